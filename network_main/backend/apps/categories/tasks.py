@@ -0,0 +1,12 @@
+from celery import shared_task
+
+from .trending import build_category_trending
+
+
+@shared_task
+def update_category_trending():
+    """
+    A periodic task that rebuilds the trending lists of categories.
+    """
+    count = build_category_trending()
+    return f'Updated trending posts of {count} categories'
@@ -1,4 +1,6 @@
 import pytest
+from django.core.cache import cache
+from django.db.models import F
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
@@ -6,6 +8,15 @@ from rest_framework.test import APIClient
 from apps.users.models import CustomUser
 from apps.communities.models import Community
 from apps.categories.models import Category
+from apps.categories.trending import build_category_trending
+from apps.posts.models import Post
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    yield
+    cache.clear()
 
 
 @pytest.fixture
@@ -84,3 +95,45 @@ class TestCategoryCommunityListView:
         response = api_client.get(url)
         assert response.status_code == status.HTTP_200_OK
         assert response.data['results'][0]['id'] == community.id
+
+
+@pytest.mark.django_db
+class TestCategoryTrending:
+    def test_trending_covers_subtree(self, api_client, test_user, parent_category, child_category, community):
+        posts = [
+            Post.objects.create(
+                author=test_user, title=f'post_{i}', community=community, status='PB')
+            for i in range(3)
+        ]
+        Post.objects.create(
+            author=test_user, title='draft', community=community, status='DF')
+        Post.objects.filter(pk=posts[0].pk).update(hot_key=F('hot_key') + 10)
+
+        assert build_category_trending() == 2
+
+        expected = [posts[0].id, posts[2].id, posts[1].id]
+        for category in (parent_category, child_category):
+            url = reverse('category-trending', kwargs={'id': category.id})
+            response = api_client.get(url)
+            assert response.status_code == status.HTTP_200_OK
+            assert [post['id'] for post in response.data['results']] == expected
+
+    def test_trending_pages(self, api_client, test_user, parent_category, community):
+        for i in range(30):
+            Post.objects.create(
+                author=test_user, title=f'post_{i}', community=community, status='PB')
+        build_category_trending()
+
+        url = reverse('category-trending', kwargs={'id': parent_category.id})
+        first = api_client.get(url)
+        second = api_client.get(url, {'cursor': first.data['next_cursor']})
+        ids = [post['id'] for post in first.data['results'] + second.data['results']]
+        assert len(ids) == 30
+        assert len(set(ids)) == 30
+        assert second.data['next_cursor'] is None
+
+    def test_unknown_category(self, api_client):
+        build_category_trending()
+        url = reverse('category-trending', kwargs={'id': 999999})
+        response = api_client.get(url)
+        assert response.status_code == status.HTTP_404_NOT_FOUND
@@ -0,0 +1,97 @@
+"""
+Trending posts per category, precomputed.
+
+A category covers the communities of its whole MPTT subtree, which is the
+(tree_id, lft..rght) range of its descendants. One query ranks the recent
+published posts of every top-level and child category by hot_key, the
+lists are stored as ranked lists in Redis and a page is a single read.
+"""
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from apps.communities.feeds import datetime_to_score
+from apps.communities.models import Community
+from apps.posts.models import Post
+from apps.recommendations.ranked import store_ranked_lists
+
+from .models import Category
+
+
+CATEGORY_TRENDING_SIZE = 500
+CATEGORY_TRENDING_DAYS = 3
+CATEGORY_TRENDING_TIMEOUT = 60 * 30
+CATEGORY_TRENDING_BUILD_LOCK_TIMEOUT = 60
+CATEGORY_TRENDING_BUILD_LOCK_KEY = 'categories:trending:building'
+# top-level categories and their children
+CATEGORY_TRENDING_MAX_LEVEL = 1
+
+
+def category_trending_key(category_id):
+    return f'category:{category_id}:trending'
+
+
+def schedule_category_trending_build():
+    from .tasks import update_category_trending
+
+    r = get_redis_connection('default')
+    acquired = r.set(
+        CATEGORY_TRENDING_BUILD_LOCK_KEY, 1,
+        nx=True, ex=CATEGORY_TRENDING_BUILD_LOCK_TIMEOUT
+    )
+    if acquired:
+        transaction.on_commit(lambda: update_category_trending.delay())
+
+
+def rank_category_posts(now=None, size=CATEGORY_TRENDING_SIZE):
+    """Returns {category_id: [post_id, ...]} best first."""
+    since = (now or timezone.now()) - timedelta(days=CATEGORY_TRENDING_DAYS)
+    quote = connection.ops.quote_name
+    categories = quote(Category._meta.db_table)
+    through = quote(Community.categories.through._meta.db_table)
+    posts = quote(Post._meta.db_table)
+
+    sql = f'''
+        WITH matched AS (
+            SELECT DISTINCT c.id AS category_id, p.id AS post_id, p.hot_key
+            FROM {categories} c
+            JOIN {categories} d
+              ON d.tree_id = c.tree_id AND d.lft BETWEEN c.lft AND c.rght
+            JOIN {through} cc ON cc.category_id = d.id
+            JOIN {posts} p ON p.community_id = cc.community_id
+            WHERE c.level <= %s AND p.status = 'PB' AND p.created >= %s
+        ),
+        ranked AS (
+            SELECT category_id, post_id, ROW_NUMBER() OVER (
+                PARTITION BY category_id ORDER BY hot_key DESC, post_id DESC
+            ) AS position
+            FROM matched
+        )
+        SELECT category_id, post_id FROM ranked
+        WHERE position <= %s
+        ORDER BY category_id, position
+    '''
+    lists = {
+        category_id: []
+        for category_id in Category.objects.filter(
+            level__lte=CATEGORY_TRENDING_MAX_LEVEL).values_list('id', flat=True)
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [CATEGORY_TRENDING_MAX_LEVEL, since, size])
+        for category_id, post_id in cursor.fetchall():
+            lists.setdefault(category_id, []).append(post_id)
+    return lists
+
+
+def build_category_trending(now=None):
+    """Stores the trending list of every category, returns their number."""
+    now = now or timezone.now()
+    lists = rank_category_posts(now)
+    store_ranked_lists(
+        {category_trending_key(category_id): ids for category_id, ids in lists.items()},
+        generation=datetime_to_score(now),
+        timeout=CATEGORY_TRENDING_TIMEOUT
+    )
+    return len(lists)
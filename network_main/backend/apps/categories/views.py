@@ -2,6 +2,8 @@ from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from rest_framework import generics
 from rest_framework.response import Response
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 
 from django.db.models import Exists, Value, OuterRef
 from django.db.models.fields import BooleanField
@@ -11,9 +13,16 @@ from apps.communities.models import Community
 from apps.communities.serializers import CommunityListSerializer
 from apps.communities.views import CommunityPagination
 from apps.memberships.models import Membership
+from apps.posts.cards import render_post_cards_by_ids
+from apps.recommendations.ranked import get_ranked_page, decode_ranked_cursor
 
 from .models import Category
 from .serializers import ParentCategorySerializer
+from .trending import (
+    category_trending_key,
+    schedule_category_trending_build,
+    CATEGORY_TRENDING_MAX_LEVEL
+)
 
 
 class CategoryViewSet(viewsets.ModelViewSet):
@@ -21,6 +30,7 @@ class CategoryViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticatedOrReadOnly]
     http_method_names = ['get']
     lookup_field = 'id'
+    lookup_value_regex = r'\d+'
 
     def get_queryset(self):
         return Category.objects.filter(parent__isnull=True).prefetch_related('children')
@@ -67,6 +77,32 @@ class CategoryViewSet(viewsets.ModelViewSet):
 
         return Response(data)
 
+    @action(detail=True, methods=['get'], url_path='trending')
+    def trending(self, request, id=None):
+        """Trending posts of the category and its subcategories."""
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                cursor = decode_ranked_cursor(cursor)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+
+        page = get_ranked_page(category_trending_key(id), cursor or None)
+        if page is None:
+            is_ranked = Category.objects.filter(
+                id=id, level__lte=CATEGORY_TRENDING_MAX_LEVEL).exists()
+            if not is_ranked:
+                raise NotFound()
+            # the lists expired, they are rebuilt in the background
+            schedule_category_trending_build()
+            return Response({'next_cursor': None, 'results': []})
+
+        post_ids, next_cursor, _ = page
+        return Response({
+            'next_cursor': next_cursor,
+            'results': render_post_cards_by_ids(request, post_ids)
+        })
+
 
 class CategoryCommunityListView(generics.ListAPIView):
     serializer_class = CommunityListSerializer
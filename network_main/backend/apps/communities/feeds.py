@@ -0,0 +1,240 @@
+import base64
+import binascii
+import logging
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.db.models import Q
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+
+FEED_MAX_LENGTH = 1000
+FEED_TIMEOUT = 60 * 60 * 24
+FEED_REBUILD_LOCK_TIMEOUT = 60
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# ZADD only into feeds that are already materialized, otherwise a single
+# new post would create a "warm" feed that contains nothing else.
+ADD_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -(tonumber(ARGV[3]) + 1))
+    return 1
+end
+return 0
+"""
+
+
+def feed_key(community_id):
+    return f'community:{community_id}:feed'
+
+
+def feed_rebuild_lock_key(community_id):
+    return f'community:{community_id}:feed:rebuild'
+
+
+def datetime_to_score(value: datetime) -> int:
+    """
+    Integer microseconds since epoch.
+    Fits into the 53-bit mantissa of a Redis score, so it round-trips exactly.
+    """
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def score_to_datetime(score: int) -> datetime:
+    return EPOCH + timedelta(microseconds=int(score))
+
+
+def encode_feed_cursor(score: int, post_id: int) -> str:
+    return base64.urlsafe_b64encode(f's={score},{post_id}'.encode()).decode()
+
+
+def decode_feed_cursor(cursor: str):
+    """
+    Returns the (score, post_id) encoded in cursor or raises ValueError.
+    Cursors without an id, from before the tie-break, skip the whole score.
+    """
+    try:
+        decoded = base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (binascii.Error, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+    key, _, value = decoded.partition('=')
+    score, _, post_id = value.partition(',')
+    if key != 's' or not score.isdigit() or not (post_id or '0').isdigit():
+        raise ValueError('Invalid cursor')
+    return int(score), int(post_id or 0)
+
+
+def filter_after_cursor(queryset, cursor):
+    """Posts that come after the cursor in (-created, -id) order."""
+    if cursor is None:
+        return queryset
+    score, post_id = cursor
+    created = score_to_datetime(score)
+    return queryset.filter(
+        Q(created__lt=created) | Q(created=created, id__lt=post_id))
+
+
+def queue_feed_range(pipe, key, cursor, count):
+    """Queues the reads of read_feed_range."""
+    upper = '+inf'
+    if cursor is not None:
+        score, _ = cursor
+        pipe.zrangebyscore(key, score, score, withscores=True)
+        upper = f'({score}'
+    pipe.zrevrangebyscore(key, upper, '-inf', start=0, num=count + 1,
+                          withscores=True)
+
+
+def read_feed_range(replies, cursor, count):
+    """
+    Entries of a sorted set after the cursor, from the replies of
+    queue_feed_range: (post_id, score) pairs newest first, ties by id.
+    Returns them with the score the range was cut at, or None when
+    the set is exhausted.
+
+    Redis orders members of one score as text, not by id. The tie group
+    at the cursor is read whole, and the group at the cut, which may be
+    partial, is left to the next page.
+    """
+    ties = []
+    if cursor is not None:
+        score, post_id = cursor
+        ties = [(int(m), int(s)) for m, s in replies[0] if 0 < int(m) < post_id]
+
+    # the sentinel of empty feeds has id 0 and is never served
+    below = [(int(m), int(s)) for m, s in replies[-1] if int(m)]
+    cut = None
+    if len(below) > count:
+        cut = below[-1][1]
+        below = [entry for entry in below if entry[1] > cut]
+
+    entries = sorted(ties + below, key=lambda entry: (-entry[1], -entry[0]))
+    return entries, cut
+
+
+def add_post_to_feed(post):
+    try:
+        r = get_redis_connection('default')
+        script = r.register_script(ADD_IF_EXISTS_SCRIPT)
+        script(
+            keys=[feed_key(post.community_id)],
+            args=[datetime_to_score(post.created), post.pk, FEED_MAX_LENGTH]
+        )
+    except RedisError as e:
+        logger.warning(f'Failed to add post {post.pk} to community feed: {e}')
+
+
+def remove_posts_from_feed(community_id, post_ids):
+    if not post_ids:
+        return
+    try:
+        r = get_redis_connection('default')
+        r.zrem(feed_key(community_id), *post_ids)
+    except RedisError as e:
+        logger.warning(
+            f'Failed to remove posts from feed of community {community_id}: {e}')
+
+
+def schedule_feed_rebuild(community_id):
+    """Queues a rebuild unless one was queued recently."""
+    from .tasks import rebuild_community_feed
+
+    r = get_redis_connection('default')
+    acquired = r.set(
+        feed_rebuild_lock_key(community_id), 1,
+        nx=True, ex=FEED_REBUILD_LOCK_TIMEOUT
+    )
+    if acquired:
+        transaction.on_commit(
+            lambda: rebuild_community_feed.delay(community_id)
+        )
+
+
+def get_feed_page(community_id, cursor=None, count=25):
+    """
+    Returns up to `count` (post_id, score) pairs after the (score, post_id)
+    cursor, newest first, and whether more follow, or None if the page
+    can't be served from Redis. Cold feeds are rebuilt in the background.
+    """
+    key = feed_key(community_id)
+
+    try:
+        r = get_redis_connection('default')
+        pipe = r.pipeline(transaction=False)
+        pipe.exists(key)
+        pipe.zcard(key)
+        queue_feed_range(pipe, key, cursor, count)
+        exists, size, *replies = pipe.execute()
+
+        if not exists:
+            schedule_feed_rebuild(community_id)
+            return None
+    except RedisError as e:
+        logger.warning(f'Failed to read feed of community {community_id}: {e}')
+        return None
+
+    entries, cut = read_feed_range(replies, cursor, count)
+    # the feed keeps only the newest posts, older pages live in Postgres
+    if cut is None and size >= FEED_MAX_LENGTH:
+        return None
+    # a single timestamp fills the whole range
+    if cut is not None and not entries:
+        return None
+
+    return entries[:count], cut is not None or len(entries) > count
+
+
+def rebuild_feed(community_id):
+    """
+    Replaces the feed of a community with its newest posts. Posts that
+    are created while the feed is built are added again after the swap.
+    An empty feed keeps a sentinel, so it stays warm until it expires.
+    """
+    from apps.posts.models import Post
+
+    posts = Post.published.filter(community_id=community_id)
+    rows = list(
+        posts
+        .order_by('-created', '-id')
+        .values_list('id', 'created')[:FEED_MAX_LENGTH]
+    )
+
+    key = feed_key(community_id)
+    tmp_key = f'{key}:tmp'
+
+    r = get_redis_connection('default')
+    pipe = r.pipeline()
+    pipe.delete(tmp_key)
+    pipe.zadd(tmp_key, {0: 0})
+    if rows:
+        pipe.zadd(tmp_key, {
+            post_id: datetime_to_score(created) for post_id, created in rows
+        })
+    pipe.expire(tmp_key, FEED_TIMEOUT)
+    pipe.rename(tmp_key, key)
+    pipe.delete(feed_rebuild_lock_key(community_id))
+    pipe.execute()
+
+    # new posts skip feeds that don't exist, so the ones saved between
+    # the select and the rename are missing
+    if rows:
+        posts = posts.filter(created__gte=rows[0][1])
+    late = posts.values_list('id', 'created')[:FEED_MAX_LENGTH]
+    if late:
+        script = r.register_script(ADD_IF_EXISTS_SCRIPT)
+        pipe = r.pipeline(transaction=False)
+        for post_id, created in late:
+            script(
+                keys=[key],
+                args=[datetime_to_score(created), post_id, FEED_MAX_LENGTH],
+                client=pipe
+            )
+        pipe.execute()
+
+    return len(rows)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.14 on 2026-10-17 20:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='community',
+            name='is_deleted',
+            field=models.BooleanField(default=False),
+        ),
+    ]
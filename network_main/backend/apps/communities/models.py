@@ -16,6 +16,13 @@ from apps.services.utils import unique_slugify, FileSizeValidator
 User = settings.AUTH_USER_MODEL
 
 
+class ActiveCommunityManager(models.Manager):
+    """Communities that are not being deleted."""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(is_deleted=False)
+
+
 class Community(models.Model):
     """Community model"""
 
@@ -94,6 +101,10 @@ class Community(models.Model):
         verbose_name='Members count'
     )
     activity_score = models.IntegerField(default=0, db_index=True)
+    is_deleted = models.BooleanField(default=False)
+
+    objects = ActiveCommunityManager()
+    all_objects = models.Manager()
 
     class Meta:
         db_table = 'api_network_community'
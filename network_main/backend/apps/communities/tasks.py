@@ -0,0 +1,12 @@
+from celery import shared_task
+
+from .feeds import rebuild_feed
+
+
+@shared_task
+def rebuild_community_feed(community_id):
+    """
+    Materializes the Redis feed of a community from Postgres.
+    """
+    count = rebuild_feed(community_id)
+    return f'Rebuilt feed for community {community_id}: {count} posts'
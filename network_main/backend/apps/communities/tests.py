@@ -1,5 +1,7 @@
 import pytest
+from datetime import timedelta
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APIClient
 import io
@@ -11,7 +13,11 @@ from apps.users.models import CustomUser
 from apps.categories.models import Category
 from apps.communities.models import Community
 from apps.memberships.models import Membership
-from apps.posts.models import Post
+from apps.posts.models import Post, DeletionJob
+from apps.posts.tasks import run_deletion_job
+from apps.communities import feeds
+from apps.communities.feeds import feed_key, get_feed_page, rebuild_feed
+from django_redis import get_redis_connection
 
 
 @pytest.fixture
@@ -383,6 +389,10 @@ class TestCommunityViewSet():
         url = reverse('community-detail', kwargs={'slug': community.slug})
         response = authenticated_client_creator.delete(url)
         assert response.status_code == status.HTTP_204_NO_CONTENT
+
+        # memberships are removed by the background deletion job
+        job = DeletionJob.objects.get(kind='community', target_id=community.pk)
+        run_deletion_job(job.pk)
         assert not Membership.objects.filter(community=community).exists()
 
 
@@ -421,6 +431,168 @@ class TestCommunityPostsListView():
         assert not any(r['id'] == other_post.id for r in results)
 
 
+@pytest.mark.django_db
+class TestCommunityFeed():
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+        yield
+        cache.clear()
+
+    @pytest.fixture
+    def many_posts(self, community, test_user_creator):
+        now = timezone.now()
+        posts = []
+        for i in range(60):
+            post = Post.objects.create(
+                title=f'feedpost_{i}',
+                author=test_user_creator,
+                community=community
+            )
+            # shuffle creation times so id order != time order
+            Post.objects.filter(pk=post.pk).update(
+                created=now - timedelta(minutes=(i * 7) % 60, seconds=i)
+            )
+            posts.append(post)
+        return posts
+
+    def collect_ids(self, client, url):
+        ids = []
+        while url:
+            response = client.get(url)
+            assert response.status_code == status.HTTP_200_OK
+            ids.extend(r['id'] for r in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def expected_ids(self, community):
+        return list(
+            Post.published
+            .filter(community=community)
+            .order_by('-created', '-id')
+            .values_list('id', flat=True)
+        )
+
+    def test_feed_parity_with_queryset(self, api_client, community, many_posts):
+        url = reverse('community-posts-list',
+                      kwargs={'community_slug': community.slug})
+
+        cold_ids = self.collect_ids(api_client, url)
+
+        rebuild_feed(community.id)
+        r = get_redis_connection('default')
+        # and the sentinel
+        assert r.zcard(feed_key(community.id)) == len(many_posts) + 1
+
+        warm_ids = self.collect_ids(api_client, url)
+
+        assert cold_ids == self.expected_ids(community)
+        assert warm_ids == cold_ids
+
+    def test_truncated_feed_continues_from_postgres(self, api_client, community, many_posts, monkeypatch):
+        monkeypatch.setattr('apps.communities.feeds.FEED_MAX_LENGTH', 30)
+        rebuild_feed(community.id)
+
+        url = reverse('community-posts-list',
+                      kwargs={'community_slug': community.slug})
+
+        assert self.collect_ids(api_client, url) == self.expected_ids(community)
+
+    def test_signals_keep_feed_up_to_date(self, api_client, community, post, test_user_creator):
+        rebuild_feed(community.id)
+
+        new_post = Post.objects.create(
+            title='fresh post',
+            author=test_user_creator,
+            community=community
+        )
+        r = get_redis_connection('default')
+        members = {int(m) for m in r.zrange(feed_key(community.id), 0, -1)}
+        assert members == {0, post.id, new_post.id}
+
+        new_post.status = 'DF'
+        new_post.save()
+        post.delete()
+
+        assert r.zrange(feed_key(community.id), 0, -1) == [b'0']
+
+    def test_signals_do_not_create_cold_feed(self, community, post):
+        r = get_redis_connection('default')
+        assert not r.exists(feed_key(community.id))
+
+    def test_stale_feed_entries_are_dropped(self, api_client, community, post):
+        rebuild_feed(community.id)
+        Post.objects.filter(pk=post.pk).update(status='DF')
+
+        url = reverse('community-posts-list',
+                      kwargs={'community_slug': community.slug})
+        response = api_client.get(url)
+
+        assert response.data['results'] == []
+        r = get_redis_connection('default')
+        assert r.zrange(feed_key(community.id), 0, -1) == [b'0']
+
+    def test_empty_feed_stays_warm(self, community):
+        rebuild_feed(community.id)
+
+        r = get_redis_connection('default')
+        assert r.ttl(feed_key(community.id)) > 0
+        assert get_feed_page(community.id) == ([], False)
+
+    def test_post_created_during_rebuild_is_kept(self, community, post, test_user_creator, monkeypatch):
+        connect = feeds.get_redis_connection
+        pending = [True]
+        late = []
+
+        def connect_after_new_post(alias):
+            # the post is saved after the select, before the swap
+            if pending:
+                pending.pop()
+                late.append(Post.objects.create(
+                    title='late post',
+                    author=test_user_creator,
+                    community=community
+                ))
+            return connect(alias)
+
+        monkeypatch.setattr(
+            'apps.communities.feeds.get_redis_connection', connect_after_new_post)
+        rebuild_feed(community.id)
+
+        r = get_redis_connection('default')
+        members = {int(m) for m in r.zrange(feed_key(community.id), 0, -1)}
+        assert members == {0, post.id, late[0].id}
+
+    def test_posts_with_same_created_are_paged(self, api_client, community, test_user_creator, monkeypatch):
+        monkeypatch.setattr(
+            'apps.communities.views.CommunityFeedPagination.page_size', 3)
+        now = timezone.now()
+        for i in range(12):
+            post = Post.objects.create(
+                title=f'tiedpost_{i}',
+                author=test_user_creator,
+                community=community
+            )
+            Post.objects.filter(pk=post.pk).update(
+                created=now - timedelta(minutes=i // 5))
+
+        url = reverse('community-posts-list',
+                      kwargs={'community_slug': community.slug})
+        cold_ids = self.collect_ids(api_client, url)
+        rebuild_feed(community.id)
+        warm_ids = self.collect_ids(api_client, url)
+
+        assert cold_ids == self.expected_ids(community)
+        assert warm_ids == cold_ids
+
+    def test_invalid_cursor(self, api_client, community, post):
+        url = reverse('community-posts-list',
+                      kwargs={'community_slug': community.slug})
+        response = api_client.get(url, {'cursor': 'garbage'})
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
 @pytest.mark.django_db
 class TestMembershipViewSet():
     def test_join_community(self, authenticated_client, test_user, community):
@@ -2,7 +2,9 @@ from rest_framework import viewsets, mixins, status, views
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from rest_framework.pagination import CursorPagination
+from rest_framework.pagination import CursorPagination, BasePagination
+from rest_framework.exceptions import NotFound
+from rest_framework.utils.urls import replace_query_param
 
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
@@ -10,13 +12,27 @@ from django.shortcuts import get_object_or_404
 from django.db.models import OuterRef, Exists, Value, Q, Prefetch
 from django.db.models.fields import BooleanField
 from django.db import transaction
-from django.contrib.contenttypes.models import ContentType
 
 from apps.memberships.models import Membership
-from apps.posts.models import Post
-from apps.posts.views import PostPagination, get_annotated_ratings
+from apps.posts.models import PostCard
+from apps.posts.deletion import delete_community
+from apps.posts.cards import (
+    render_post_cards,
+    render_post_cards_by_ids,
+    COMMUNITY_CARD_FIELDS
+)
+from apps.recommendations.ranked import decode_ranked_cursor
+from apps.recommendations.rollups import parse_window, get_top_page
 
 from .models import Community
+from .feeds import (
+    get_feed_page,
+    remove_posts_from_feed,
+    datetime_to_score,
+    filter_after_cursor,
+    encode_feed_cursor,
+    decode_feed_cursor
+)
 from .serializers import (
     CommunityListSerializer,
     CommunityDetailSerializer,
@@ -167,22 +183,144 @@ class CommunityViewSet(viewsets.ModelViewSet):
         serializer.save()
         cache.delete(f"community:{instance.slug}")
 
+    def perform_destroy(self, instance):
+        delete_community(instance)
+
     def get_serializer_context(self):
         return {'request': self.request}
 
 
+class CommunityFeedPagination(BasePagination):
+    """
+    Pages through the materialized Redis feed of a community,
+    falling back to Postgres when the feed is cold or exhausted.
+    Both sources share the same (created, id) cursor.
+    """
+    page_size = 25
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.next_cursor = None
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            try:
+                cursor = decode_feed_cursor(cursor)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+        else:
+            cursor = None
+
+        community_id = view.community.id
+        page = get_feed_page(community_id, cursor, self.page_size)
+
+        if page is None:
+            posts = list(
+                filter_after_cursor(queryset, cursor)
+                .order_by('-created', '-id')[:self.page_size + 1]
+            )
+
+            if len(posts) > self.page_size:
+                posts = posts[:self.page_size]
+                self.next_cursor = (
+                    datetime_to_score(posts[-1].created), posts[-1].id)
+            return posts
+
+        entries, more = page
+        if more:
+            post_id, score = entries[-1]
+            self.next_cursor = (score, post_id)
+
+        page_ids = [post_id for post_id, _ in entries]
+        if not page_ids:
+            return []
+
+        found = {post.id: post for post in queryset.filter(pk__in=page_ids)}
+
+        # deleted, unpublished or moved posts are dropped lazily
+        if len(found) < len(page_ids):
+            remove_posts_from_feed(
+                community_id,
+                [pk for pk in page_ids if pk not in found]
+            )
+
+        return [found[pk] for pk in page_ids if pk in found]
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, encode_feed_cursor(*self.next_cursor)
+        )
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': None,
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
 class CommunityPostsListView(viewsets.GenericViewSet, mixins.ListModelMixin):
     serializer_class = CommunityPostListSerializer
-    pagination_class = PostPagination
+    pagination_class = CommunityFeedPagination
 
     def get_queryset(self):
-        queryset = Post.published.filter(
-            community__slug=self.kwargs['community_slug']
-        ).prefetch_related('media_data')
-        queryset = get_annotated_ratings(
-            queryset, self.request, ContentType.objects.get_for_model(Post)
+        self.community = get_object_or_404(
+            Community.objects.only('id'),
+            slug=self.kwargs['community_slug']
         )
-        return queryset
+        return PostCard.objects.filter(
+            status='PB', community_id=self.community.id)
+
+    def list(self, request, *args, **kwargs):
+        window = parse_window(request)
+        if window:
+            return self.list_top(request, window)
+
+        page = self.paginate_queryset(self.get_queryset())
+        return self.get_paginated_response(
+            render_post_cards(request, page, COMMUNITY_CARD_FIELDS))
+
+    def list_top(self, request, window):
+        """Posts with the most net votes within the window."""
+        community = get_object_or_404(
+            Community.objects.only('id'), slug=self.kwargs['community_slug'])
+
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                cursor = decode_ranked_cursor(cursor)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+
+        page_ids, next_cursor, _ = get_top_page(
+            window, cursor or None, self.pagination_class.page_size, community.id)
+
+        next_link = None
+        if next_cursor:
+            next_link = replace_query_param(
+                request.build_absolute_uri(), 'cursor', next_cursor)
+
+        return Response({
+            'next': next_link,
+            'previous': None,
+            'results': render_post_cards_by_ids(
+                request, page_ids, COMMUNITY_CARD_FIELDS),
+        })
 
 
 class CommunityNameCheck(views.APIView):
@@ -206,7 +344,8 @@ class MembershipViewSet(
     def get_queryset(self):
         return Membership.objects.filter(
             user=self.request.user,
-            community_id=self.kwargs['community_pk']
+            community_id=self.kwargs['community_pk'],
+            community__is_deleted=False
         )
 
     def perform_create(self, serializer):
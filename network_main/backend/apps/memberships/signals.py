@@ -4,6 +4,7 @@ from django.dispatch import receiver
 from django.core.cache import cache
 
 from apps.communities.models import Community
+from apps.recommendations.feeds import invalidate_home_feed
 from .models import Membership
 
 
@@ -21,6 +22,11 @@ def invalidate_first_community_recommendations_page_cache(sender, instance, **kw
     cache.delete(key)
 
 
+@receiver([post_save, post_delete], sender=Membership)
+def invalidate_home_feed_on_membership_change(sender, instance, **kwargs):
+    invalidate_home_feed(instance.user_id)
+
+
 @receiver(post_save, sender=Membership)
 def on_member_join(sender, instance, created, **kwargs):
     if created:
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Post, Media, Comment
+from .models import Post, Media, Comment, DeletionJob
 
 
 class MediaInLine(admin.TabularInline):
@@ -17,3 +17,10 @@ class ApiPostAdmin(admin.ModelAdmin):
 @admin.register(Comment)
 class ApiPostAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(DeletionJob)
+class DeletionJobAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'target_id', 'stage', 'last_id', 'progress', 'updated', 'finished')
+    list_filter = ('kind', 'stage')
+    readonly_fields = list_display + ('created',)
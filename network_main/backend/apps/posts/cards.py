@@ -0,0 +1,256 @@
+"""
+Post cards for list endpoints.
+
+A card is a row of the PostCard read model: the post with its author,
+community and a summary of its media, so a page is read from one table
+without joins or prefetches. Rows are written here from the source
+models; updates of the post row itself, including the counters, are
+copied by a trigger (see migration 0008). The viewer's votes are merged
+in from one batched lookup.
+"""
+from django.contrib.contenttypes.models import ContentType
+from rest_framework import serializers
+
+from apps.communities.models import Community
+from apps.ratings.models import Rating
+
+from .images import rendition_urls
+from .models import Post, Media, PostCard
+
+
+CARD_BATCH_SIZE = 1000
+
+POST_CARD_FIELDS = (
+    'id', 'title', 'slug', 'description', 'status', 'author',
+    'created', 'updated', 'sum_rating', 'user_vote', 'comment_count',
+    'community_id', 'community_slug', 'community_name', 'community_icon',
+    'media_data', 'score'
+)
+COMMUNITY_CARD_FIELDS = (
+    'id', 'title', 'slug', 'description', 'status', 'author',
+    'created', 'updated', 'sum_rating', 'user_vote', 'comment_count',
+    'media_data', 'author_slug', 'author_icon'
+)
+
+datetime_field = serializers.DateTimeField()
+
+
+def file_url(file):
+    return file.url if file else ''
+
+
+def author_fields(user):
+    return {
+        'author_id': user.pk,
+        'author_name': user.username,
+        'author_slug': user.slug,
+        'author_icon': file_url(user.avatar),
+    }
+
+
+def community_fields(community):
+    return {
+        'community_id': community.pk,
+        'community_slug': community.slug,
+        'community_name': community.name,
+        'community_icon': file_url(community.icon),
+    }
+
+
+def media_summary(media):
+    return [
+        {
+            'id': item.id,
+            'url': file_url(item.file),
+            'media_type': item.get_media_type(),
+            'aspect_ratio': item.aspect_ratio,
+            'width': item.width,
+            'height': item.height,
+            'dominant_color': item.dominant_color,
+            'placeholder': item.placeholder,
+            'srcset': rendition_urls(item) if item.file else [],
+            'uploaded_at': datetime_field.to_representation(item.uploaded_at),
+        }
+        for item in media
+    ]
+
+
+def build_post_card(post):
+    """A PostCard of a post loaded with author, community and media_data."""
+    return PostCard(
+        id=post.id,
+        status=post.status,
+        title=post.title,
+        slug=post.slug,
+        description=post.description,
+        created=post.created,
+        updated=post.updated,
+        **author_fields(post.author),
+        **community_fields(post.community),
+        media=media_summary(post.media_data.all()),
+        sum_rating=post.sum_rating,
+        comment_count=post.comment_count,
+        score=post.score,
+        hot_key=post.hot_key,
+    )
+
+
+def build_post_cards(post_ids):
+    return [
+        build_post_card(post)
+        for post in (
+            Post.objects
+            .filter(id__in=post_ids)
+            .select_related('author', 'community')
+            .prefetch_related('media_data')
+        )
+    ]
+
+
+def refresh_post_cards(post_ids):
+    """Rewrites the cards of posts, drops cards of posts that are gone."""
+    post_ids = list(post_ids)
+    cards = build_post_cards(post_ids)
+    PostCard.objects.bulk_create(
+        cards,
+        batch_size=CARD_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['id'],
+        update_fields=[
+            field.name for field in PostCard._meta.fields if not field.primary_key
+        ]
+    )
+    found = {card.id for card in cards}
+    PostCard.objects.filter(
+        id__in=[post_id for post_id in post_ids if post_id not in found]
+    ).delete()
+    return len(cards)
+
+
+def refresh_card_media(post_id):
+    PostCard.objects.filter(id=post_id).update(
+        media=media_summary(Media.objects.filter(post_id=post_id)))
+
+
+def refresh_author_cards(user):
+    """Updates the author fields of a user's cards if they changed."""
+    fields = author_fields(user)
+    PostCard.objects.filter(author_id=user.pk).exclude(**fields).update(**fields)
+
+
+def refresh_community_cards(community):
+    fields = community_fields(community)
+    PostCard.objects.filter(
+        community_id=community.pk).exclude(**fields).update(**fields)
+
+
+def absolute_url(request, url):
+    if request is None or not url:
+        return url or None
+    return request.build_absolute_uri(url)
+
+
+def render_card(card, request=None, fields=POST_CARD_FIELDS):
+    """Returns the card as a list serializer would, with user_vote set to 0."""
+    data = {
+        'id': card.id,
+        'title': card.title,
+        'slug': card.slug,
+        'description': card.description,
+        'status': card.status,
+        'author': card.author_slug,
+        'author_slug': card.author_slug,
+        'author_icon': absolute_url(request, card.author_icon),
+        'created': datetime_field.to_representation(card.created),
+        'updated': datetime_field.to_representation(card.updated),
+        'sum_rating': card.sum_rating,
+        'user_vote': 0,
+        'comment_count': card.comment_count,
+        'community_id': card.community_id,
+        'community_slug': card.community_slug,
+        'community_name': card.community_name,
+        'community_icon': card.community_icon or None,
+        'media_data': [
+            {
+                'id': item['id'],
+                'file': absolute_url(request, item['url']),
+                'media_type': item['media_type'],
+                'aspect_ratio': item['aspect_ratio'],
+                'width': item.get('width'),
+                'height': item.get('height'),
+                'dominant_color': item.get('dominant_color', ''),
+                'placeholder': item.get('placeholder', ''),
+                'file_url': item['url'],
+                'srcset': [
+                    {'url': absolute_url(request, source['url']),
+                     'width': source['width']}
+                    for source in item.get('srcset', [])
+                ],
+                'uploaded_at': item['uploaded_at'],
+            }
+            for item in card.media
+        ],
+        'score': card.score,
+    }
+    return {field: data[field] for field in fields}
+
+
+def get_post_cards(cards, request=None, fields=POST_CARD_FIELDS):
+    return [render_card(card, request, fields) for card in cards]
+
+
+def published_cards():
+    """
+    Cards of published posts. Posts of a deleted community are hidden by
+    its deletion job later, until then they are left out here.
+    """
+    return PostCard.objects.filter(status='PB').exclude(
+        community_id__in=Community.all_objects
+        .filter(is_deleted=True)
+        .values('id')
+    )
+
+
+def drop_deleted_communities(cards):
+    """Rendered cards without those of communities deleted since."""
+    community_ids = {card['community_id'] for card in cards}
+    deleted = set(
+        Community.all_objects
+        .filter(id__in=community_ids, is_deleted=True)
+        .values_list('id', flat=True)
+    ) if community_ids else set()
+    return [card for card in cards if card['community_id'] not in deleted]
+
+
+def get_cards_by_ids(post_ids):
+    """Published cards of the given posts, in the given order."""
+    cards = {
+        card.id: card
+        for card in published_cards().filter(id__in=post_ids)
+    } if post_ids else {}
+    return [cards[post_id] for post_id in post_ids if post_id in cards]
+
+
+def overlay_user_votes(request, cards):
+    """Returns copies of cards with the votes of the request user."""
+    votes = {}
+    if request.user.is_authenticated and cards:
+        votes = dict(
+            Rating.objects
+            .filter(
+                content_type=ContentType.objects.get_for_model(Post),
+                object_id__in=[card['id'] for card in cards],
+                user=request.user
+            )
+            .values_list('object_id', 'value')
+        )
+
+    return [{**card, 'user_vote': votes.get(card['id'], 0)} for card in cards]
+
+
+def render_post_cards(request, cards, fields=POST_CARD_FIELDS):
+    return overlay_user_votes(request, get_post_cards(cards, request, fields))
+
+
+def render_post_cards_by_ids(request, post_ids, fields=POST_CARD_FIELDS):
+    return render_post_cards(request, get_cards_by_ids(post_ids), fields)
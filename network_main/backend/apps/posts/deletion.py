@@ -0,0 +1,349 @@
+"""
+Chunked removal of communities and accounts.
+
+Deleting a community or a user through the ORM cascades to every post,
+comment, rating and membership and runs the delete signals once per row.
+Instead the target is hidden at once and a DeletionJob removes its rows
+in id ordered chunks, one short transaction per chunk. Counters of the
+rows that stay (`members_count`, `sum_rating`, `comment_count`) are
+changed once per chunk, and the job row records where to resume.
+Posts are purged in their own batched transactions instead, and the
+cursor moves after them. A session advisory lock per job keeps two
+workers from running the same job.
+"""
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone as dt_timezone
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from apps.communities.feeds import feed_key, remove_posts_from_feed
+from apps.communities.models import Community
+from apps.memberships.models import Membership
+from apps.ratings.counters import (
+    apply_rating_deltas,
+    changed_key,
+    hour_start
+)
+from apps.ratings.models import Rating
+from apps.recommendations.feeds import invalidate_home_feed
+from apps.recommendations.rollups import upsert_rollups
+from apps.recommendations.scoring import mark_posts_dirty, hot_key_expression
+
+from .models import Post, Comment, DeletionJob
+from .purge import purge_post
+from .signals import (
+    change_post_comment_count,
+    change_replies_counts,
+    removed_replies
+)
+
+logger = logging.getLogger(__name__)
+
+
+DELETION_BATCH_SIZE = 1000
+# posts are purged one by one with all their comments
+POSTS_PER_CHUNK = 10
+# the first key of the advisory locks of deletion jobs
+DELETION_LOCK_NAMESPACE = 7301
+
+STAGES = {
+    DeletionJob.Kind.COMMUNITY: (
+        'hide_posts', 'posts', 'memberships', 'community'),
+    DeletionJob.Kind.USER: (
+        'hide_posts', 'posts', 'comments', 'ratings', 'memberships', 'user'),
+}
+
+
+def quote(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def start_deletion(kind, target_id):
+    """Creates the job of a target unless one is running, returns the job."""
+    job, created = DeletionJob.objects.get_or_create(
+        kind=kind,
+        target_id=target_id,
+        finished__isnull=True,
+        defaults={'stage': STAGES[kind][0]}
+    )
+    if created:
+        from .tasks import run_deletion_job
+
+        transaction.on_commit(lambda: run_deletion_job.delay(job.pk))
+    return job
+
+
+def delete_community(community):
+    """Hides the community, frees its name and slug and schedules the job."""
+    cache.delete(f'community:{community.slug}')
+    with transaction.atomic():
+        Community.all_objects.filter(pk=community.pk).update(
+            is_deleted=True,
+            name=f'deleted-{community.pk}',
+            slug=f'deleted-{community.pk}'
+        )
+        return start_deletion(DeletionJob.Kind.COMMUNITY, community.pk)
+
+
+def delete_user(user):
+    """Deactivates the account and schedules the job."""
+    with transaction.atomic():
+        get_user_model().objects.filter(pk=user.pk).update(is_active=False)
+        return start_deletion(DeletionJob.Kind.USER, user.pk)
+
+
+def owner_filter(job):
+    column = 'community_id' if job.kind == DeletionJob.Kind.COMMUNITY else 'author_id'
+    return column, job.target_id
+
+
+def hide_posts(job):
+    """Marks the posts of the target as deleted, so feeds drop them."""
+    column, target_id = owner_filter(job)
+    posts = quote(Post)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {posts} SET status = 'DL', updated = %s "
+            f"WHERE id IN (SELECT id FROM {posts} "
+            f"WHERE {column} = %s AND id > %s ORDER BY id LIMIT %s) "
+            f"RETURNING id, community_id",
+            [timezone.now(), target_id, job.last_id, DELETION_BATCH_SIZE]
+        )
+        rows = cursor.fetchall()
+
+    by_community = {}
+    for post_id, community_id in rows:
+        by_community.setdefault(community_id, []).append(post_id)
+    for community_id, post_ids in by_community.items():
+        remove_posts_from_feed(community_id, post_ids)
+
+    return len(rows), max((row[0] for row in rows), default=job.last_id)
+
+
+def purge_posts(job):
+    """
+    Purges a chunk of hidden posts, each in its own batches. Runs outside
+    of the job transaction: if the cursor is not saved afterwards, the next
+    run only finds the posts that are not purged yet.
+    """
+    column, target_id = owner_filter(job)
+    post_ids = list(
+        Post.objects
+        .filter(**{column: target_id}, status='DL', id__gt=job.last_id)
+        .order_by('id')
+        .values_list('id', flat=True)[:POSTS_PER_CHUNK]
+    )
+    for post_id in post_ids:
+        purge_post(post_id)
+    return len(post_ids), max(post_ids, default=job.last_id)
+
+
+def delete_comments(job):
+    """
+    Deletes a chunk of the user's comments with their replies and
+    lowers comment_count of each post and the replies counts once.
+    """
+    comments = quote(Comment)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT id, path FROM {comments} '
+            f'WHERE author_id = %s AND id > %s ORDER BY id LIMIT %s',
+            [job.target_id, job.last_id, DELETION_BATCH_SIZE]
+        )
+        roots = cursor.fetchall()
+        if not roots:
+            return 0, job.last_id
+
+        cursor.execute(
+            f"DELETE FROM {comments} c "
+            f"USING (SELECT unnest(%s::text[]) AS path) r "
+            f"WHERE c.path >= r.path AND c.path < r.path || '~' "
+            f"RETURNING c.id, c.post_id, c.path",
+            [[path for _, path in roots]]
+        )
+        deleted = cursor.fetchall()
+
+        cursor.execute(
+            f'DELETE FROM {quote(Rating)} '
+            f'WHERE content_type_id = %s AND object_id = ANY(%s)',
+            [ContentType.objects.get_for_model(Comment).id,
+             [comment_id for comment_id, _, _ in deleted]]
+        )
+
+    per_post = Counter(post_id for _, post_id, _ in deleted)
+    for post_id in sorted(per_post):
+        change_post_comment_count(post_id, -per_post[post_id])
+    change_replies_counts(removed_replies([path for _, _, path in deleted]))
+
+    return len(deleted), roots[-1][0]
+
+
+def delete_ratings(job):
+    """
+    Deletes a chunk of the user's votes and takes them out of the sums.
+    Like an unvote, the votes are subtracted from the rollup of this hour.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {quote(Rating)} WHERE id IN ('
+            f'SELECT id FROM {quote(Rating)} '
+            f'WHERE user_id = %s AND id > %s ORDER BY id LIMIT %s) '
+            f'RETURNING id, content_type_id, object_id, value',
+            [job.target_id, job.last_id, DELETION_BATCH_SIZE]
+        )
+        rows = cursor.fetchall()
+
+    deltas = {}
+    for _, content_type_id, object_id, value in rows:
+        delta, votes = deltas.get((content_type_id, object_id), (0, 0))
+        deltas[(content_type_id, object_id)] = (delta - value, votes - 1)
+
+    for model in (Post, Comment):
+        type_id = ContentType.objects.get_for_model(model).id
+        items = [
+            (object_id, delta, votes)
+            for (content_type_id, object_id), (delta, votes) in deltas.items()
+            if content_type_id == type_id
+        ]
+        if not items:
+            continue
+        apply_rating_deltas(model, items)
+        if model is Post:
+            post_ids = [object_id for object_id, _, _ in items]
+            Post.objects.filter(id__in=post_ids).update(
+                hot_key=hot_key_expression())
+            bucket = datetime.fromtimestamp(
+                hour_start(time.time()), tz=dt_timezone.utc)
+            upsert_rollups([
+                (object_id, bucket, delta)
+                for object_id, delta, _ in items if delta
+            ])
+            mark_posts_dirty(post_ids)
+            get_redis_connection('default').sadd(changed_key(Post), *post_ids)
+
+    return len(rows), max((row[0] for row in rows), default=job.last_id)
+
+
+def delete_memberships(job):
+    column = 'community_id' if job.kind == DeletionJob.Kind.COMMUNITY else 'user_id'
+    memberships = quote(Membership)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {memberships} WHERE id IN ('
+            f'SELECT id FROM {memberships} '
+            f'WHERE {column} = %s AND id > %s ORDER BY id LIMIT %s) '
+            f'RETURNING id, user_id, community_id',
+            [job.target_id, job.last_id, DELETION_BATCH_SIZE]
+        )
+        rows = cursor.fetchall()
+
+    if job.kind == DeletionJob.Kind.USER:
+        left = Counter(community_id for _, _, community_id in rows)
+        for community_id in sorted(left):
+            Community.all_objects.filter(pk=community_id).update(
+                members_count=F('members_count') - left[community_id])
+    else:
+        user_ids = [user_id for _, user_id, _ in rows]
+        slugs = get_user_model().objects.filter(
+            id__in=user_ids).values_list('slug', flat=True)
+        cache.delete_many(
+            [f'user_communities_first_page:{slug}' for slug in slugs]
+            + [f'auth_recs_first_page:{user_id}' for user_id in user_ids]
+        )
+        for user_id in user_ids:
+            invalidate_home_feed(user_id)
+
+    return len(rows), max((row[0] for row in rows), default=job.last_id)
+
+
+def delete_target(job):
+    """Deletes the emptied community or user, the cascade has little left."""
+    if job.kind == DeletionJob.Kind.COMMUNITY:
+        Community.all_objects.filter(pk=job.target_id).delete()
+        get_redis_connection('default').delete(feed_key(job.target_id))
+    else:
+        get_user_model().objects.filter(pk=job.target_id).delete()
+    return 0, job.last_id
+
+
+STAGE_HANDLERS = {
+    'hide_posts': hide_posts,
+    'posts': purge_posts,
+    'comments': delete_comments,
+    'ratings': delete_ratings,
+    'memberships': delete_memberships,
+    'community': delete_target,
+    'user': delete_target,
+}
+
+
+# stages that commit their own batches instead of joining the job transaction
+SELF_COMMITTING_STAGES = {'posts'}
+
+
+@contextmanager
+def deletion_lock(job_id):
+    """Yields True if this worker holds the job, the lock is session wide."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_try_advisory_lock(%s, %s)',
+            [DELETION_LOCK_NAMESPACE, job_id]
+        )
+        acquired = cursor.fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT pg_advisory_unlock(%s, %s)',
+                    [DELETION_LOCK_NAMESPACE, job_id]
+                )
+
+
+def advance_job(job, count, last_id):
+    job.last_id = last_id
+    if count:
+        job.progress[job.stage] = job.progress.get(job.stage, 0) + count
+    else:
+        stages = STAGES[job.kind]
+        position = stages.index(job.stage) + 1
+        if position < len(stages):
+            job.stage, job.last_id = stages[position], 0
+        else:
+            job.finished = timezone.now()
+            logger.info(f'Deletion job {job.pk} finished: {job.progress}')
+    job.save()
+
+
+def run_deletion_chunk(job_id):
+    """
+    Deletes one chunk of a job and moves its cursor, in the same transaction
+    unless the stage commits its own batches.
+    Returns the job, or None if it is finished or run by another worker.
+    """
+    with deletion_lock(job_id) as acquired:
+        if not acquired:
+            return None
+
+        job = DeletionJob.objects.filter(pk=job_id, finished__isnull=True).first()
+        if job is None:
+            return None
+
+        if job.stage in SELF_COMMITTING_STAGES:
+            result = STAGE_HANDLERS[job.stage](job)
+            with transaction.atomic():
+                advance_job(job, *result)
+        else:
+            with transaction.atomic():
+                advance_job(job, *STAGE_HANDLERS[job.stage](job))
+    return job
@@ -0,0 +1,127 @@
+"""
+WebP renditions of uploaded images.
+
+The stored file is streamed from storage straight into libvips and
+decoded once, with shrink-on-load down to ORIGINAL_MAX_WIDTH. Every width
+of the ladder is resized from that decode, encoded to WebP and saved next
+to the file; the full size one replaces the file itself. The renditions
+are listed on Media.renditions, smallest first. The same decode gives the
+dimensions, the mean colour and a tiny inline placeholder, so cards can
+be laid out and painted before any image is loaded.
+"""
+import base64
+import os
+from contextlib import closing
+
+import pyvips
+from django.core.files.base import ContentFile
+
+
+RENDITION_WIDTHS = (320, 640, 1080)
+# the "original" rendition, larger images are shrunk on load
+ORIGINAL_MAX_WIDTH = 2560
+RENDITION_QUALITY = 75
+STREAM_CHUNK_SIZE = 1024 * 300
+# no height limit for the shrink-on-load
+UNBOUNDED = 10000000
+PLACEHOLDER_WIDTH = 16
+PLACEHOLDER_QUALITY = 30
+
+
+def rendition_urls(media):
+    """The renditions as a srcset: [{'url', 'width'}, ...], smallest first."""
+    storage = media.file.storage
+    return [
+        {'url': storage.url(item['name']), 'width': item['width']}
+        for item in media.renditions
+    ]
+
+
+def open_stream(file):
+    """A file object that reads the stored file as it is downloaded."""
+    storage = file.storage
+    if hasattr(storage, 'bucket'):
+        # S3File would download the whole object first
+        key = storage._normalize_name(file.name)
+        return storage.bucket.Object(key).get()['Body']
+    return storage.open(file.name, 'rb')
+
+
+def stream_source(stream):
+    source = pyvips.SourceCustom()
+    source.on_read(lambda size: stream.read(min(size, STREAM_CHUNK_SIZE)))
+    return source
+
+
+def decode_image(file):
+    """Decodes the file into memory, at most ORIGINAL_MAX_WIDTH wide."""
+    with closing(open_stream(file)) as stream:
+        # the source has to outlive the decode
+        source = stream_source(stream)
+        image = pyvips.Image.thumbnail_source(
+            source,
+            ORIGINAL_MAX_WIDTH,
+            height=UNBOUNDED,
+            size='down'
+        )
+        return image.copy_memory()
+
+
+def rendition_name(file_name, width=None):
+    base = os.path.splitext(file_name)[0]
+    return f'{base}_{width}w.webp' if width else f'{base}.webp'
+
+
+def encode(image):
+    return image.write_to_buffer('.webp', Q=RENDITION_QUALITY, strip=True)
+
+
+def describe_image(image):
+    """Width, height, mean colour and a data URI placeholder of an image."""
+    flat = image.colourspace('srgb')
+    if flat.hasalpha():
+        flat = flat.flatten(background=[255, 255, 255])
+    tiny = flat.resize(min(PLACEHOLDER_WIDTH / flat.width, 1)).cast('uchar')
+
+    red, green, blue = (round(tiny.extract_band(band).avg()) for band in range(3))
+    placeholder = tiny.write_to_buffer(
+        '.webp', Q=PLACEHOLDER_QUALITY, strip=True)
+    return {
+        'width': image.width,
+        'height': image.height,
+        'dominant_color': f'#{red:02x}{green:02x}{blue:02x}',
+        'placeholder': (
+            'data:image/webp;base64,' + base64.b64encode(placeholder).decode()),
+    }
+
+
+def render_renditions(media, image):
+    """
+    Saves the ladder of a decoded image, replaces the file with the full
+    size WebP. Returns the renditions, smallest first, and the names of
+    files that are no longer used once the media is saved.
+    """
+    file = media.file
+    storage = file.storage
+    old_names = {item['name'] for item in media.renditions}
+
+    renditions = []
+    for width in RENDITION_WIDTHS:
+        if width >= image.width:
+            break
+        resized = image.resize(width / image.width)
+        name = storage.save(
+            rendition_name(file.name, width), ContentFile(encode(resized)))
+        renditions.append(
+            {'name': name, 'width': resized.width, 'height': resized.height})
+
+    old_file = file.name
+    was_shrunk = image.width >= ORIGINAL_MAX_WIDTH
+    if was_shrunk or not old_file.lower().endswith('.webp'):
+        file.name = storage.save(
+            rendition_name(old_file), ContentFile(encode(image)))
+    renditions.append(
+        {'name': file.name, 'width': image.width, 'height': image.height})
+
+    stale = (old_names | {old_file}) - {item['name'] for item in renditions}
+    return renditions, stale
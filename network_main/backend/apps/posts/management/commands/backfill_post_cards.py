@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from apps.posts.cards import CARD_BATCH_SIZE, refresh_post_cards
+from apps.posts.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Writes the PostCard rows of all posts in id order'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=CARD_BATCH_SIZE)
+        parser.add_argument('--start-id', type=int, default=0,
+                            help='Resume after this post id')
+
+    def handle(self, *args, **options):
+        last_id = options['start_id']
+        total = 0
+        while True:
+            post_ids = list(
+                Post.objects
+                .filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not post_ids:
+                break
+
+            total += refresh_post_cards(post_ids)
+            last_id = post_ids[-1]
+            self.stdout.write(f'{total} cards written, last post id {last_id}')
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {total} post cards'))
@@ -0,0 +1,94 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median, quantiles
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from apps.posts.models import Post, Comment, path_segment
+from apps.posts.signals import change_post_comment_count
+
+
+class Command(BaseCommand):
+    help = 'Measures concurrent comment inserts into a large thread of a post'
+
+    def add_arguments(self, parser):
+        parser.add_argument('post', help='Slug of the post to comment on')
+        parser.add_argument('--thread-size', type=int, default=50000)
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--inserts', type=int, default=200,
+                            help='Inserts per worker')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        post = Post.objects.filter(slug=options['post']).first()
+        if post is None:
+            raise CommandError('Post does not exist.')
+
+        rng = random.Random(options['seed'])
+        existing = Comment.objects.filter(post=post).count()
+        missing = options['thread_size'] - existing
+        if missing > 0:
+            self.stdout.write(f'Seeding {missing} comments...')
+            self.seed_thread(post, missing, rng)
+
+        parent_ids = list(
+            Comment.objects.filter(post=post).values_list('id', flat=True))
+
+        def worker(index):
+            worker_rng = random.Random(options['seed'] + index + 1)
+            timings = []
+            try:
+                for _ in range(options['inserts']):
+                    parent = Comment.objects.only('id', 'path').get(
+                        pk=worker_rng.choice(parent_ids))
+                    start = time.perf_counter()
+                    Comment.objects.create(
+                        post=post,
+                        author_id=post.author_id,
+                        content='benchmark reply',
+                        parent=parent
+                    )
+                    timings.append((time.perf_counter() - start) * 1000)
+            finally:
+                connection.close()
+            return timings
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            timings = sum(executor.map(worker, range(options['workers'])), [])
+        elapsed = time.perf_counter() - start
+
+        p95 = quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+        self.stdout.write(
+            f'{len(timings)} inserts by {options["workers"]} workers '
+            f'into {len(parent_ids)} comments: '
+            f'{len(timings) / elapsed:.1f}/s, median {median(timings):.2f} ms, '
+            f'p95 {p95:.2f} ms, max {max(timings):.2f} ms'
+        )
+
+    def seed_thread(self, post, count, rng, batch_size=5000):
+        """Inserts a random tree with paths built in Python."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+                "FROM generate_series(1, %s)",
+                [Comment._meta.db_table, count]
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+
+        comments = []
+        for i, comment_id in enumerate(ids):
+            parent = comments[rng.randrange(i)] if i and rng.random() < 0.8 else None
+            comments.append(Comment(
+                id=comment_id,
+                post=post,
+                author_id=post.author_id,
+                content='benchmark comment',
+                parent=parent,
+                path=(parent.path if parent else '') + path_segment(comment_id)
+            ))
+
+        Comment.objects.bulk_create(comments, batch_size=batch_size)
+        change_post_comment_count(post.id, len(comments))
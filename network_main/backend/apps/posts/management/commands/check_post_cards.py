@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+
+from apps.posts.cards import CARD_BATCH_SIZE, build_post_cards, refresh_post_cards
+from apps.posts.models import Post, PostCard
+
+
+class Command(BaseCommand):
+    help = 'Compares PostCard rows with their posts and reports the differences'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=CARD_BATCH_SIZE)
+        parser.add_argument('--fix', action='store_true',
+                            help='Rewrite missing and stale cards, drop orphaned ones')
+
+    def handle(self, *args, **options):
+        fields = [field.attname for field in PostCard._meta.fields]
+        missing, stale = [], []
+
+        last_id = 0
+        while True:
+            post_ids = list(
+                Post.objects
+                .filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not post_ids:
+                break
+            last_id = post_ids[-1]
+
+            stored = PostCard.objects.in_bulk(post_ids)
+            for card in build_post_cards(post_ids):
+                current = stored.get(card.id)
+                if current is None:
+                    missing.append(card.id)
+                    continue
+                changed = [
+                    name for name in fields
+                    if getattr(current, name) != getattr(card, name)
+                ]
+                if changed:
+                    stale.append(card.id)
+                    self.stdout.write(
+                        f'Post {card.id}: stale {", ".join(changed)}')
+
+        orphaned = list(
+            PostCard.objects
+            .exclude(id__in=Post.objects.values('id'))
+            .values_list('id', flat=True)
+        )
+
+        self.stdout.write(
+            f'{len(missing)} missing, {len(stale)} stale, '
+            f'{len(orphaned)} orphaned cards'
+        )
+
+        if options['fix'] and (missing or stale or orphaned):
+            ids = missing + stale + orphaned
+            for start in range(0, len(ids), options['batch_size']):
+                refresh_post_cards(ids[start:start + options['batch_size']])
+            self.stdout.write(self.style.SUCCESS(f'Fixed {len(ids)} cards'))
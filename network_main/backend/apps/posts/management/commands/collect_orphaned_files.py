@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.posts.orphans import collect_orphaned_files, ORPHAN_LOOKBACK_DAYS
+
+
+class Command(BaseCommand):
+    help = 'Queues unreferenced uploads of past days for deletion, day by day'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=ORPHAN_LOOKBACK_DAYS,
+                            help='How many days back to scan')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the orphaned files')
+
+    def handle(self, *args, **options):
+        today = timezone.now().date()
+        total = 0
+        for days in range(1, options['days'] + 1):
+            day = today - timedelta(days=days)
+            orphans = collect_orphaned_files(day, dry_run=options['dry_run'])
+            total += orphans
+            self.stdout.write(f'{day}: {orphans} orphaned files')
+
+        action = 'Found' if options['dry_run'] else 'Queued'
+        self.stdout.write(self.style.SUCCESS(f'{action} {total} orphaned files'))
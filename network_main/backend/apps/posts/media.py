@@ -0,0 +1,71 @@
+"""
+Saving the media files of a post.
+
+The files of a request are written to the storage concurrently, so the
+request waits for the slowest upload instead of their sum. The Media
+rows are then created with one bulk insert and processed by one task
+dispatch. If any write or the insert fails, the files already stored
+are deleted again.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from apps.services.utils import delete_s3_file
+
+from .cards import refresh_card_media
+from .models import Media
+from .tasks import start_compression_for_post_media
+
+
+MEDIA_UPLOAD_WORKERS = 5
+
+
+def store_file(file):
+    field = Media._meta.get_field('file')
+    name = field.generate_filename(None, file.name)
+    return field.storage.save(name, file, max_length=field.max_length)
+
+
+def discard_files(names):
+    storage = Media._meta.get_field('file').storage
+    for name in names:
+        delete_s3_file(storage, name)
+
+
+def store_media_files(files):
+    """
+    Writes the files on a bounded thread pool, returns their storage names.
+    If a write fails, the stored ones are deleted and the error is raised.
+    """
+    if not files:
+        return []
+
+    workers = min(MEDIA_UPLOAD_WORKERS, len(files))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(store_file, file) for file in files]
+
+    names, errors = [], []
+    for future in futures:
+        try:
+            names.append(future.result())
+        except Exception as e:
+            errors.append(e)
+
+    if errors:
+        discard_files(names)
+        raise errors[0]
+    return names
+
+
+def attach_media(post, names):
+    """
+    Creates the Media rows of stored files at once and queues their
+    processing. bulk_create sends no signals, so the card is refreshed here.
+    """
+    if not names:
+        return []
+
+    media = Media.objects.bulk_create(
+        [Media(post=post, file=name) for name in names])
+    refresh_card_media(post.pk)
+    start_compression_for_post_media(post.pk, media_ids=[item.id for item in media])
+    return media
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.14 on 2026-10-17 19:38
+
+from django.db import migrations, models
+
+
+# Same formula as apps.recommendations.scoring.compute_hot_key
+BACKFILL_HOT_KEY = '''
+    UPDATE api_network_post
+    SET hot_key =
+        SIGN(sum_rating + 0.25 * comment_count)
+        * LOG(10, GREATEST(ABS(sum_rating + 0.25 * comment_count), 1))
+        + (EXTRACT(EPOCH FROM created) - 1704067200) / 45000.0
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='hot_key',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.RunSQL(BACKFILL_HOT_KEY, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['status', '-hot_key'], name='api_network_status_fbf63f_idx'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.14 on 2026-10-17 20:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Same encoding as apps.posts.models.path_segment
+BACKFILL_PATH = '''
+    WITH RECURSIVE tree(id, path) AS (
+        SELECT id, LPAD(TO_HEX(id), 12, '0')
+        FROM api_network_comment
+        WHERE parent_id IS NULL
+        UNION ALL
+        SELECT c.id, tree.path || LPAD(TO_HEX(c.id), 12, '0')
+        FROM api_network_comment c
+        JOIN tree ON c.parent_id = tree.id
+    )
+    UPDATE api_network_comment c
+    SET path = tree.path
+    FROM tree
+    WHERE c.id = tree.id
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0003_post_hot_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.TextField(db_collation='C', default='', editable=False),
+        ),
+        migrations.RunSQL(BACKFILL_PATH, migrations.RunSQL.noop),
+        migrations.RemoveField(
+            model_name='comment',
+            name='level',
+        ),
+        migrations.RemoveField(
+            model_name='comment',
+            name='lft',
+        ),
+        migrations.RemoveField(
+            model_name='comment',
+            name='rght',
+        ),
+        migrations.RemoveField(
+            model_name='comment',
+            name='tree_id',
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='posts.comment'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['path'], name='api_network_path_b49439_idx'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.14 on 2026-10-17 20:14
+
+import django.db.models.expressions
+import django.db.models.functions.comparison
+import django.db.models.functions.math
+from django.db import migrations, models
+
+
+BACKFILL_VOTE_COUNT = '''
+    UPDATE api_network_comment c
+    SET vote_count = v.count
+    FROM (
+        SELECT r.object_id, COUNT(*) AS count
+        FROM api_network_rating r
+        JOIN django_content_type ct ON ct.id = r.content_type_id
+        WHERE ct.app_label = 'posts' AND ct.model = 'comment'
+        GROUP BY r.object_id
+    ) v
+    WHERE c.id = v.object_id
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0004_comment_path'),
+        ('ratings', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='vote_count',
+            field=models.IntegerField(default=0, verbose_name='Vote count'),
+        ),
+        migrations.RunSQL(BACKFILL_VOTE_COUNT, migrations.RunSQL.noop),
+        migrations.AddField(
+            model_name='comment',
+            name='controversy',
+            field=models.GeneratedField(db_persist=True, expression=models.Case(models.When(then=django.db.models.functions.math.Power(django.db.models.functions.comparison.Cast('vote_count', models.FloatField()), django.db.models.expressions.CombinedExpression(django.db.models.functions.comparison.Cast(django.db.models.expressions.CombinedExpression(models.F('vote_count'), '-', django.db.models.functions.math.Abs('sum_rating')), models.FloatField()), '/', django.db.models.functions.comparison.Cast(django.db.models.expressions.CombinedExpression(models.F('vote_count'), '+', django.db.models.functions.math.Abs('sum_rating')), models.FloatField()))), vote_count__gt=django.db.models.functions.math.Abs('sum_rating')), default=models.Value(0.0), output_field=models.FloatField()), output_field=models.FloatField()),
+        ),
+        migrations.RemoveIndex(
+            model_name='comment',
+            name='api_network_post_id_cd5814_idx',
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'parent', '-time_created', '-id'], name='api_network_post_id_20381b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'parent', '-sum_rating', '-id'], name='api_network_post_id_91656d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'parent', '-controversy', '-id'], name='api_network_post_id_d3a548_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.14 on 2026-10-17 20:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0005_comment_sort_modes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='post',
+            name='status',
+            field=models.CharField(choices=[('DF', 'Draft'), ('PB', 'Published'), ('DL', 'Deleted')], default='PB', max_length=10, verbose_name='Post status'),
+        ),
+    ]
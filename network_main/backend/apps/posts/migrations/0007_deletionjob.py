@@ -0,0 +1,34 @@
+# Generated by Django 5.2.14 on 2026-10-17 20:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0006_post_status_deleted'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('community', 'Community'), ('user', 'User')], max_length=10)),
+                ('target_id', models.BigIntegerField()),
+                ('stage', models.CharField(max_length=20)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('progress', models.JSONField(default=dict, verbose_name='Deleted rows per stage')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Deletion job',
+                'verbose_name_plural': 'Deletion jobs',
+                'db_table': 'api_network_deletion_job',
+                'ordering': ['-created'],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('finished__isnull', True)), fields=('kind', 'target_id'), name='unique_unfinished_deletion_job')],
+            },
+        ),
+    ]
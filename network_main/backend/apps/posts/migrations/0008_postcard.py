@@ -0,0 +1,91 @@
+# Generated by Django 5.2.14 on 2026-10-17 20:39
+
+from django.db import migrations, models
+
+
+# Keeps the columns a card copies from its post equal to the post.
+# Counters and status are changed with queryset and raw SQL updates
+# that send no signals.
+CREATE_SYNC_TRIGGER = '''
+    CREATE FUNCTION api_network_post_card_sync() RETURNS trigger AS $$
+    BEGIN
+        UPDATE api_network_post_card
+        SET status = NEW.status,
+            title = NEW.title,
+            slug = NEW.slug,
+            description = NEW.description,
+            created = NEW.created,
+            updated = NEW.updated,
+            sum_rating = NEW.sum_rating,
+            comment_count = NEW.comment_count,
+            score = NEW.score,
+            hot_key = NEW.hot_key
+        WHERE id = NEW.id;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER api_network_post_card_sync
+    AFTER UPDATE ON api_network_post
+    FOR EACH ROW
+    WHEN (
+        OLD.status IS DISTINCT FROM NEW.status
+        OR OLD.title IS DISTINCT FROM NEW.title
+        OR OLD.slug IS DISTINCT FROM NEW.slug
+        OR OLD.description IS DISTINCT FROM NEW.description
+        OR OLD.created IS DISTINCT FROM NEW.created
+        OR OLD.updated IS DISTINCT FROM NEW.updated
+        OR OLD.sum_rating IS DISTINCT FROM NEW.sum_rating
+        OR OLD.comment_count IS DISTINCT FROM NEW.comment_count
+        OR OLD.score IS DISTINCT FROM NEW.score
+        OR OLD.hot_key IS DISTINCT FROM NEW.hot_key
+    )
+    EXECUTE FUNCTION api_network_post_card_sync();
+'''
+
+DROP_SYNC_TRIGGER = '''
+    DROP TRIGGER api_network_post_card_sync ON api_network_post;
+    DROP FUNCTION api_network_post_card_sync();
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0007_deletionjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostCard',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('status', models.CharField(max_length=10)),
+                ('title', models.CharField(max_length=300)),
+                ('slug', models.SlugField(db_index=False, max_length=310)),
+                ('description', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField()),
+                ('updated', models.DateTimeField()),
+                ('author_id', models.BigIntegerField()),
+                ('author_name', models.CharField(max_length=150)),
+                ('author_slug', models.SlugField(db_index=False, max_length=255)),
+                ('author_icon', models.TextField(blank=True, default='')),
+                ('community_id', models.BigIntegerField()),
+                ('community_slug', models.SlugField(db_index=False, max_length=100)),
+                ('community_name', models.CharField(max_length=100)),
+                ('community_icon', models.TextField(blank=True, default='')),
+                ('media', models.JSONField(default=list)),
+                ('sum_rating', models.IntegerField(default=0)),
+                ('comment_count', models.IntegerField(default=0)),
+                ('score', models.FloatField(default=0.0)),
+                ('hot_key', models.FloatField(default=0.0)),
+            ],
+            options={
+                'verbose_name': 'Post card',
+                'verbose_name_plural': 'Post cards',
+                'db_table': 'api_network_post_card',
+                'indexes': [models.Index(fields=['status', '-created', '-id'], name='api_network_status_69c84d_idx'), models.Index(fields=['community_id', 'status', '-created', '-id'], name='api_network_communi_c09156_idx'), models.Index(fields=['author_slug', 'status', '-created', '-id'], name='api_network_author__d8bfdf_idx')],
+            },
+        ),
+        migrations.RunSQL(CREATE_SYNC_TRIGGER, DROP_SYNC_TRIGGER),
+    ]
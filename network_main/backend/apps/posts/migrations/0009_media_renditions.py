@@ -0,0 +1,18 @@
+# Generated by Django 5.2.14 on 2026-10-17 21:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0008_postcard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='renditions',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
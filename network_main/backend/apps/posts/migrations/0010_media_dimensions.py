@@ -0,0 +1,33 @@
+# Generated by Django 5.2.14 on 2026-10-17 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0009_media_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='dominant_color',
+            field=models.CharField(blank=True, default='', max_length=7),
+        ),
+        migrations.AddField(
+            model_name='media',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='media',
+            name='placeholder',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='media',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
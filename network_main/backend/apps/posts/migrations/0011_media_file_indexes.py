@@ -0,0 +1,22 @@
+# Generated by Django 5.2.14 on 2026-10-17 21:20
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0010_media_dimensions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='media',
+            index=models.Index(fields=['file'], name='media_file_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='media',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['renditions'], name='media_renditions_idx', opclasses=['jsonb_path_ops']),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.14 on 2026-10-17 22:08
+
+from django.db import migrations, models
+
+
+BACKFILL_BATCH_SIZE = 5000
+
+# Same range as CommentQuerySet.descendants_of
+BACKFILL_DESCENDANTS_COUNT = '''
+    UPDATE api_network_comment c
+    SET descendants_count = (
+        SELECT COUNT(*) FROM api_network_comment d
+        WHERE d.path > c.path AND d.path < c.path || '~'
+    )
+    WHERE c.id IN (
+        SELECT id FROM api_network_comment
+        WHERE id > %s ORDER BY id LIMIT %s
+    )
+    RETURNING c.id
+'''
+
+
+def backfill_descendants_count(apps, schema_editor):
+    """Counts the replies of existing comments, one committed batch at a time."""
+    last_id = 0
+    while True:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(BACKFILL_DESCENDANTS_COUNT, [last_id, BACKFILL_BATCH_SIZE])
+            ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return
+        last_id = max(ids)
+
+
+class Migration(migrations.Migration):
+
+    # every backfill batch is its own transaction
+    atomic = False
+
+    dependencies = [
+        ('posts', '0011_media_file_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='descendants_count',
+            field=models.IntegerField(default=0, verbose_name='Replies count'),
+        ),
+        migrations.RunPython(
+            backfill_descendants_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,121 @@
+import os
+
+from django.db import migrations
+from rest_framework import serializers
+
+
+CARD_BATCH_SIZE = 1000
+
+# a copy of Media.MEDIA_EXTENSIONS as of this migration
+MEDIA_EXTENSIONS = {
+    'image': ['jpg', 'jpeg', 'png', 'gif', 'webp'],
+    'video': ['mp4', 'webm'],
+}
+
+datetime_field = serializers.DateTimeField()
+
+
+# The card helpers below are frozen copies of apps.posts.cards, so later
+# changes to the app code don't change what this migration writes.
+
+def file_url(file):
+    return file.url if file else ''
+
+
+def media_type(file):
+    ext = os.path.splitext(file.name)[1].lower().lstrip('.')
+    for kind, extensions in MEDIA_EXTENSIONS.items():
+        if ext in extensions:
+            return kind
+    return 'unknown'
+
+
+def media_summary(media):
+    return [
+        {
+            'id': item.id,
+            'url': file_url(item.file),
+            'media_type': media_type(item.file),
+            'aspect_ratio': item.aspect_ratio,
+            'width': item.width,
+            'height': item.height,
+            'dominant_color': item.dominant_color,
+            'placeholder': item.placeholder,
+            'srcset': [
+                {'url': item.file.storage.url(rendition['name']),
+                 'width': rendition['width']}
+                for rendition in item.renditions
+            ] if item.file else [],
+            'uploaded_at': datetime_field.to_representation(item.uploaded_at),
+        }
+        for item in media
+    ]
+
+
+def build_post_card(PostCard, post):
+    return PostCard(
+        id=post.id,
+        status=post.status,
+        title=post.title,
+        slug=post.slug,
+        description=post.description,
+        created=post.created,
+        updated=post.updated,
+        author_id=post.author.pk,
+        author_name=post.author.username,
+        author_slug=post.author.slug,
+        author_icon=file_url(post.author.avatar),
+        community_id=post.community.pk,
+        community_slug=post.community.slug,
+        community_name=post.community.name,
+        community_icon=file_url(post.community.icon),
+        media=media_summary(post.media_data.all()),
+        sum_rating=post.sum_rating,
+        comment_count=post.comment_count,
+        score=post.score,
+        hot_key=post.hot_key,
+    )
+
+
+def backfill_post_cards(apps, schema_editor):
+    """
+    Writes the cards of posts created before 0008, one committed batch at
+    a time. Until then list endpoints would miss those posts.
+    """
+    Post = apps.get_model('posts', 'Post')
+    PostCard = apps.get_model('posts', 'PostCard')
+    update_fields = [
+        field.name for field in PostCard._meta.fields if not field.primary_key
+    ]
+    last_id = 0
+    while True:
+        posts = list(
+            Post.objects
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .select_related('author', 'community')
+            .prefetch_related('media_data')[:CARD_BATCH_SIZE]
+        )
+        if not posts:
+            return
+        PostCard.objects.bulk_create(
+            [build_post_card(PostCard, post) for post in posts],
+            update_conflicts=True,
+            unique_fields=['id'],
+            update_fields=update_fields,
+        )
+        last_id = posts[-1].id
+
+
+class Migration(migrations.Migration):
+
+    # every batch is its own transaction
+    atomic = False
+
+    dependencies = [
+        ('posts', '0012_comment_descendants_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_post_cards, migrations.RunPython.noop),
+    ]
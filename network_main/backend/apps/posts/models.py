@@ -1,16 +1,15 @@
-from django.db import models
+from django.db import models, connection
 from django.core.validators import MinLengthValidator, FileExtensionValidator
 from django.contrib.contenttypes.fields import GenericRelation
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.indexes import GinIndex
 from django.db.models import (
-    Q, Sum, Value, IntegerField,
-    Subquery, OuterRef
+    Q, Sum, Value, IntegerField, FloatField,
+    Subquery, OuterRef, F, Case, When
 )
-from django.db.models.functions import Coalesce
-
-from mptt.models import MPTTModel
-from mptt.fields import TreeForeignKey
+from django.db.models.functions import Abs, Cast, Coalesce, Power
+from django.utils import timezone
 
 from PIL import Image, ImageFile, UnidentifiedImageError
 from PIL.Image import DecompressionBombError
@@ -20,6 +19,7 @@ from functools import partial
 
 from apps.communities.models import Community
 from apps.ratings.models import Rating
+from apps.recommendations.scoring import compute_hot_key
 from apps.services.utils import unique_slugify, validate_file_size
 
 
@@ -34,7 +34,81 @@ class PublishedManager(models.Manager):
         return super().get_queryset().select_related('author').filter(status='PB').order_by('-created')
 
 
+class VisiblePostManager(models.Manager):
+    """Posts that are not deleted, drafts included."""
+
+    def get_queryset(self):
+        return super().get_queryset().exclude(status='DL')
+
+
+PATH_SEGMENT_WIDTH = 12
+PATH_END = '~'
+
+
+def path_segment(comment_id):
+    """Fixed width hex of the id, so paths sort and compare as strings."""
+    return f'{comment_id:0{PATH_SEGMENT_WIDTH}x}'
+
+
+def ancestor_ids(path):
+    """Ids of the comments above the one with this path, root first."""
+    return [
+        int(path[start:start + PATH_SEGMENT_WIDTH], 16)
+        for start in range(0, len(path) - PATH_SEGMENT_WIDTH, PATH_SEGMENT_WIDTH)
+    ]
+
+
+def saved_fields(instance, counters):
+    """
+    The fields an update of a loaded row writes. Counters are changed
+    with deltas elsewhere, a stale instance must not write them back.
+    """
+    return [
+        field.name for field in instance._meta.concrete_fields
+        if not field.primary_key and not field.generated
+        and field.name not in counters
+    ]
+
+
+def writes_all_fields(instance, args, kwargs):
+    """Whether a save would update every field of an existing row."""
+    return (
+        not instance._state.adding and not args
+        and kwargs.get('update_fields') is None
+        and not kwargs.get('force_insert')
+    )
+
+
+def controversy_expression():
+    """
+    votes ** balance, where balance is the ratio of the minority votes
+    to the majority votes: many votes split evenly rank highest.
+    """
+    majority = F('vote_count') + Abs('sum_rating')
+    minority = F('vote_count') - Abs('sum_rating')
+    return Case(
+        When(
+            vote_count__gt=Abs('sum_rating'),
+            then=Power(
+                Cast('vote_count', FloatField()),
+                Cast(minority, FloatField()) / Cast(majority, FloatField())
+            )
+        ),
+        default=Value(0.0),
+        output_field=FloatField()
+    )
+
+
 class CommentQuerySet(models.QuerySet):
+    def descendants_of(self, path):
+        return self.filter(path__gt=path, path__lt=path + PATH_END)
+
+    def delete(self):
+        from .signals import aggregate_comment_deletes
+
+        with aggregate_comment_deletes():
+            return super().delete()
+
     def with_ratings(self, user):
         comment_content_type = ContentType.objects.get_for_model(Comment)
         qs = self
@@ -68,6 +142,7 @@ class Post(models.Model):
     STATUS_OPTIONS = (
         ("DF", "Draft"),
         ("PB", "Published"),
+        ("DL", "Deleted"),
     )
 
     title = models.CharField(
@@ -118,9 +193,13 @@ class Post(models.Model):
     )
 
     score = models.FloatField(default=0.0)
+    hot_key = models.FloatField(default=0.0)
+
+    COUNTER_FIELDS = ('sum_rating', 'comment_count', 'score', 'hot_key')
 
     objects = models.Manager()
     published = PublishedManager()
+    visible = VisiblePostManager()
 
     class Meta:
         db_table = 'api_network_post'
@@ -128,10 +207,31 @@ class Post(models.Model):
         indexes = [
             models.Index(fields=['status', '-created']),
             models.Index(fields=['status', '-score']),
+            models.Index(fields=['status', '-hot_key']),
         ]
         verbose_name = 'Post'
         verbose_name_plural = 'Posts'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.set_loaded_status()
+        return instance
+
+    def set_loaded_status(self):
+        """Remembers the status stored in the db to notice publishing"""
+        self._loaded_status = self.__dict__.get('status')
+
+    def get_loaded_status(self):
+        return getattr(self, '_loaded_status', None)
+
+    def delete(self, *args, **kwargs):
+        # the comments go with the post, count them once
+        from .signals import aggregate_comment_deletes
+
+        with aggregate_comment_deletes():
+            return super().delete(*args, **kwargs)
+
     def save(self, *args, **kwargs):
         # if this is an update to an existing post
         if self.pk:
@@ -146,14 +246,28 @@ class Post(models.Model):
         # if this is post create(or slug is empty)
         if not self.slug:
             self.slug = unique_slugify(self, self.title)
+
+        if self._state.adding:
+            self.hot_key = compute_hot_key(
+                self.sum_rating,
+                self.comment_count,
+                self.created or timezone.now()
+            )
+        elif writes_all_fields(self, args, kwargs):
+            kwargs['update_fields'] = saved_fields(self, self.COUNTER_FIELDS)
         super().save(*args, **kwargs)
 
     def __str__(self):
         return self.title
 
 
-class Comment(MPTTModel):
-    """Tree Comment model"""
+class Comment(models.Model):
+    """
+    Tree Comment model.
+
+    `path` is the chain of fixed width ids from the root to the comment,
+    so a subtree is a range of paths and an insert writes a single row.
+    """
 
     post = models.ForeignKey(
         to=Post,
@@ -169,27 +283,76 @@ class Comment(MPTTModel):
     time_created = models.DateTimeField(auto_now_add=True)
     time_updated = models.DateTimeField(auto_now=True)
     sum_rating = models.IntegerField(default=0, verbose_name='Rating sum')
-    parent = TreeForeignKey(
+    vote_count = models.IntegerField(default=0, verbose_name='Vote count')
+    # all replies below the comment, buffered deltas are added on read
+    # (see replies.py)
+    descendants_count = models.IntegerField(
+        default=0, verbose_name='Replies count')
+    controversy = models.GeneratedField(
+        expression=controversy_expression(),
+        output_field=FloatField(),
+        db_persist=True
+    )
+    parent = models.ForeignKey(
         'self',
         on_delete=models.CASCADE,
         null=True,
         blank=True,
         related_name='children'
     )
+    path = models.TextField(db_collation='C', editable=False, default='')
     ratings = GenericRelation(to=Rating)
 
-    objects = CommentManager()
+    COUNTER_FIELDS = ('sum_rating', 'vote_count', 'descendants_count')
 
-    class MPTTMeta:
-        order_insertion_by = ('-time_created', )
+    objects = CommentManager()
 
     class Meta:
         db_table = 'api_network_comment'
-        indexes = [models.Index(fields=['post', '-time_created'])]
+        indexes = [
+            models.Index(fields=['post', 'parent', '-time_created', '-id']),
+            models.Index(fields=['post', 'parent', '-sum_rating', '-id']),
+            models.Index(fields=['post', 'parent', '-controversy', '-id']),
+            models.Index(fields=['path']),
+        ]
         ordering = ('-time_created', )
         verbose_name = 'Comment'
         verbose_name_plural = 'Comments'
 
+    def save(self, *args, **kwargs):
+        if not self.path:
+            if self.pk is None:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT nextval(pg_get_serial_sequence(%s, 'id'))",
+                        [self._meta.db_table]
+                    )
+                    self.pk = cursor.fetchone()[0]
+                if not args:
+                    kwargs['force_insert'] = True
+            parent_path = self.parent.path if self.parent_id else ''
+            self.path = parent_path + path_segment(self.pk)
+        elif writes_all_fields(self, args, kwargs):
+            kwargs['update_fields'] = saved_fields(self, self.COUNTER_FIELDS)
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        # the whole subtree goes with the comment, count it once
+        from .signals import aggregate_comment_deletes
+
+        with aggregate_comment_deletes():
+            return super().delete(*args, **kwargs)
+
+    @property
+    def depth(self):
+        return len(self.path) // PATH_SEGMENT_WIDTH - 1
+
+    def get_descendants(self):
+        return Comment.objects.all().descendants_of(self.path)
+
+    def get_descendant_count(self):
+        return self.descendants_count
+
     def get_children_count(self):
         return self.get_descendant_count()
 
@@ -223,13 +386,29 @@ class Media(models.Model):
 
     aspect_ratio = models.CharField(max_length=10, blank=True, default='16/9')
 
+    # [{'name', 'width', 'height'}, ...] of the WebP versions, smallest first
+    renditions = models.JSONField(default=list, blank=True)
+
+    # set from the decoded image by process_image_to_webp
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    dominant_color = models.CharField(max_length=7, blank=True, default='')
+    placeholder = models.TextField(blank=True, default='')
+
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         db_table = 'api_network_media'
         indexes = [
             models.Index(fields=['post']),
-            models.Index(fields=['post', '-uploaded_at'])
+            models.Index(fields=['post', '-uploaded_at']),
+            # lookups of stored names by the orphaned file collector
+            models.Index(fields=['file'], name='media_file_idx'),
+            GinIndex(
+                fields=['renditions'],
+                opclasses=['jsonb_path_ops'],
+                name='media_renditions_idx'
+            )
         ]
         ordering = ['-uploaded_at']
         verbose_name = 'Mediafile'
@@ -253,3 +432,95 @@ class Media(models.Model):
 
     def __str__(self):
         return f"{self.get_media_type()} - {self.file.name}"
+
+
+class PostCard(models.Model):
+    """
+    Read model of a post as list endpoints show it.
+
+    `id` is the id of the post. Author, community and media fields are
+    copied by the signals of their models, the post's own columns by a
+    trigger on the post table, so a page of cards is read from this table
+    alone.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    status = models.CharField(max_length=10)
+    title = models.CharField(max_length=300)
+    slug = models.SlugField(max_length=310, db_index=False)
+    description = models.TextField(blank=True, default='')
+    created = models.DateTimeField()
+    updated = models.DateTimeField()
+
+    author_id = models.BigIntegerField()
+    author_name = models.CharField(max_length=150)
+    author_slug = models.SlugField(max_length=255, db_index=False)
+    author_icon = models.TextField(blank=True, default='')
+
+    community_id = models.BigIntegerField()
+    community_slug = models.SlugField(max_length=100, db_index=False)
+    community_name = models.CharField(max_length=100)
+    community_icon = models.TextField(blank=True, default='')
+
+    # [{id, url, media_type, aspect_ratio, uploaded_at}, ...] newest first
+    media = models.JSONField(default=list)
+
+    sum_rating = models.IntegerField(default=0)
+    comment_count = models.IntegerField(default=0)
+    score = models.FloatField(default=0.0)
+    hot_key = models.FloatField(default=0.0)
+
+    class Meta:
+        db_table = 'api_network_post_card'
+        indexes = [
+            models.Index(fields=['status', '-created', '-id']),
+            models.Index(fields=['community_id', 'status', '-created', '-id']),
+            models.Index(fields=['author_slug', 'status', '-created', '-id']),
+        ]
+        verbose_name = 'Post card'
+        verbose_name_plural = 'Post cards'
+
+    def __str__(self):
+        return self.title
+
+
+class DeletionJob(models.Model):
+    """
+    Progress of a community or account removal.
+
+    The job walks through the stages of its kind, deleting rows in id order;
+    `last_id` is the cursor inside the current stage, so an interrupted job
+    resumes where it stopped.
+    """
+
+    class Kind(models.TextChoices):
+        COMMUNITY = 'community', 'Community'
+        USER = 'user', 'User'
+
+    kind = models.CharField(max_length=10, choices=Kind.choices)
+    target_id = models.BigIntegerField()
+    stage = models.CharField(max_length=20)
+    last_id = models.BigIntegerField(default=0)
+    progress = models.JSONField(
+        default=dict,
+        verbose_name='Deleted rows per stage'
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'api_network_deletion_job'
+        ordering = ['-created']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'target_id'],
+                condition=Q(finished__isnull=True),
+                name='unique_unfinished_deletion_job'
+            )
+        ]
+        verbose_name = 'Deletion job'
+        verbose_name_plural = 'Deletion jobs'
+
+    def __str__(self):
+        return f'{self.kind} {self.target_id}: {self.stage}'
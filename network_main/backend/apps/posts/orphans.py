@@ -0,0 +1,106 @@
+"""
+Collection of orphaned files in the bucket.
+
+Uploads live under date prefixes such as `uploads/media/%Y/%m/%d/`. For
+a day the collector lists each prefix page by page, looks up which of
+the page's names are still referenced by Media (file and renditions),
+Community (icon, banner) or CustomUser (avatar) and queues the rest for
+deletion. Only a page of keys is held at a time. Objects younger than
+ORPHAN_GRACE_PERIOD are kept, they may belong to an upload that is not
+finalized yet.
+"""
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.utils import timezone
+from storages.backends.s3 import S3Storage
+
+from apps.communities.models import Community
+from apps.services.storage import queue_file_deletion, DELETE_BATCH_SIZE
+from apps.users.models import CustomUser
+
+from .models import Media
+
+
+ORPHAN_GRACE_PERIOD = timedelta(days=1)
+ORPHAN_LOOKBACK_DAYS = 7
+
+FILE_FIELDS = (
+    (Media, 'file'),
+    (Community, 'icon'),
+    (Community, 'banner'),
+    (CustomUser, 'avatar'),
+)
+
+
+def day_prefixes(day):
+    """{prefix: (model, field)} of the uploads of a day."""
+    return {
+        day.strftime(model._meta.get_field(field).upload_to).rstrip('/') + '/': (model, field)
+        for model, field in FILE_FIELDS
+    }
+
+
+def iter_object_pages(storage, prefix):
+    """Yields pages of (name, last_modified) under a prefix."""
+    root = storage._normalize_name(prefix)
+    paginator = storage.connection.meta.client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(
+        Bucket=storage.bucket_name,
+        Prefix=root,
+        PaginationConfig={'PageSize': DELETE_BATCH_SIZE}
+    )
+    for page in pages:
+        yield [
+            (prefix + item['Key'][len(root):], item['LastModified'])
+            for item in page.get('Contents', [])
+        ]
+
+
+def referenced_media_names(names):
+    """The names used as a Media file or one of its renditions."""
+    media = connection.ops.quote_name(Media._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT n.name FROM unnest(%s::text[]) AS n(name) "
+            f"WHERE EXISTS (SELECT 1 FROM {media} m WHERE m.file = n.name "
+            f"OR m.renditions @> jsonb_build_array(jsonb_build_object('name', n.name)))",
+            [names]
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+
+def referenced_names(model, field, names):
+    if model is Media:
+        return referenced_media_names(names)
+    # _base_manager includes soft deleted communities
+    return set(
+        model._base_manager
+        .filter(**{f'{field}__in': names})
+        .values_list(field, flat=True)
+    )
+
+
+def collect_orphaned_files(day, storage=None, now=None, dry_run=False):
+    """
+    Queues the unreferenced files uploaded on a day for deletion,
+    returns their number. Only S3 storages are listed.
+    """
+    storage = storage or default_storage
+    if not isinstance(storage, S3Storage):
+        return 0
+    cutoff = (now or timezone.now()) - ORPHAN_GRACE_PERIOD
+
+    orphans = 0
+    for prefix, (model, field) in day_prefixes(day).items():
+        for page in iter_object_pages(storage, prefix):
+            names = [name for name, modified in page if modified < cutoff]
+            if not names:
+                continue
+            used = referenced_names(model, field, names)
+            unused = [name for name in names if name not in used]
+            if unused and not dry_run:
+                queue_file_deletion(unused)
+            orphans += len(unused)
+    return orphans
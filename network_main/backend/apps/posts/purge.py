@@ -0,0 +1,121 @@
+"""
+Deletion of posts without the ORM cascade.
+
+A deleted post is only marked 'DL', which hides it at once. A task then
+removes its ratings, comments, media and the post itself with raw SQL in
+short batches: no rows are loaded into memory and no delete signals run,
+so aggregates are not recomputed row by row for a post that is going away.
+"""
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+
+from apps.ratings.models import Rating
+from apps.recommendations.models import PostSimilarity, PostVoteRollup
+from apps.services.storage import queue_file_deletion
+
+from .models import Post, Comment, Media, PostCard
+
+logger = logging.getLogger(__name__)
+
+
+PURGE_BATCH_SIZE = 5000
+
+
+def soft_delete_post(post):
+    from .tasks import purge_deleted_post
+
+    post.status = 'DL'
+    post.save(update_fields=['status', 'updated'])
+    transaction.on_commit(lambda: purge_deleted_post.delay(post.pk))
+
+
+def delete_in_batches(table, where, params, order_by='', batch_size=PURGE_BATCH_SIZE):
+    """
+    Deletes rows of `table` matching `where` in batches,
+    each in its own transaction. Returns the number of deleted rows.
+    """
+    sql = (
+        f'DELETE FROM {table} WHERE id IN ('
+        f'SELECT id FROM {table} WHERE {where} {order_by} LIMIT %s)'
+    )
+    total = 0
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, [*params, batch_size])
+            deleted = cursor.rowcount
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+def purge_post(post_id, batch_size=PURGE_BATCH_SIZE):
+    """
+    Removes a soft deleted post and everything that belongs to it.
+    Returns {table: deleted rows} or None if the post is not deleted.
+    """
+    if not Post.objects.filter(pk=post_id, status='DL').exists():
+        return None
+
+    quote = connection.ops.quote_name
+    ratings = quote(Rating._meta.db_table)
+    comments = quote(Comment._meta.db_table)
+    media = quote(Media._meta.db_table)
+    get_type_id = ContentType.objects.get_for_model
+
+    deleted = {}
+    deleted['comment ratings'] = delete_in_batches(
+        ratings,
+        f'content_type_id = %s AND object_id IN '
+        f'(SELECT id FROM {comments} WHERE post_id = %s)',
+        [get_type_id(Comment).id, post_id],
+        batch_size=batch_size
+    )
+    deleted['post ratings'] = delete_in_batches(
+        ratings,
+        'content_type_id = %s AND object_id = %s',
+        [get_type_id(Post).id, post_id],
+        batch_size=batch_size
+    )
+    # the deepest comments go first, so a batch never
+    # leaves replies without their parent
+    deleted['comments'] = delete_in_batches(
+        comments,
+        'post_id = %s',
+        [post_id],
+        order_by='ORDER BY LENGTH(path) DESC',
+        batch_size=batch_size
+    )
+
+    files = []
+    for name, renditions in Media.objects.filter(
+            post_id=post_id).values_list('file', 'renditions'):
+        files += [name, *(item['name'] for item in renditions)]
+    deleted['media'] = delete_in_batches(
+        media, 'post_id = %s', [post_id], batch_size=batch_size)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {quote(PostSimilarity._meta.db_table)} '
+            f'WHERE post_id = %s',
+            [post_id]
+        )
+        cursor.execute(
+            f'DELETE FROM {quote(PostVoteRollup._meta.db_table)} '
+            f'WHERE post_id = %s',
+            [post_id]
+        )
+        cursor.execute(
+            f'DELETE FROM {quote(PostCard._meta.db_table)} WHERE id = %s',
+            [post_id]
+        )
+        cursor.execute(
+            f"DELETE FROM {quote(Post._meta.db_table)} "
+            f"WHERE id = %s AND status = 'DL'",
+            [post_id]
+        )
+
+    queue_file_deletion(files)
+
+    return deleted
@@ -0,0 +1,167 @@
+"""
+Write-behind buffer for replies counts.
+
+A reply changes `descendants_count` of every comment above it, so a busy
+thread would update (and lock) its root row on every insert. The deltas
+are added to a Redis hash (comment id -> pending delta) instead, and a
+periodic task moves them into the db in batches, with the flush batches
+of the rating buffer (see apps.ratings.counters). Readers add the pending
+delta on top of the stored value.
+
+When Redis is down the deltas are written straight to the db. Drift that
+still gets in is fixed by the periodic reconcile that recounts the
+replies below each comment.
+"""
+import logging
+
+from django.db import connection, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from apps.ratings.counters import flush_batch, flush_lock
+
+from .models import Comment
+
+logger = logging.getLogger(__name__)
+
+
+PENDING_REPLIES_KEY = 'comments:replies:pending'
+FLUSHING_REPLIES_KEY = f'{PENDING_REPLIES_KEY}:flushing'
+REPLIES_BATCH_SIZE = 1000
+
+
+def apply_replies_deltas(deltas):
+    """
+    Applies {comment id: delta} to descendants_count with one
+    UPDATE ... FROM (VALUES ...) statement per batch.
+    """
+    table = connection.ops.quote_name(Comment._meta.db_table)
+    # a stable order keeps concurrent writers from deadlocking
+    items = sorted(
+        (comment_id, delta) for comment_id, delta in deltas.items() if delta)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(items), REPLIES_BATCH_SIZE):
+            batch = items[start:start + REPLIES_BATCH_SIZE]
+            values = ', '.join(['(%s, %s)'] * len(batch))
+            cursor.execute(
+                f'UPDATE {table} AS t '
+                f'SET descendants_count = t.descendants_count + v.delta '
+                f'FROM (VALUES {values}) AS v(id, delta) '
+                f'WHERE t.id = v.id',
+                [value for item in batch for value in item]
+            )
+
+
+def buffer_replies_deltas(deltas):
+    """Buffers {comment id: delta}, writes it through when Redis is down."""
+    deltas = {comment_id: delta for comment_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    try:
+        r = get_redis_connection('default')
+        pipe = r.pipeline(transaction=False)
+        for comment_id, delta in deltas.items():
+            pipe.hincrby(PENDING_REPLIES_KEY, comment_id, delta)
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f'Failed to buffer replies counts, writing them through: {e}')
+        apply_replies_deltas(deltas)
+
+
+def get_pending_replies(comment_ids):
+    """{comment id: delta} of the deltas that are not in the db yet."""
+    comment_ids = list(comment_ids)
+    if not comment_ids:
+        return {}
+
+    try:
+        r = get_redis_connection('default')
+        pipe = r.pipeline(transaction=False)
+        pipe.hmget(PENDING_REPLIES_KEY, comment_ids)
+        pipe.hmget(FLUSHING_REPLIES_KEY, comment_ids)
+        pending, flushing = pipe.execute()
+    except RedisError as e:
+        logger.warning(f'Failed to read pending replies counts: {e}')
+        return {}
+
+    deltas = {}
+    for comment_id, a, b in zip(comment_ids, pending, flushing):
+        delta = int(a or 0) + int(b or 0)
+        if delta:
+            deltas[comment_id] = delta
+    return deltas
+
+
+def apply_pending_replies(comments):
+    """Adds pending deltas to `descendants_count` of loaded comments."""
+    comments = list(comments)
+    deltas = get_pending_replies([comment.pk for comment in comments])
+    for comment in comments:
+        comment.descendants_count += deltas.get(comment.pk, 0)
+    return comments
+
+
+def flush_replies_deltas():
+    """
+    Moves pending deltas into the db, returns the updated ids. A batch
+    that failed to flush is retried before new deltas are taken.
+    """
+    def apply(fields):
+        apply_replies_deltas(
+            {int(comment_id): delta for comment_id, delta in fields.items()})
+
+    fields = flush_batch(PENDING_REPLIES_KEY, apply)
+    return [int(comment_id) for comment_id, delta in (fields or {}).items() if delta]
+
+
+def reconcile_replies(batch_size=REPLIES_BATCH_SIZE):
+    """
+    Sets descendants_count of drifted comments to their actual replies,
+    one batch at a time, returns the fixed ids. Like the rating
+    reconcile, comments with buffered deltas are skipped and a batch
+    whose flush lock is taken is left to the next run.
+    """
+    actual = Coalesce(Subquery(
+        Comment.objects
+        .filter(post=OuterRef('post'), path__startswith=OuterRef('path'))
+        .exclude(pk=OuterRef('pk'))
+        .order_by()
+        .values('post')
+        .annotate(count=Count('id'))
+        .values('count')
+    ), 0)
+
+    fixed = []
+    last_id = 0
+    while True:
+        comment_ids = list(
+            Comment.objects
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not comment_ids:
+            break
+        last_id = comment_ids[-1]
+
+        with flush_lock(PENDING_REPLIES_KEY) as acquired:
+            if not acquired:
+                continue
+            settled = set(comment_ids) - set(get_pending_replies(comment_ids))
+            drifted = list(
+                Comment.objects
+                .filter(id__in=settled)
+                .annotate(actual=actual)
+                .exclude(descendants_count=F('actual'))
+                .values_list('id', flat=True)
+            )
+            if drifted:
+                Comment.objects.filter(id__in=drifted).update(
+                    descendants_count=actual)
+                fixed += drifted
+
+    return fixed
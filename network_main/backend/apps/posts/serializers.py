@@ -1,17 +1,18 @@
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
-from django.contrib.contenttypes.models import ContentType
-
 from bleach import clean
 
+from django.db import transaction
+
 from apps.communities.models import Community
 from apps.ratings.models import Rating
 
 from apps.services.utils import validate_magic_mime, validate_file_size, validate_files_length
 
+from .images import rendition_urls
 from .models import Post, Comment, Media
-from .tasks import start_compression_for_post_media
+from .media import store_media_files, attach_media, discard_files
 
 ALLOWED_MIME_TYPES = {
     'image': ['image/jpeg', 'image/png', 'image/gif', 'image/webp'],
@@ -23,13 +24,15 @@ class MediaSerializer(serializers.ModelSerializer):
     media_type = serializers.SerializerMethodField()
     aspect_ratio = serializers.CharField(read_only=True)
     file_url = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Media
-        fields = ('id', 'file', 'media_type',
-                  'aspect_ratio', 'file_url', 'uploaded_at')
-        read_only_fields = ('id', 'media_type',
-                            'aspect_ratio', 'file_url', 'uploaded_at')
+        fields = ('id', 'file', 'media_type', 'aspect_ratio', 'width', 'height',
+                  'dominant_color', 'placeholder', 'file_url', 'srcset', 'uploaded_at')
+        read_only_fields = ('id', 'media_type', 'aspect_ratio', 'width', 'height',
+                            'dominant_color', 'placeholder', 'file_url', 'srcset',
+                            'uploaded_at')
 
     def validate_file(self, uploaded_file):
         validate_magic_mime(uploaded_file)
@@ -41,6 +44,14 @@ class MediaSerializer(serializers.ModelSerializer):
     def get_file_url(self, obj):
         return obj.file.url
 
+    def get_srcset(self, obj):
+        request = self.context.get('request')
+        srcset = rendition_urls(obj)
+        if request is not None:
+            for item in srcset:
+                item['url'] = request.build_absolute_uri(item['url'])
+        return srcset
+
 
 class CommentSummarySerializer(serializers.ModelSerializer):
     author = serializers.StringRelatedField(read_only=True)
@@ -84,7 +95,7 @@ class CommentDetailSerializer(serializers.ModelSerializer):
         if value:
             slug = self.context['view'].kwargs.get('slug')
             try:
-                post = Post.objects.get(slug=slug)
+                post = Post.visible.get(slug=slug)
                 if value.post != post:
                     raise ValidationError(
                         'Parent comment must belong to the same post.')
@@ -211,6 +222,11 @@ class PostDetailSerializer(serializers.ModelSerializer):
     def validate_title(self, value):
         return clean(value, tags=[], attributes={}, strip=True)
 
+    def validate_status(self, value):
+        if value == 'DL':
+            raise ValidationError('Posts are deleted with a DELETE request.')
+        return value
+
     # something will need to be done about it
     #
     # def validate_description(self, value):
@@ -225,21 +241,28 @@ class PostDetailSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         media_files = validated_data.pop('media_files', [])
-        post = Post.objects.create(**validated_data)
-        for file in media_files:
-            Media.objects.create(post=post, file=file)
-        start_compression_for_post_media(post.id)
+        names = store_media_files(media_files)
+        try:
+            with transaction.atomic():
+                post = Post.objects.create(**validated_data)
+                attach_media(post, names)
+        except Exception:
+            discard_files(names)
+            raise
         return post
 
     def update(self, instance, validated_data):
         media_files = validated_data.pop('media_files', [])
         deleted_media_ids = validated_data.pop('deleted_media_files', [])
 
-        post = super().update(instance, validated_data)
-        if media_files:
-            for file in media_files:
-                Media.objects.create(post=post, file=file)
-            start_compression_for_post_media(post.id)
+        names = store_media_files(media_files)
+        try:
+            with transaction.atomic():
+                post = super().update(instance, validated_data)
+                attach_media(post, names)
+        except Exception:
+            discard_files(names)
+            raise
         if deleted_media_ids:
             Media.objects.filter(id__in=deleted_media_ids, post=post).delete()
         return post
@@ -254,45 +277,33 @@ class RatingSerializer(serializers.ModelSerializer):
         fields = ('id', 'user', 'value', 'time_created')
         read_only_fields = ('id', 'user', 'time_created')
 
-    def validate(self, attrs):
-        request = self.context['request']
-        view = self.context['view']
-        content_type = None
-        object_id = None
-
-        if 'slug' in view.kwargs and 'pk' not in view.kwargs:
-            content_type = ContentType.objects.get_for_model(Post)
-            slug = view.kwargs['slug']
-            try:
-                post = Post.objects.get(slug=slug)
-                object_id = post.id
-            except Post.DoesNotExist:
-                raise ValidationError('Post does not exist.')
-        elif 'slug' in view.kwargs and 'pk' in view.kwargs:
-            content_type = ContentType.objects.get_for_model(Comment)
-            object_id = view.kwargs['pk']
-            try:
-                post = Post.objects.get(slug=view.kwargs['slug'])
-                if not Comment.objects.filter(pk=object_id).exists():
-                    raise ValidationError('Comment does not exist.')
-            except Post.DoesNotExist:
-                raise ValidationError('Post does not exist.')
-        else:
-            raise ValidationError('Invalid URL parameters.')
 
-        attrs['content_type'] = content_type
-        attrs['object_id'] = object_id
-        attrs['user'] = request.user
-        return attrs
+class MediaUploadSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=255)
+    content_type = serializers.CharField(max_length=100)
+    size = serializers.IntegerField(min_value=1)
 
-    def create(self, validated_data):
-        rating, created = Rating.objects.update_or_create(
-            content_type=validated_data['content_type'],
-            object_id=validated_data['object_id'],
-            user=validated_data['user'],
-            defaults={
-                'value': validated_data['value'],
-            }
+    def validate(self, attrs):
+        ext = attrs['name'].rsplit('.', 1)[-1].lower()
+        media_type = next(
+            (media_type for media_type, extensions in Media.MEDIA_EXTENSIONS.items()
+             if ext in extensions),
+            None
         )
-        self.created = created
-        return rating
+        if media_type is None:
+            raise ValidationError({'name': f'Unsupported file extension: {ext}'})
+        if attrs['content_type'] not in ALLOWED_MIME_TYPES[media_type]:
+            raise ValidationError(
+                {'content_type': f'Invalid file type: {attrs["content_type"]}'})
+        if attrs['size'] > 10 * 1024 * 1024:
+            raise ValidationError({'size': 'File size cannot exceed 10MB.'})
+        return attrs
+
+
+class UploadRequestSerializer(serializers.Serializer):
+    files = MediaUploadSerializer(many=True, allow_empty=False)
+
+
+class FinalizeUploadSerializer(serializers.Serializer):
+    tokens = serializers.ListField(
+        child=serializers.CharField(), allow_empty=False)
@@ -1,8 +1,36 @@
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from apps.communities.feeds import add_post_to_feed, remove_posts_from_feed
+from apps.communities.models import Community
+from apps.users.models import CustomUser
+from apps.recommendations.feeds import is_pushed_community
+from apps.recommendations.tasks import fanout_post_to_members
+from apps.recommendations.scoring import mark_posts_dirty, hot_key_expression
+from apps.services.storage import queue_file_deletion
 
-from .models import Post, Comment
+from .cards import (
+    refresh_post_cards,
+    refresh_card_media,
+    refresh_author_cards,
+    refresh_community_cards
+)
+from .models import (
+    Post,
+    Comment,
+    Media,
+    PostCard,
+    PATH_SEGMENT_WIDTH,
+    ancestor_ids
+)
+from .replies import buffer_replies_deltas
 
 
 @receiver([post_save, post_delete], sender=Post)
@@ -18,20 +46,161 @@ def invalidate_first_page_cache(sender, instance, **kwargs):
     cache.delete_many(keys)
 
 
-def update_post_comment_count(post_id):
+@receiver(post_save, sender=Post)
+def on_post_save_update_feed(sender, instance, **kwargs):
+    if instance.status == 'PB':
+        add_post_to_feed(instance)
+        mark_posts_dirty([instance.pk])
+    else:
+        remove_posts_from_feed(instance.community_id, [instance.pk])
+
+
+@receiver(post_save, sender=Post)
+def on_post_publish_fanout(sender, instance, created, **kwargs):
+    # a new published post or a draft that was published just now
+    previous = instance.get_loaded_status()
+    published = created or previous not in (None, 'PB')
+    instance.set_loaded_status()
+    if published and instance.status == 'PB' and is_pushed_community(instance.community.members_count):
+        transaction.on_commit(
+            lambda: fanout_post_to_members.delay(instance.pk)
+        )
+
+
+@receiver(post_delete, sender=Post)
+def on_post_delete_update_feed(sender, instance, **kwargs):
+    remove_posts_from_feed(instance.community_id, [instance.pk])
+
+
+@receiver(post_save, sender=Post)
+def on_post_save_update_card(sender, instance, **kwargs):
+    refresh_post_cards([instance.pk])
+
+
+@receiver(post_delete, sender=Post)
+def on_post_delete_remove_card(sender, instance, **kwargs):
+    PostCard.objects.filter(id=instance.pk).delete()
+
+
+@receiver([post_save, post_delete], sender=Media)
+def on_media_change_update_card(sender, instance, **kwargs):
+    refresh_card_media(instance.post_id)
+
+
+def stored_file_names(instance, fields):
+    """Names of the instance's files, defaults are shared and skipped."""
+    names = []
+    for field in fields:
+        name = getattr(instance, field).name
+        if name and name != instance._meta.get_field(field).default:
+            names.append(name)
+    return names
+
+
+def queue_deletion_on_commit(names):
+    if names:
+        transaction.on_commit(lambda: queue_file_deletion(names))
+
+
+@receiver(post_delete, sender=Media)
+def on_media_delete_queue_files(sender, instance, **kwargs):
+    queue_deletion_on_commit(
+        stored_file_names(instance, ['file'])
+        + [item['name'] for item in instance.renditions]
+    )
+
+
+@receiver(post_delete, sender=Community)
+def on_community_delete_queue_files(sender, instance, **kwargs):
+    queue_deletion_on_commit(stored_file_names(instance, ['icon', 'banner']))
+
+
+@receiver(post_delete, sender=CustomUser)
+def on_user_delete_queue_files(sender, instance, **kwargs):
+    queue_deletion_on_commit(stored_file_names(instance, ['avatar']))
+
+
+@receiver(post_save, sender=Community)
+def on_community_save_update_cards(sender, instance, **kwargs):
+    refresh_community_cards(instance)
+
+
+@receiver(post_save, sender=CustomUser)
+def on_user_save_update_cards(sender, instance, update_fields=None, **kwargs):
+    if update_fields and not {'username', 'slug', 'avatar'} & set(update_fields):
+        return
+    refresh_author_cards(instance)
+
+
+# (post id, path) of the deleted comments while a subtree delete is running
+_subtree_deletes = ContextVar('comment_subtree_deletes', default=None)
+
+
+def change_post_comment_count(post_id, delta):
+    count = F('comment_count') + delta
+    Post.objects.filter(pk=post_id).update(
+        comment_count=count,
+        hot_key=hot_key_expression(comment_count=count)
+    )
+    mark_posts_dirty([post_id])
+
+
+def change_replies_counts(deltas):
+    """Buffers {comment id: delta} once the change is committed."""
+    transaction.on_commit(lambda: buffer_replies_deltas(deltas))
+
+
+def removed_replies(paths):
+    """
+    {comment id: -removed replies} for the ancestors of deleted comments
+    that are not deleted themselves.
+    """
+    deleted_ids = {int(path[-PATH_SEGMENT_WIDTH:], 16) for path in paths}
+    deltas = Counter()
+    for path in paths:
+        for ancestor_id in ancestor_ids(path):
+            if ancestor_id not in deleted_ids:
+                deltas[ancestor_id] -= 1
+    return deltas
+
+
+@contextmanager
+def aggregate_comment_deletes():
+    """
+    Applies the comment deletes inside the block as one comment_count
+    delta per post and one replies count delta per remaining ancestor.
+
+    Comment.delete(), comment querysets and Post.delete() run in such a
+    block. Other cascades, such as the admin deleting a community or an
+    account, are counted comment by comment; deletion jobs count their
+    own raw deletes.
+    """
+    deleted = []
+    token = _subtree_deletes.set(deleted)
     try:
-        post = Post.objects.get(pk=post_id)
-        count = post.owned_comments.count()
-        Post.objects.filter(pk=post_id).update(comment_count=count)
-    except Post.DoesNotExist:
-        pass
+        yield
+    finally:
+        _subtree_deletes.reset(token)
+
+    per_post = Counter(post_id for post_id, _ in deleted)
+    for post_id, count in per_post.items():
+        change_post_comment_count(post_id, -count)
+    change_replies_counts(removed_replies([path for _, path in deleted]))
 
 
 @receiver(post_save, sender=Comment)
-def on_comment_save(sender, instance, **kwargs):
-    update_post_comment_count(instance.post_id)
+def on_comment_save(sender, instance, created, **kwargs):
+    if created:
+        change_post_comment_count(instance.post_id, 1)
+        change_replies_counts(
+            {ancestor_id: 1 for ancestor_id in ancestor_ids(instance.path)})
 
 
 @receiver(post_delete, sender=Comment)
 def on_comment_delete(sender, instance, **kwargs):
-    update_post_comment_count(instance.post_id)
+    deleted = _subtree_deletes.get()
+    if deleted is not None:
+        deleted.append((instance.post_id, instance.path))
+    else:
+        change_post_comment_count(instance.post_id, -1)
+        change_replies_counts(removed_replies([instance.path]))
@@ -1,65 +1,57 @@
-import os
-import pyvips
-import uuid
+import time
+from datetime import timedelta
 from celery import shared_task, group
-from django.core.files.base import ContentFile
 from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from botocore.exceptions import ClientError
 
-from apps.services.utils import delete_s3_file
-from .models import Post, Media
+from apps.services.storage import queue_file_deletion, flush_file_deletions
+from apps.recommendations.scoring import mark_posts_dirty, hot_key_expression
+from .images import decode_image, describe_image, render_renditions
+from .models import Post, Comment, Media, DeletionJob
+from .purge import purge_post
+from .deletion import run_deletion_chunk
+from .replies import flush_replies_deltas, reconcile_replies
+from .orphans import collect_orphaned_files, ORPHAN_LOOKBACK_DAYS
 
-MAX_SIZE_THRESHOLD = 1 * 1024 * 1024
+RECONCILE_BATCH_SIZE = 1000
+DELETION_TASK_SECONDS = 60
 
 
 @shared_task(bind=True, autoretry_for=(ClientError,), retry_kwargs={'max_retries': 3, 'countdown': 4})
 def process_image_to_webp(self, image_id):
-    temp_input_path = None
+    """
+    Renders the WebP renditions of an image and records its dimensions,
+    colour and placeholder from the same decode.
+    """
     try:
         image = Media.objects.get(id=image_id)
 
         if not image.file:
             return f"Image {image_id} has no file."
 
-        file_ext = os.path.splitext(image.file.name)[1]
-        temp_input_path = f'/tmp/{image_id}_{uuid.uuid4().hex}{file_ext}'
+        vips_image = decode_image(image.file)
+        for field, value in describe_image(vips_image).items():
+            setattr(image, field, value)
+        image.aspect_ratio = f"{vips_image.width}/{vips_image.height}"
+        update_fields_list = [
+            'aspect_ratio', 'width', 'height', 'dominant_color', 'placeholder']
 
-        with open(temp_input_path, 'wb') as f:
-            for chunk in image.file.chunks(chunk_size=1024*300):
-                f.write(chunk)
-
-        vips_image = pyvips.Image.new_from_file(
-            temp_input_path, access='sequential'
-        )
-
-        ratio = f"{vips_image.width}/{vips_image.height}"
-        image.aspect_ratio = ratio
-
-        update_fields_list = ['aspect_ratio']
-
-        is_small = image.file.size < MAX_SIZE_THRESHOLD
-        is_already_webp = image.file.name.lower().endswith('.webp')
-        is_gif = image.file.name.lower().endswith('.gif')
-
-        if is_small or is_already_webp or is_gif:
+        if image.file.name.lower().endswith('.gif'):
+            # animated images are served as they are
             image.save(update_fields=update_fields_list)
-            action = 'Updated ratio only (skipped compression)'
+            action = 'Updated dimensions only (skipped compression)'
         else:
-            webp_buffer = vips_image.write_to_buffer('.webp', Q=50, strip=True)
+            image.renditions, stale = render_renditions(image, vips_image)
+            image.save(update_fields=update_fields_list + ['renditions', 'file'])
+            queue_file_deletion(stale)
+            action = f'Rendered {len(image.renditions)} WebP renditions'
 
-            old_file = image.file.name
-            storage_instance = image.file.storage
-
-            basename = os.path.basename(image.file.name)
-            new_filename = os.path.splitext(basename)[0] + '.webp'
-
-            image.file.save(new_filename, ContentFile(webp_buffer), save=False)
-            update_fields_list.append('file')
-            image.save(update_fields=update_fields_list)
-
-            delete_s3_file(storage_instance, old_file)
-
-            action = 'Converted to WebP and updated ratio'
+        # the card media is refreshed by the Media signal, this only
+        # moves the post's lastmod for the sitemap and the card
+        Post.objects.filter(pk=image.post_id).update(updated=timezone.now())
 
         return (f'Success image {image_id}: {action}')
 
@@ -67,12 +59,9 @@ def process_image_to_webp(self, image_id):
         raise e
     except Exception as e:
         return (f'Error compression for image {image_id}: {e}')
-    finally:
-        if temp_input_path and os.path.exists(temp_input_path):
-            os.remove(temp_input_path)
 
 
-def start_compression_for_post_media(post_id):
+def start_compression_for_post_media(post_id, media_ids=None):
     try:
         post = Post.objects.get(id=post_id)
 
@@ -80,6 +69,8 @@ def start_compression_for_post_media(post_id):
             return
 
         media_qs = post.media_data.all()
+        if media_ids is not None:
+            media_qs = media_qs.filter(id__in=media_ids)
 
         task_list = [
             process_image_to_webp.s(media.id)
@@ -92,3 +83,151 @@ def start_compression_for_post_media(post_id):
 
     except Exception as e:
         return (f'Error start compression for post {post_id}: {e}')
+
+
+@shared_task
+def reconcile_comment_counts():
+    """
+    A periodic task that fixes drift of comment_count
+    from the actual comments, one batch of posts at a time.
+    """
+    actual = Coalesce(Subquery(
+        Comment.objects
+        .filter(post=OuterRef('pk'))
+        .order_by()
+        .values('post')
+        .annotate(count=Count('id'))
+        .values('count')
+    ), 0)
+
+    fixed = []
+    last_id = 0
+    while True:
+        post_ids = list(
+            Post.objects
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .values_list('id', flat=True)[:RECONCILE_BATCH_SIZE]
+        )
+        if not post_ids:
+            break
+        last_id = post_ids[-1]
+
+        drifted = list(
+            Post.objects
+            .filter(id__in=post_ids)
+            .annotate(actual=actual)
+            .exclude(comment_count=F('actual'))
+            .values_list('id', flat=True)
+        )
+        if drifted:
+            Post.objects.filter(id__in=drifted).update(
+                comment_count=actual,
+                hot_key=hot_key_expression(comment_count=actual)
+            )
+            fixed += drifted
+
+    mark_posts_dirty(fixed)
+    return f'Fixed comment count of {len(fixed)} posts'
+
+
+@shared_task
+def flush_pending_replies():
+    """
+    A periodic task that moves buffered replies count deltas
+    into descendants_count.
+    """
+    comment_ids = flush_replies_deltas()
+    return f'Flushed replies counts of {len(comment_ids)} comments'
+
+
+@shared_task
+def reconcile_replies_counts():
+    """
+    A periodic task that fixes drift of descendants_count
+    from the actual replies, one batch of comments at a time.
+    """
+    fixed = reconcile_replies()
+    return f'Fixed replies count of {len(fixed)} comments'
+
+
+@shared_task
+def purge_deleted_post(post_id):
+    deleted = purge_post(post_id)
+    if deleted is None:
+        return f'Post {post_id} is not deleted'
+    return f'Purged post {post_id}: {deleted}'
+
+
+@shared_task
+def purge_deleted_posts():
+    """
+    A periodic task that purges soft deleted posts
+    whose purge was not started or did not finish.
+    """
+    post_ids = list(
+        Post.objects
+        .filter(status='DL', updated__lt=timezone.now() - timedelta(minutes=10))
+        .values_list('id', flat=True)[:100]
+    )
+    for post_id in post_ids:
+        purge_post(post_id)
+    return f'Purged {len(post_ids)} posts'
+
+
+@shared_task
+def run_deletion_job(job_id):
+    """
+    Runs chunks of a deletion job for about a minute,
+    then queues itself again to keep every task short.
+    """
+    deadline = time.monotonic() + DELETION_TASK_SECONDS
+    while time.monotonic() < deadline:
+        job = run_deletion_chunk(job_id)
+        if job is None:
+            return f'Deletion job {job_id} is finished or running'
+        if job.finished:
+            return f'Deletion job {job_id} finished: {job.progress}'
+
+    run_deletion_job.delay(job_id)
+    return f'Deletion job {job_id} continues at {job.stage} after {job.last_id}'
+
+
+@shared_task
+def resume_deletion_jobs():
+    """
+    A periodic task that restarts deletion jobs
+    which made no progress for ten minutes.
+    """
+    job_ids = list(
+        DeletionJob.objects
+        .filter(finished__isnull=True, updated__lt=timezone.now() - timedelta(minutes=10))
+        .values_list('id', flat=True)
+    )
+    for job_id in job_ids:
+        run_deletion_job.delay(job_id)
+    return f'Resumed {len(job_ids)} deletion jobs'
+
+
+@shared_task
+def flush_storage_deletions():
+    """
+    A periodic task that deletes the queued files
+    in batches of DeleteObjects requests.
+    """
+    deleted = flush_file_deletions()
+    return f'Deleted {deleted} files'
+
+
+@shared_task
+def collect_orphaned_storage_files():
+    """
+    A daily task that queues the unreferenced files
+    of the last ORPHAN_LOOKBACK_DAYS days for deletion.
+    """
+    today = timezone.now().date()
+    orphans = sum(
+        collect_orphaned_files(today - timedelta(days=days))
+        for days in range(1, ORPHAN_LOOKBACK_DAYS + 1)
+    )
+    return f'Queued {orphans} orphaned files for deletion'
@@ -1,14 +1,33 @@
 import pytest
+import base64
+import importlib
 import io
+import json
 import os
 import pyvips
+from datetime import timedelta
 from urllib.parse import urlparse
-from unittest.mock import MagicMock, patch, PropertyMock
+from unittest.mock import MagicMock, patch
 
+from django.test import TestCase
 from django.urls import reverse
 from django.contrib.contenttypes.models import ContentType
+from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.cache import cache
+from django.core import signing
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from django_redis import get_redis_connection
+from moto import mock_aws
+from storages.backends.s3 import S3Storage
+from redis.exceptions import RedisError
+import requests
+from django.db import connection, connections
+from django.db.models import Sum
+from django.db.migrations.loader import MigrationLoader
 
 from rest_framework.test import APIClient
 from rest_framework import status
@@ -17,8 +36,33 @@ from apps.users.models import CustomUser
 from apps.communities.models import Community
 from apps.categories.models import Category
 from apps.ratings.models import Rating
-from apps.posts.models import Post, Comment, Media
-from apps.posts.tasks import process_image_to_webp, MAX_SIZE_THRESHOLD
+from apps.memberships.models import Membership
+from apps.posts.models import Post, Comment, Media, DeletionJob, PostCard
+from apps.posts.tasks import (
+    process_image_to_webp,
+    reconcile_comment_counts,
+    flush_pending_replies,
+    reconcile_replies_counts,
+    purge_deleted_post,
+    run_deletion_job
+)
+from apps.posts.cards import build_post_card
+from apps.posts.images import ORIGINAL_MAX_WIDTH
+from apps.posts.uploads import UPLOAD_TOKEN_SALT
+from apps.posts import media as media_module
+from apps.posts.orphans import collect_orphaned_files
+from apps.services.storage import DELETION_QUEUE_KEY, flush_file_deletions
+from apps.posts.deletion import (
+    delete_community,
+    delete_user,
+    run_deletion_chunk,
+    DELETION_LOCK_NAMESPACE
+)
+from apps.ratings.tasks import flush_pending_ratings
+from apps.recommendations.feeds import get_subscriptions
+from apps.posts.purge import soft_delete_post, purge_post
+from apps.ratings.counters import get_pending_deltas
+from apps.recommendations.models import PostSimilarity, PostVoteRollup
 from apps.services.utils import delete_s3_file
 
 pyvips.cache_set_max(0)
@@ -88,6 +132,36 @@ def comment(test_user, post):
     )
 
 
+@pytest.fixture
+def image_storage(tmp_path):
+    storage = FileSystemStorage(location=tmp_path, base_url='/media/')
+    with patch.object(Media._meta.get_field('file'), 'storage', storage):
+        yield storage
+
+
+def image_upload(name, width, height):
+    image = pyvips.Image.black(width, height, bands=3) + 128
+    data = image.cast('uchar').write_to_buffer(os.path.splitext(name)[1])
+    return SimpleUploadedFile(name, data)
+
+
+@pytest.fixture
+def s3_storage():
+    with mock_aws():
+        storage = S3Storage(
+            bucket_name='test-bucket',
+            access_key='testing',
+            secret_key='testing',
+            region_name='us-east-1',
+            location='media',
+            default_acl='public-read',
+            querystring_auth=False
+        )
+        storage.connection.meta.client.create_bucket(Bucket='test-bucket')
+        with patch.object(Media._meta.get_field('file'), 'storage', storage):
+            yield storage
+
+
 @pytest.fixture
 def media_file(post):
     return Media.objects.create(
@@ -179,6 +253,47 @@ class TestPostView:
         assert not Post.objects.filter(
             title='post with too many files').exists()
 
+    def test_create_post_with_several_media_files(self, api_client, test_user, community, image_storage):
+        api_client.force_authenticate(user=test_user)
+        data = {
+            'title': 'post with images',
+            'community_obj': community.id,
+            'media_files': [image_upload(f'img{i}.png', 8, 8) for i in range(3)],
+        }
+
+        response = api_client.post(self.url, data, format='multipart')
+        assert response.status_code == status.HTTP_201_CREATED
+        post = Post.objects.get(title='post with images')
+        names = set(Media.objects.filter(post=post).values_list('file', flat=True))
+        assert len(names) == 3
+        assert all(image_storage.exists(name) for name in names)
+        # bulk_create sends no signals, the card is refreshed explicitly
+        assert len(PostCard.objects.get(id=post.id).media) == 3
+
+    def test_create_post_removes_stored_files_on_error(self, api_client, test_user, community, image_storage):
+        api_client.force_authenticate(user=test_user)
+        store_file = media_module.store_file
+        stored = []
+
+        def failing_store_file(file):
+            if file.name == 'bad.png':
+                raise OSError('storage is down')
+            stored.append(store_file(file))
+            return stored[-1]
+
+        data = {
+            'title': 'post with a failed upload',
+            'community_obj': community.id,
+            'media_files': [image_upload(name, 8, 8) for name in ('a.png', 'bad.png', 'b.png')],
+        }
+        with patch('apps.posts.media.store_file', side_effect=failing_store_file):
+            with pytest.raises(OSError):
+                api_client.post(self.url, data, format='multipart')
+
+        assert not Post.objects.filter(title='post with a failed upload').exists()
+        assert len(stored) == 2
+        assert not any(image_storage.exists(name) for name in stored)
+
     def test_post_create_invalid_community(self, authenticated_client):
         data = {
             'title': 'invalid community post',
@@ -300,6 +415,10 @@ class TestPostView:
         url = reverse('post-detail', kwargs={'slug': 'testpost'})
         response = authenticated_client.delete(url)
         assert response.status_code == status.HTTP_204_NO_CONTENT
+        post.refresh_from_db()
+        assert post.status == 'DL'
+
+        purge_deleted_post(post.id)
         assert not Post.objects.filter(id=post.id).exists()
 
     def test_delete_post_unauthenticated(self, api_client, post):
@@ -614,14 +733,441 @@ class TestCommentRepliesView:
 
 
 @pytest.mark.django_db
-class TestAnnotations:
-    def test_post_annotations(self, api_client, post, test_user):
+class TestCommentTree:
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        # pending replies counts live in redis, not in the test database
+        cache.clear()
+        yield
+        cache.clear()
+
+    def reply(self, comment, content='reply'):
+        return Comment.objects.create(
+            post=comment.post,
+            author=comment.author,
+            content=content,
+            parent=comment
+        )
+
+    def test_paths(self, comment):
+        child = self.reply(comment)
+        grandchild = self.reply(child)
+
+        assert comment.depth == 0
+        assert grandchild.depth == 2
+        assert grandchild.path.startswith(child.path)
+        assert child.path.startswith(comment.path)
+        assert list(comment.get_descendants().order_by('path')) == [
+            child, grandchild]
+
+    def test_replies_count_includes_nested_replies(self, api_client, post, comment,
+                                                   django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            child = self.reply(comment)
+            self.reply(child)
+            sibling = Comment.objects.create(
+                post=post, author=comment.author, content='sibling')
+            self.reply(sibling)
+
+        response = api_client.get(
+            reverse('post-comments-list', kwargs={'slug': post.slug}))
+        counts = {
+            item['id']: item['replies_count']
+            for item in response.data['results']
+        }
+        assert counts == {comment.id: 2, sibling.id: 1}
+
+        response = api_client.get(reverse(
+            'post-comment-replies', kwargs={'slug': post.slug, 'pk': comment.pk}))
+        assert response.data['results'][0]['replies_count'] == 1
+
+    def test_insert_query_count(self, comment, django_assert_num_queries):
+        # id allocation, insert and the post comment count,
+        # the replies count deltas are buffered in redis
+        with django_assert_num_queries(3):
+            reply = self.reply(comment)
+        assert reply.path == comment.path + f'{reply.id:012x}'
+
+    def test_replies_count_is_stored(self, comment, django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            child = self.reply(comment)
+            grandchild = self.reply(child)
+            self.reply(grandchild)
+        comment.refresh_from_db()
+        assert comment.descendants_count == 0
+
+        assert flush_pending_replies() == 'Flushed replies counts of 3 comments'
+        comment.refresh_from_db()
+        assert comment.descendants_count == 3
+
+        # the deleted subtree is subtracted once from the remaining ancestors
+        with django_capture_on_commit_callbacks(execute=True):
+            grandchild.delete()
+        flush_pending_replies()
+        comment.refresh_from_db()
+        child.refresh_from_db()
+        assert (comment.descendants_count, child.descendants_count) == (1, 0)
+
+    def test_rolled_back_reply_is_not_counted(self, comment,
+                                              django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=False) as callbacks:
+            self.reply(comment)
+        # the reply never commits, so the callbacks are dropped
+        assert callbacks
+        flush_pending_replies()
+        comment.refresh_from_db()
+        assert comment.descendants_count == 0
+
+    def test_replies_count_without_redis(self, comment,
+                                         django_capture_on_commit_callbacks):
+        with patch('apps.posts.replies.get_redis_connection',
+                   side_effect=RedisError('down')):
+            with django_capture_on_commit_callbacks(execute=True):
+                self.reply(comment)
+        comment.refresh_from_db()
+        assert comment.descendants_count == 1
+
+    def test_reconcile_replies_counts(self, comment, django_capture_on_commit_callbacks):
+        child = self.reply(comment)
+        self.reply(child)
+        Comment.objects.filter(pk=child.pk).update(descendants_count=5)
+
+        assert reconcile_replies_counts() == 'Fixed replies count of 2 comments'
+        comment.refresh_from_db()
+        child.refresh_from_db()
+        assert (comment.descendants_count, child.descendants_count) == (2, 1)
+
+        # a comment with a buffered delta is left to the flush
+        with django_capture_on_commit_callbacks(execute=True):
+            self.reply(child)
+        Comment.objects.filter(pk=comment.pk).update(descendants_count=9)
+        assert reconcile_replies_counts() == 'Fixed replies count of 0 comments'
+
+    def test_delete_removes_subtree(self, comment):
+        child = self.reply(comment)
+        self.reply(child)
+
+        comment.delete()
+        assert not Comment.objects.exists()
+
+
+@pytest.mark.django_db
+class TestCommentCount:
+    def reply(self, post, author, parent=None):
+        return Comment.objects.create(
+            post=post, author=author, content='reply', parent=parent)
+
+    def test_create_and_edit(self, post, comment, django_assert_num_queries):
+        post.refresh_from_db()
+        assert post.comment_count == 1
+
+        comment.content = 'edited'
+        # the edit does not touch the post
+        with django_assert_num_queries(1):
+            comment.save()
+
+        post.refresh_from_db()
+        assert post.comment_count == 1
+
+    def test_subtree_delete_is_one_delta(self, post, comment, test_user):
+        child = self.reply(post, test_user, comment)
+        self.reply(post, test_user, child)
+        self.reply(post, test_user)
+
+        with CaptureQueriesContext(connection) as context:
+            comment.delete()
+
+        post_updates = [
+            query for query in context.captured_queries
+            if query['sql'].startswith('UPDATE "api_network_post"')
+        ]
+        assert len(post_updates) == 1
+        post.refresh_from_db()
+        assert post.comment_count == 1
+
+    def test_queryset_delete_is_one_delta(self, post, comment, test_user,
+                                          django_capture_on_commit_callbacks):
+        cache.clear()
+        with django_capture_on_commit_callbacks(execute=True):
+            child = self.reply(post, test_user, comment)
+            grandchild = self.reply(post, test_user, child)
+            self.reply(post, test_user, grandchild)
+            sibling = self.reply(post, test_user)
+
+        with CaptureQueriesContext(connection) as context, \
+                django_capture_on_commit_callbacks(execute=True):
+            Comment.objects.filter(pk__in=[grandchild.pk, sibling.pk]).delete()
+        flush_pending_replies()
+
+        post_updates = [
+            query for query in context.captured_queries
+            if query['sql'].startswith('UPDATE "api_network_post"')
+        ]
+        assert len(post_updates) == 1
+        post.refresh_from_db()
+        comment.refresh_from_db()
+        child.refresh_from_db()
+        assert post.comment_count == 2
+        assert (comment.descendants_count, child.descendants_count) == (1, 0)
+
+    def test_post_delete_skips_comment_deltas(self, post, comment, test_user):
+        self.reply(post, test_user, comment)
+
+        with CaptureQueriesContext(connection) as context:
+            post.delete()
+
+        comment_updates = [
+            query for query in context.captured_queries
+            if query['sql'].startswith('UPDATE "api_network_comment"')
+        ]
+        assert comment_updates == []
+        assert not Comment.objects.exists()
+
+    def test_reconcile(self, post, comment, test_user):
+        other = Post.objects.create(
+            author=test_user, title='otherpost', community=post.community)
+        Post.objects.filter(pk=post.pk).update(comment_count=7)
+
+        assert reconcile_comment_counts() == 'Fixed comment count of 1 posts'
+        post.refresh_from_db()
+        other.refresh_from_db()
+        assert post.comment_count == 1
+        assert other.comment_count == 0
+
+
+@pytest.mark.django_db
+class TestCommentTreeView:
+    def get_url(self, post):
+        return reverse('post-comments-tree', kwargs={'slug': post.slug})
+
+    @pytest.fixture
+    def thread(self, post, test_user):
+        """Three top level comments with two levels of replies each."""
+        def create(parent=None, content=''):
+            return Comment.objects.create(
+                post=post, author=test_user, content=content, parent=parent)
+
+        cache.clear()
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            roots = [create(content=f'root {i}') for i in range(3)]
+            for root in roots:
+                for i in range(3):
+                    reply = create(root, f'{root.content} reply {i}')
+                    create(reply, f'{reply.content} reply')
+        return roots
+
+    def test_nested_tree(self, api_client, post, thread):
+        response = api_client.get(self.get_url(post), {'depth': 2, 'limit': 2})
+        assert response.status_code == status.HTTP_200_OK
+
+        results = response.data['results']
+        # newest top level comments first, replies oldest first
+        assert [item['content'] for item in results] == ['root 2', 'root 1']
+        assert [item['content'] for item in results[0]['replies']] == [
+            'root 2 reply 0', 'root 2 reply 1']
+        assert results[0]['replies_count'] == 6
+        assert results[0]['replies'][0]['replies'] == []
+        assert results[0]['replies'][0]['replies_count'] == 1
+
+    def test_subtree_of_comment(self, api_client, post, thread):
+        response = api_client.get(
+            self.get_url(post), {'parent': thread[0].id})
+
+        results = response.data['results']
+        assert len(results) == 3
+        assert results[0]['content'] == 'root 0 reply 0'
+        assert results[0]['replies'][0]['content'] == 'root 0 reply 0 reply'
+
+    def test_roots_are_paged(self, api_client, post, thread):
+        response = api_client.get(self.get_url(post), {'depth': 2, 'limit': 2})
+        assert [item['content'] for item in response.data['results']] == [
+            'root 2', 'root 1']
+
+        # the cursor keeps depth and limit
+        response = api_client.get(response.data['next'])
+        results = response.data['results']
+        assert [item['content'] for item in results] == ['root 0']
+        assert [item['content'] for item in results[0]['replies']] == [
+            'root 0 reply 0', 'root 0 reply 1']
+        assert response.data['next'] is None
+
+    def test_replies_of_parent_are_paged(self, api_client, post, thread):
+        response = api_client.get(
+            self.get_url(post), {'parent': thread[1].id, 'limit': 2})
+        assert [item['content'] for item in response.data['results']] == [
+            'root 1 reply 0', 'root 1 reply 1']
+
+        response = api_client.get(response.data['next'])
+        assert [item['content'] for item in response.data['results']] == [
+            'root 1 reply 2']
+
+    def test_unknown_parent(self, api_client, post):
+        response = api_client.get(self.get_url(post), {'parent': 'abc'})
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_votes_in_one_query(self, api_client, test_user, post, thread,
+                                django_assert_num_queries):
         Rating.objects.create(
-            content_type=ContentType.objects.get_for_model(Post),
-            object_id=post.id,
+            content_type=ContentType.objects.get_for_model(Comment),
+            object_id=thread[2].id,
             user=test_user,
-            value=1
+            value=-1
         )
+        api_client.force_authenticate(user=test_user)
+
+        # post, page of roots, their replies and votes
+        with django_assert_num_queries(4):
+            response = api_client.get(self.get_url(post))
+
+        results = response.data['results']
+        assert len(results) == 3
+        assert results[0]['user_vote'] == -1
+        assert results[1]['user_vote'] == 0
+
+
+@pytest.mark.django_db
+class TestCommentSorting:
+    def get_url(self, post):
+        return reverse('post-comments-list', kwargs={'slug': post.slug})
+
+    def create(self, post, author, sum_rating=0, vote_count=0, parent=None):
+        comment = Comment.objects.create(
+            post=post, author=author, content='comment', parent=parent)
+        Comment.objects.filter(pk=comment.pk).update(
+            sum_rating=sum_rating, vote_count=vote_count)
+        return comment.pk
+
+    def collect(self, client, url, params):
+        ids, pages = [], 0
+        while url:
+            response = client.get(url, params)
+            assert response.status_code == status.HTTP_200_OK
+            ids += [item['id'] for item in response.data['results']]
+            url, params, pages = response.data['next'], None, pages + 1
+        return ids, pages
+
+    def test_top_pages_follow_the_index_order(self, api_client, post, test_user):
+        ids = [self.create(post, test_user, sum_rating=value)
+               for value in (3, 5, 3, 0, 5)]
+
+        result, pages = self.collect(
+            api_client, self.get_url(post), {'sort': 'top', 'page_size': 2})
+
+        assert result == [ids[4], ids[1], ids[2], ids[0], ids[3]]
+        assert pages == 3
+
+    def test_controversial(self, api_client, post, test_user):
+        split = self.create(post, test_user, sum_rating=0, vote_count=10)
+        one_sided = self.create(post, test_user, sum_rating=10, vote_count=10)
+        mixed = self.create(post, test_user, sum_rating=4, vote_count=10)
+
+        response = api_client.get(self.get_url(post), {'sort': 'controversial'})
+        assert [item['id'] for item in response.data['results']] == [
+            split, mixed, one_sided]
+
+    def test_old_and_new(self, api_client, post, test_user):
+        ids = [self.create(post, test_user) for _ in range(3)]
+
+        new, _ = self.collect(api_client, self.get_url(post),
+                              {'sort': 'new', 'page_size': 2})
+        old, _ = self.collect(api_client, self.get_url(post),
+                              {'sort': 'old', 'page_size': 2})
+        assert new == ids[::-1]
+        assert old == ids
+
+    def test_replies_sort(self, api_client, post, comment, test_user):
+        low = self.create(post, test_user, sum_rating=1, parent=comment)
+        high = self.create(post, test_user, sum_rating=2, parent=comment)
+
+        url = reverse('post-comment-replies',
+                      kwargs={'slug': post.slug, 'pk': comment.pk})
+        response = api_client.get(url, {'sort': 'top'})
+        assert [item['id'] for item in response.data['results']] == [high, low]
+
+    def test_default_pages_use_stored_count(self, api_client, post, test_user,
+                                            django_assert_num_queries):
+        ids = [self.create(post, test_user) for _ in range(25)]
+        self.create(post, test_user, parent=Comment.objects.get(pk=ids[0]))
+        post.refresh_from_db()
+
+        url, params, result = self.get_url(post), {'page_size': 10}, []
+        while url:
+            # post and comments only, the same for every page
+            with django_assert_num_queries(2) as context:
+                response = api_client.get(url, params)
+            assert not any(
+                query['sql'].startswith('SELECT COUNT(')
+                for query in context.captured_queries
+            )
+            assert response.data['count'] == post.comment_count == 26
+            result += [item['id'] for item in response.data['results']]
+            url, params = response.data['next'], None
+
+        assert result == ids[::-1]
+
+    def test_invalid_sort_and_cursor(self, api_client, post):
+        url = self.get_url(post)
+        response = api_client.get(url, {'sort': 'random'})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+        response = api_client.get(url, {'sort': 'top', 'cursor': 'abc'})
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    @pytest.mark.parametrize('sort, decoded', [
+        ('top', {'sort': 'top'}),
+        ('top', ['top', 1]),
+        ('top', ['top', 1, 2, 3]),
+        ('top', [['top'], 1, 2]),
+        ('top', ['top', 'abc', 2]),
+        ('top', ['top', 1.5, 2]),
+        ('top', ['top', 1, True]),
+        ('top', ['top', 1, '2']),
+        ('new', ['new', 5, 2]),
+        ('new', ['new', 'yesterday', 2]),
+        ('new', ['new', '2024-02-30T10:00:00+00:00', 2]),
+        ('controversial', ['controversial', None, 2]),
+    ])
+    def test_malformed_cursor(self, api_client, post, comment, sort, decoded):
+        cursor = base64.urlsafe_b64encode(json.dumps(decoded).encode()).decode()
+        response = api_client.get(
+            self.get_url(post), {'sort': sort, 'cursor': cursor})
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db(transaction=True)
+def test_benchmark_comment_inserts(post):
+    out = io.StringIO()
+    call_command(
+        'benchmark_comment_inserts', post.slug,
+        thread_size=50, workers=2, inserts=5, stdout=out
+    )
+
+    assert '10 inserts by 2 workers' in out.getvalue()
+    assert Comment.objects.filter(post=post).count() == 60
+    post.refresh_from_db()
+    assert post.comment_count == 60
+
+
+@pytest.mark.django_db
+class TestAnnotations:
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        # pending vote deltas live in redis, not in the test database
+        cache.clear()
+        yield
+        cache.clear()
+
+    def test_post_annotations(self, api_client, post, test_user,
+                              django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            Rating.objects.create(
+                content_type=ContentType.objects.get_for_model(Post),
+                object_id=post.id,
+                user=test_user,
+                value=1
+            )
 
         new_user = CustomUser.objects.create_user(
             username='newuser',
@@ -631,12 +1177,13 @@ class TestAnnotations:
 
         )
 
-        Rating.objects.create(
-            content_type=ContentType.objects.get_for_model(Post),
-            object_id=post.id,
-            user=new_user,
-            value=1
-        )
+        with django_capture_on_commit_callbacks(execute=True):
+            Rating.objects.create(
+                content_type=ContentType.objects.get_for_model(Post),
+                object_id=post.id,
+                user=new_user,
+                value=1
+            )
 
         url = reverse('post-detail', kwargs={'slug': post.slug})
         response = api_client.get(url)
@@ -647,13 +1194,15 @@ class TestAnnotations:
         assert 'user_vote' in response.data
         assert 'comment_count' in response.data
 
-    def test_comment_annotations(self, api_client, post, comment, test_user):
-        Rating.objects.create(
-            content_type=ContentType.objects.get_for_model(Comment),
-            object_id=comment.id,
-            user=test_user,
-            value=1
-        )
+    def test_comment_annotations(self, api_client, post, comment, test_user,
+                                 django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            Rating.objects.create(
+                content_type=ContentType.objects.get_for_model(Comment),
+                object_id=comment.id,
+                user=test_user,
+                value=1
+            )
 
         new_user = CustomUser.objects.create_user(
             username='newuser',
@@ -663,12 +1212,13 @@ class TestAnnotations:
 
         )
 
-        Rating.objects.create(
-            content_type=ContentType.objects.get_for_model(Comment),
-            object_id=comment.id,
-            user=new_user,
-            value=1
-        )
+        with django_capture_on_commit_callbacks(execute=True):
+            Rating.objects.create(
+                content_type=ContentType.objects.get_for_model(Comment),
+                object_id=comment.id,
+                user=new_user,
+                value=1
+            )
 
         url = reverse('post-comments-detail',
                       kwargs={'slug': post.slug, 'pk': comment.pk})
@@ -680,6 +1230,335 @@ class TestAnnotations:
         assert 'user_vote' in response.data
 
 
+@pytest.mark.django_db
+class TestPostPurge:
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+        yield
+        cache.clear()
+
+    def rate(self, obj, user):
+        Rating.objects.create(
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.id,
+            user=user,
+            value=1
+        )
+
+    def test_purge_removes_everything_without_signals(
+            self, api_client, test_user, post, comment, media_file):
+        child = Comment.objects.create(
+            post=post, author=test_user, content='child', parent=comment)
+        Comment.objects.create(
+            post=post, author=test_user, content='grandchild', parent=child)
+        self.rate(post, test_user)
+        self.rate(comment, test_user)
+        self.rate(child, test_user)
+        PostSimilarity.objects.create(post=post, neighbour_ids=[])
+        cache.clear()
+
+        soft_delete_post(post)
+        response = api_client.get(
+            reverse('post-detail', kwargs={'slug': post.slug}))
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+        response = api_client.get(
+            reverse('post-comments-list', kwargs={'slug': post.slug}))
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+        deleted = purge_post(post.id, batch_size=2)
+
+        assert deleted == {
+            'comment ratings': 2,
+            'post ratings': 1,
+            'comments': 3,
+            'media': 1,
+        }
+        assert not Post.objects.filter(id=post.id).exists()
+        assert not Comment.objects.exists()
+        assert not Rating.objects.exists()
+        assert not Media.objects.exists()
+        assert not PostSimilarity.objects.exists()
+        # the file is left to the deletion queue
+        queued = get_redis_connection('default').smembers(DELETION_QUEUE_KEY)
+        assert queued == {media_file.file.name.encode()}
+        # no rating delete signals ran
+        assert get_pending_deltas(Post, [post.id]) == {}
+        assert get_pending_deltas(Comment, [comment.id]) == {}
+
+    def test_live_post_is_not_purged(self, post):
+        assert purge_post(post.id) is None
+        assert Post.objects.filter(id=post.id).exists()
+
+    def test_cannot_vote_on_comments_of_deleted_post(self, api_client, test_user,
+                                                     post, comment):
+        soft_delete_post(post)
+        api_client.force_authenticate(user=test_user)
+
+        response = api_client.post(reverse(
+            'post-comments-ratings',
+            kwargs={'slug': post.slug, 'pk': comment.pk}
+        ), {'value': 1})
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestDeletionJobs:
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+        yield
+        cache.clear()
+
+    @pytest.fixture
+    def other_user(self):
+        return CustomUser.objects.create_user(
+            username='otheruser',
+            email='other@example.com',
+            password='otherpassword',
+            is_active=True
+        )
+
+    def rate(self, obj, user, value=1):
+        # votes are buffered on commit
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            Rating.objects.create(
+                content_type=ContentType.objects.get_for_model(obj),
+                object_id=obj.id,
+                user=user,
+                value=value
+            )
+
+    def test_deleted_community_is_hidden_before_its_job(self, api_client, test_user,
+                                                        other_user, community, post):
+        Membership.objects.create(user=other_user, community=community)
+        communities_url = reverse(
+            'user_communities', kwargs={'slug': other_user.slug})
+        # caches the first page
+        assert len(api_client.get(communities_url).data['results']) == 1
+        post_lists = [
+            reverse('post-list'),
+            reverse('user_posts', kwargs={'slug': test_user.slug}),
+        ]
+        for url in post_lists:
+            assert len(api_client.get(url).data['results']) == 1
+
+        delete_community(community)
+
+        assert api_client.get(communities_url).data['results'] == []
+        for url in post_lists:
+            assert api_client.get(url).data['results'] == []
+        response = api_client.get(
+            reverse('post-detail', kwargs={'slug': post.slug}))
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+        assert get_subscriptions(other_user.id) == ([], [])
+
+    def test_community_deletion(self, api_client, test_user, other_user,
+                                community, post, comment):
+        Membership.objects.create(
+            user=test_user, community=community, role=Membership.Role.CREATOR)
+        Membership.objects.create(user=other_user, community=community)
+        self.rate(post, other_user)
+
+        api_client.force_authenticate(user=test_user)
+        response = api_client.delete(
+            reverse('community-detail', kwargs={'slug': community.slug}))
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        assert not Community.objects.filter(pk=community.pk).exists()
+        # the name can be taken again right away
+        assert Community.all_objects.get(pk=community.pk).name != 'testcommunity'
+
+        job = DeletionJob.objects.get(kind='community', target_id=community.pk)
+        with patch('apps.posts.purge.queue_file_deletion'):
+            run_deletion_job(job.pk)
+
+        job.refresh_from_db()
+        assert job.finished is not None
+        assert job.progress == {'hide_posts': 1, 'posts': 1, 'memberships': 2}
+        assert not Community.all_objects.filter(pk=community.pk).exists()
+        assert not Post.objects.exists()
+        assert not Comment.objects.exists()
+        assert not Membership.objects.exists()
+        assert not Rating.objects.exists()
+
+    def test_user_deletion_in_chunks(self, monkeypatch, test_user, other_user,
+                                     community, post):
+        monkeypatch.setattr('apps.posts.deletion.DELETION_BATCH_SIZE', 2)
+        Membership.objects.create(user=test_user, community=community)
+        Membership.objects.create(user=other_user, community=community)
+        members_count = Community.objects.get(pk=community.pk).members_count
+
+        other_post = Post.objects.create(
+            author=other_user, title='otherpost', community=community)
+        kept = Comment.objects.create(
+            post=other_post, author=other_user, content='kept')
+        for i in range(3):
+            root = Comment.objects.create(
+                post=other_post, author=test_user, content=f'root {i}')
+            Comment.objects.create(
+                post=other_post, author=other_user, content='reply', parent=root)
+        self.rate(other_post, test_user)
+        self.rate(other_post, other_user)
+        self.rate(kept, test_user, value=-1)
+        flush_pending_ratings()
+
+        job = delete_user(test_user)
+        test_user.refresh_from_db()
+        assert not test_user.is_active
+
+        chunks = 0
+        with patch('apps.posts.purge.queue_file_deletion'):
+            while run_deletion_chunk(job.pk) is not None:
+                chunks += 1
+        job.refresh_from_db()
+        assert job.finished is not None
+        assert job.progress == {
+            'hide_posts': 1, 'posts': 1, 'comments': 6,
+            'ratings': 2, 'memberships': 1
+        }
+        # every stage is walked in chunks of two rows
+        assert chunks > len(job.progress) + 4
+
+        assert not CustomUser.objects.filter(pk=test_user.pk).exists()
+        other_post.refresh_from_db()
+        kept.refresh_from_db()
+        assert other_post.comment_count == 1
+        assert list(Comment.objects.values_list('id', flat=True)) == [kept.id]
+        assert (other_post.sum_rating, kept.sum_rating, kept.vote_count) == (1, 0, 0)
+        # the removed upvote is taken out of the windowed top lists too
+        assert PostVoteRollup.objects.filter(
+            post=other_post).aggregate(net=Sum('net'))['net'] == 1
+        assert Community.objects.get(pk=community.pk).members_count == members_count - 1
+
+    def test_job_is_not_started_twice(self, test_user):
+        assert delete_user(test_user) == delete_user(test_user)
+
+    def test_job_held_by_other_worker_is_skipped(self, test_user):
+        job = delete_user(test_user)
+        other = connections.create_connection('default')
+        try:
+            with other.cursor() as cursor:
+                cursor.execute(
+                    'SELECT pg_advisory_lock(%s, %s)',
+                    [DELETION_LOCK_NAMESPACE, job.pk]
+                )
+            assert run_deletion_chunk(job.pk) is None
+            job.refresh_from_db()
+            assert (job.stage, job.progress) == ('hide_posts', {})
+
+            with other.cursor() as cursor:
+                cursor.execute(
+                    'SELECT pg_advisory_unlock(%s, %s)',
+                    [DELETION_LOCK_NAMESPACE, job.pk]
+                )
+        finally:
+            other.close()
+
+        assert run_deletion_chunk(job.pk) is not None
+
+
+@pytest.mark.django_db
+class TestPostCards:
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+        yield
+        cache.clear()
+
+    @pytest.fixture
+    def voter(self):
+        return CustomUser.objects.create_user(
+            username='voter',
+            email='voter@example.com',
+            password='testpassword',
+            is_active=True
+        )
+
+    def test_list_reads_only_the_card_table(self, api_client, post, media_file,
+                                            django_assert_num_queries):
+        url = reverse('post-list')
+        with django_assert_num_queries(1):
+            response = api_client.get(url)
+        card = response.data['results'][0]
+        assert card['id'] == post.id
+        assert card['community_slug'] == post.community.slug
+        assert [m['id'] for m in card['media_data']] == [media_file.id]
+        assert card['media_data'][0]['media_type'] == 'image'
+
+        # counters follow queryset updates of the post
+        Post.objects.filter(id=post.id).update(comment_count=3)
+        response = api_client.get(url)
+        assert response.data['results'][0]['comment_count'] == 3
+
+    def test_migration_backfills_missing_cards(self, post, media_file):
+        migration = importlib.import_module(
+            'apps.posts.migrations.0013_backfill_post_cards')
+        state = MigrationLoader(connection).project_state(
+            ('posts', '0013_backfill_post_cards'))
+        PostCard.objects.all().delete()
+
+        migration.backfill_post_cards(state.apps, None)
+        card = PostCard.objects.get(id=post.id)
+        assert [item['id'] for item in card.media] == [media_file.id]
+        assert card.media == build_post_card(post).media
+
+    def test_cards_follow_source_changes(self, test_user, community, post, media_file):
+        community.name = 'renamed'
+        community.save()
+        test_user.username = 'renameduser'
+        test_user.save()
+        media_file.delete()
+
+        card = PostCard.objects.get(id=post.id)
+        assert card.community_name == 'renamed'
+        assert card.author_name == 'renameduser'
+        assert card.media == []
+
+        post.delete()
+        assert not PostCard.objects.filter(id=post.id).exists()
+
+    def test_backfill_and_check_commands(self, post, comment):
+        PostCard.objects.all().delete()
+        out = io.StringIO()
+        call_command('check_post_cards', stdout=out)
+        assert '1 missing, 0 stale, 0 orphaned' in out.getvalue()
+
+        call_command('backfill_post_cards', stdout=io.StringIO())
+        PostCard.objects.filter(id=post.id).update(title='stale title')
+        PostCard.objects.create(
+            id=post.id + 1000, status='PB', title='orphan', slug='orphan',
+            created=post.created, updated=post.updated,
+            author_id=post.author_id, author_name='', author_slug='',
+            community_id=post.community_id, community_slug='', community_name=''
+        )
+        out = io.StringIO()
+        call_command('check_post_cards', '--fix', stdout=out)
+        assert '0 missing, 1 stale, 1 orphaned' in out.getvalue()
+        assert list(PostCard.objects.values_list('id', 'title')) == [
+            (post.id, post.title)]
+
+    def test_votes_are_merged_per_viewer(self, api_client, test_user, voter, post):
+        Rating.objects.create(
+            content_type=ContentType.objects.get_for_model(Post),
+            object_id=post.id,
+            user=voter,
+            value=-1
+        )
+        url = reverse('user_posts', kwargs={'slug': test_user.slug})
+
+        api_client.force_authenticate(user=voter)
+        response = api_client.get(url)
+        assert response.data['results'][0]['user_vote'] == -1
+
+        # the cached first page must not leak the first viewer's vote
+        api_client.force_authenticate(user=test_user)
+        response = api_client.get(url)
+        assert response.data['results'][0]['user_vote'] == 0
+
+
 @pytest.mark.django_db
 class TestPostMedia:
     def test_media_in_post(self, api_client, post, media_file):
@@ -700,6 +1579,12 @@ class TestPostMedia:
 
 @pytest.mark.django_db
 class TestMediaCompression:
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+        yield
+        cache.clear()
+
     def test_delete_old_s3_file_success(self):
         mock_storage = MagicMock()
         mock_storage.exists.return_value = True
@@ -737,79 +1622,250 @@ class TestMediaCompression:
         result = process_image_to_webp(media_file.id)
         assert f"Image {media_file.id} has no file" in result
 
-    @patch('apps.posts.tasks.pyvips.Image')
-    def test_process_image_skip_compression(self, mock_vips, media_file):
-        mock_image_instance = MagicMock()
-        mock_image_instance.width = 100
-        mock_image_instance.height = 200
-        mock_vips.new_from_file.return_value = mock_image_instance
+    def test_process_image_renders_ladder(self, image_storage, post):
+        media = Media.objects.create(
+            post=post, file=image_upload('photo.jpg', 1600, 900))
+        original = media.file.name
+
+        res = process_image_to_webp(media.id)
+        media.refresh_from_db()
+
+        assert 'Rendered 4 WebP renditions' in res
+        assert media.aspect_ratio == '1600/900'
+        assert (media.width, media.height) == (1600, 900)
+        assert media.dominant_color == '#808080'
+        assert media.placeholder.startswith('data:image/webp;base64,')
+        assert [item['width'] for item in media.renditions] == [320, 640, 1080, 1600]
+        assert media.renditions[0]['height'] == 180
+        assert media.file.name.endswith('.webp')
+        assert media.renditions[-1]['name'] == media.file.name
+        assert all(image_storage.exists(item['name']) for item in media.renditions)
+        flush_file_deletions(image_storage)
+        assert not image_storage.exists(original)
+
+        card = PostCard.objects.get(id=post.id)
+        assert [source['width'] for source in card.media[0]['srcset']] == [320, 640, 1080, 1600]
+
+    def test_process_image_shrinks_large_original(self, image_storage, post):
+        media = Media.objects.create(
+            post=post, file=image_upload('large.png', 3000, 1000))
+
+        process_image_to_webp(media.id)
+        media.refresh_from_db()
+
+        assert media.renditions[-1]['width'] == ORIGINAL_MAX_WIDTH
+        assert media.renditions[-1]['height'] == 853
+
+    def test_process_image_already_webp(self, image_storage, post):
+        media = Media.objects.create(
+            post=post, file=image_upload('small.webp', 200, 100))
+        name = media.file.name
+
+        process_image_to_webp(media.id)
+        media.refresh_from_db()
+
+        assert media.file.name == name
+        assert media.renditions == [{'name': name, 'width': 200, 'height': 100}]
+
+    def test_process_image_gif_keeps_file(self, image_storage, post):
+        media = Media.objects.create(
+            post=post, file=image_upload('anim.gif', 50, 40))
+        name = media.file.name
+
+        res = process_image_to_webp(media.id)
+        media.refresh_from_db()
+
+        assert "Updated dimensions only" in res
+        assert media.aspect_ratio == '50/40'
+        assert (media.width, media.height) == (50, 40)
+        assert media.file.name == name
+        assert media.renditions == []
+
+    def test_srcset_in_post_detail(self, api_client, image_storage, post):
+        media = Media.objects.create(
+            post=post, file=image_upload('photo.jpg', 700, 700))
+        process_image_to_webp(media.id)
 
-        res = process_image_to_webp(media_file.id)
+        url = reverse('post-detail', kwargs={'slug': post.slug})
+        response = api_client.get(url)
 
-        media_file.refresh_from_db()
+        data = response.data['media_data'][0]
+        assert [source['width'] for source in data['srcset']] == [320, 640, 700]
+        assert data['srcset'][0]['url'].startswith('http')
+        assert (data['width'], data['height']) == (700, 700)
+        assert data['dominant_color'] == '#808080'
+        assert data['placeholder'].startswith('data:image/webp;base64,')
 
-        assert media_file.aspect_ratio == "100/200"
-        assert "Updated ratio only" in res
-        mock_image_instance.write_to_buffer.assert_not_called()
+        card = api_client.get(reverse('post-list')).data['results'][0]
+        assert card['media_data'][0]['placeholder'] == data['placeholder']
 
-    def test_process_image_conversion_success(self, media_file):
-        with patch('apps.posts.tasks.Media.objects.get', return_value=media_file) as mock_get_obj, \
-                patch('apps.posts.tasks.os.remove') as mock_os_remove, \
-                patch('apps.posts.tasks.os.path.exists', return_value=True), \
-                patch('apps.posts.tasks.delete_s3_file') as mock_delete_s3, \
-                patch('apps.posts.tasks.pyvips.Image') as mock_vips, \
-                patch('builtins.open', new_callable=MagicMock) as mock_open, \
-                patch('django.db.models.fields.files.FieldFile.size', new_callable=PropertyMock) as mock_size:
 
-            mock_size.return_value = MAX_SIZE_THRESHOLD + 1000
+@pytest.mark.django_db
+class TestDirectUploads:
+    def request_upload(self, api_client, post, name='photo.jpg', content_type='image/jpeg'):
+        response = api_client.post(
+            reverse('post-uploads', kwargs={'slug': post.slug}),
+            {'files': [{'name': name, 'content_type': content_type, 'size': 1000}]},
+            format='json'
+        )
+        assert response.status_code == status.HTTP_201_CREATED
+        return response.data['uploads'][0]
 
-            media_file.file.chunks = MagicMock(return_value=[b'dummy_data'])
+    def finalize(self, api_client, post, tokens):
+        return api_client.post(
+            reverse('post-uploads-finalize', kwargs={'slug': post.slug}),
+            {'tokens': tokens},
+            format='json'
+        )
 
-            media_file.save = MagicMock()
-            media_file.file.save = MagicMock()
+    def test_upload_and_finalize(self, api_client, test_user, post, s3_storage):
+        api_client.force_authenticate(user=test_user)
+        upload = self.request_upload(api_client, post)
+        assert upload['fields']['Content-Type'] == 'image/jpeg'
 
-            mock_vips_instance = MagicMock()
-            mock_vips_instance.width = 800
-            mock_vips_instance.height = 600
-            mock_vips_instance.write_to_buffer.return_value = b'fake_webp_bytes'
-            mock_vips.new_from_file.return_value = mock_vips_instance
+        data = image_upload('photo.jpg', 64, 48).read()
+        response = requests.post(
+            upload['url'], data=upload['fields'], files={'file': ('photo.jpg', data)})
+        assert response.status_code == status.HTTP_204_NO_CONTENT
 
-            old_filename = media_file.file.name
+        response = self.finalize(api_client, post, [upload['token']])
+        assert response.status_code == status.HTTP_201_CREATED
+        media = Media.objects.get(post=post)
+        assert response.data[0]['id'] == media.id
+        assert s3_storage.exists(media.file.name)
 
-            res = process_image_to_webp(media_file.id)
+        # finalizing twice does not duplicate the media
+        response = self.finalize(api_client, post, [upload['token']])
+        assert response.status_code == status.HTTP_201_CREATED
+        assert Media.objects.filter(post=post).count() == 1
 
-            mock_get_obj.assert_called_with(id=media_file.id)
+    def test_finalize_rejects_invalid_objects(self, api_client, test_user, post, s3_storage):
+        api_client.force_authenticate(user=test_user)
+        upload = self.request_upload(api_client, post)
 
-            mock_vips_instance.write_to_buffer.assert_called_with(
-                '.webp', Q=50, strip=True
-            )
+        response = self.finalize(api_client, post, [upload['token']])
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
 
-            assert media_file.file.save.called
-            args, _ = media_file.file.save.call_args
-            assert args[0].endswith('.webp')
+        requests.post(
+            upload['url'], data=upload['fields'], files={'file': ('photo.jpg', b'plain text')})
+        name = signing.loads(upload['token'], salt=UPLOAD_TOKEN_SALT)['name']
+        assert s3_storage.exists(name)
 
-            mock_delete_s3.assert_called_once()
-            del_args, _ = mock_delete_s3.call_args
-            assert del_args[1] == old_filename
+        response = self.finalize(api_client, post, [upload['token']])
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert not s3_storage.exists(name)
 
-            mock_os_remove.assert_called_once()
+        response = self.finalize(api_client, post, ['forged'])
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert not Media.objects.filter(post=post).exists()
+
+    def test_upload_validation(self, api_client, test_user, post, community, s3_storage):
+        other = CustomUser.objects.create_user(
+            username='other', email='other@example.com', password='pass')
+        api_client.force_authenticate(user=other)
+        response = api_client.post(
+            reverse('post-uploads', kwargs={'slug': post.slug}),
+            {'files': [{'name': 'a.jpg', 'content_type': 'image/jpeg', 'size': 10}]},
+            format='json'
+        )
+        assert response.status_code == status.HTTP_403_FORBIDDEN
 
-            assert "Converted to WebP" in res
+        api_client.force_authenticate(user=test_user)
+        response = api_client.post(
+            reverse('post-uploads', kwargs={'slug': post.slug}),
+            {'files': [{'name': 'a.exe', 'content_type': 'image/jpeg', 'size': 10}]},
+            format='json'
+        )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
 
-    @patch('apps.posts.tasks.pyvips.Image')
-    def test_process_image_already_webp(self, mock_vips, post):
-        media_webp = Media.objects.create(
-            post=post,
-            file=SimpleUploadedFile(
-                "existing.webp", b"data", content_type="image/webp")
+        response = api_client.post(
+            reverse('post-uploads', kwargs={'slug': post.slug}),
+            {'files': [{'name': 'a.jpg', 'content_type': 'image/jpeg', 'size': 10}] * 6},
+            format='json'
         )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_uploads_need_s3_storage(self, api_client, test_user, post):
+        api_client.force_authenticate(user=test_user)
+        response = api_client.post(
+            reverse('post-uploads', kwargs={'slug': post.slug}),
+            {'files': [{'name': 'a.jpg', 'content_type': 'image/jpeg', 'size': 10}]},
+            format='json'
+        )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+class TestStorageCleanup:
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        cache.clear()
+        yield
+        cache.clear()
+
+    def queued(self):
+        return {
+            name.decode()
+            for name in get_redis_connection('default').smembers(DELETION_QUEUE_KEY)
+        }
+
+    def test_flush_deletes_in_batches(self, s3_storage):
+        names = [s3_storage.save(f'uploads/media/x/{i}.jpg', ContentFile(b'x')) for i in range(5)]
+        get_redis_connection('default').sadd(DELETION_QUEUE_KEY, *names)
+        client = s3_storage.connection.meta.client
+
+        with patch('apps.services.storage.DELETE_BATCH_SIZE', 2), \
+                patch.object(client, 'delete_objects', wraps=client.delete_objects) as delete_objects:
+            assert flush_file_deletions(s3_storage) == 5
+
+        assert delete_objects.call_count == 3
+        assert not any(s3_storage.exists(name) for name in names)
+        assert self.queued() == set()
+
+    def test_deletes_queue_files_on_commit(
+            self, post, community, image_storage, django_capture_on_commit_callbacks):
+        media = Media.objects.create(
+            post=post, file=image_upload('photo.jpg', 400, 300))
+        process_image_to_webp(media.id)
+        media.refresh_from_db()
+        community.icon = 'uploads/community/icons/2026/01/01/icon.png'
+        community.save()
+        # the replaced original is already queued
+        get_redis_connection('default').delete(DELETION_QUEUE_KEY)
+
+        with django_capture_on_commit_callbacks(execute=True):
+            Media.objects.filter(post=post).delete()
+            Community.all_objects.filter(pk=community.pk).delete()
+
+        assert self.queued() == {
+            media.file.name,
+            *(item['name'] for item in media.renditions),
+            'uploads/community/icons/2026/01/01/icon.png',
+        }
+
+    def test_collect_orphaned_files(self, s3_storage, post, test_user):
+        today = timezone.now().date()
+        day = today.strftime('%Y/%m/%d')
+        kept = s3_storage.save(f'uploads/media/{day}/kept.webp', ContentFile(b'x'))
+        rendition = s3_storage.save(f'uploads/media/{day}/kept_320w.webp', ContentFile(b'x'))
+        orphan = s3_storage.save(f'uploads/media/{day}/orphan.jpg', ContentFile(b'x'))
+        avatar = s3_storage.save(f'uploads/avatars/{day}/old.png', ContentFile(b'x'))
+        Media.objects.create(
+            post=post, file=kept,
+            renditions=[{'name': rendition, 'width': 320, 'height': 200},
+                        {'name': kept, 'width': 640, 'height': 400}]
+        )
+
+        # new objects may belong to an unfinished upload
+        assert collect_orphaned_files(today, s3_storage) == 0
 
-        mock_instance = MagicMock()
-        mock_instance.width = 50
-        mock_instance.height = 50
-        mock_vips.new_from_file.return_value = mock_instance
+        later = timezone.now() + timedelta(days=2)
+        assert collect_orphaned_files(today, s3_storage, now=later, dry_run=True) == 2
+        assert self.queued() == set()
 
-        res = process_image_to_webp(media_webp.id)
+        assert collect_orphaned_files(today, s3_storage, now=later) == 2
+        assert self.queued() == {orphan, avatar}
 
-        assert "Updated ratio only" in res
-        mock_instance.write_to_buffer.assert_not_called()
+        flush_file_deletions(s3_storage)
+        assert s3_storage.exists(kept) and s3_storage.exists(rendition)
+        assert not s3_storage.exists(orphan) and not s3_storage.exists(avatar)
@@ -0,0 +1,155 @@
+"""
+Direct uploads of post media to S3.
+
+Instead of streaming files through a web worker, the client asks for
+presigned POST targets, uploads the files straight to the bucket and
+finalizes them. Each target comes with a signed token naming the post
+and the object key, so finalize only accepts keys the API handed out.
+Finalize checks the size and the magic bytes of every object, creates
+the Media rows and queues the image processing.
+"""
+import io
+import os
+from uuid import uuid4
+
+from botocore.exceptions import ClientError
+from django.core import signing
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+from storages.backends.s3 import S3Storage
+
+from apps.services.utils import validate_magic_mime, delete_s3_file
+
+from .models import Media
+from .serializers import ALLOWED_MIME_TYPES
+from .tasks import start_compression_for_post_media
+
+
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+MAX_POST_MEDIA = 5
+UPLOAD_EXPIRES = 60 * 10
+UPLOAD_TOKEN_SALT = 'posts.media-upload'
+# the client gets some time to upload after the target expires
+UPLOAD_TOKEN_MAX_AGE = UPLOAD_EXPIRES * 2
+MAGIC_HEADER_SIZE = 2048
+
+
+def get_upload_storage():
+    """The media storage, raises ValidationError unless it is S3."""
+    storage = Media._meta.get_field('file').storage
+    if not isinstance(storage, S3Storage):
+        raise ValidationError('Direct uploads need the S3 storage.')
+    return storage
+
+
+def check_media_count(post, count):
+    if post.media_data.count() + count > MAX_POST_MEDIA:
+        raise ValidationError(
+            f'You can upload no more than {MAX_POST_MEDIA} files')
+
+
+def upload_name(filename):
+    """A unique storage name under the upload_to path of Media.file."""
+    ext = os.path.splitext(filename)[1].lower()
+    return Media._meta.get_field('file').generate_filename(
+        None, f'{uuid4().hex}{ext}')
+
+
+def issue_uploads(post, files):
+    """
+    Returns a presigned POST target and a token per file.
+    `files` are validated dicts with name, content_type and size.
+    """
+    storage = get_upload_storage()
+    check_media_count(post, len(files))
+    client = storage.connection.meta.client
+
+    uploads = []
+    for file in files:
+        name = upload_name(file['name'])
+        fields = {'Content-Type': file['content_type']}
+        conditions = [
+            {'Content-Type': file['content_type']},
+            ['content-length-range', 1, MAX_UPLOAD_SIZE],
+        ]
+        if storage.default_acl:
+            fields['acl'] = storage.default_acl
+            conditions.append({'acl': storage.default_acl})
+
+        target = client.generate_presigned_post(
+            Bucket=storage.bucket_name,
+            Key=storage._normalize_name(name),
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=UPLOAD_EXPIRES
+        )
+        uploads.append({
+            'token': signing.dumps(
+                {'post': post.pk, 'name': name}, salt=UPLOAD_TOKEN_SALT),
+            'url': target['url'],
+            'fields': target['fields'],
+        })
+    return uploads
+
+
+def read_upload_token(post, token):
+    try:
+        data = signing.loads(
+            token, salt=UPLOAD_TOKEN_SALT, max_age=UPLOAD_TOKEN_MAX_AGE)
+    except signing.SignatureExpired:
+        raise ValidationError('Upload token has expired.')
+    except signing.BadSignature:
+        raise ValidationError('Invalid upload token.')
+    if data.get('post') != post.pk:
+        raise ValidationError('Upload token belongs to another post.')
+    return data['name']
+
+
+def verify_upload(storage, name):
+    """
+    Checks the size and the type of an uploaded object by its head and
+    first bytes, a rejected object is deleted.
+    """
+    client = storage.connection.meta.client
+    key = storage._normalize_name(name)
+    try:
+        head = client.head_object(Bucket=storage.bucket_name, Key=key)
+    except ClientError:
+        raise ValidationError(f'File {name} was not uploaded.')
+
+    try:
+        if head['ContentLength'] > MAX_UPLOAD_SIZE:
+            raise DjangoValidationError(
+                f'File size cannot exceed {MAX_UPLOAD_SIZE // 1024 // 1024}MB.')
+        header = client.get_object(
+            Bucket=storage.bucket_name,
+            Key=key,
+            Range=f'bytes=0-{MAGIC_HEADER_SIZE - 1}'
+        )['Body'].read()
+        validate_magic_mime(
+            io.BytesIO(header), allowed_mime_types=ALLOWED_MIME_TYPES)
+    except DjangoValidationError as e:
+        delete_s3_file(storage, name)
+        raise ValidationError(e.messages)
+
+
+def finalize_uploads(post, tokens):
+    """Creates Media of uploaded objects and queues their processing."""
+    storage = get_upload_storage()
+    names = list(dict.fromkeys(read_upload_token(post, token) for token in tokens))
+
+    existing = set(
+        Media.objects.filter(post=post, file__in=names).values_list('file', flat=True))
+    new_names = [name for name in names if name not in existing]
+    check_media_count(post, len(new_names))
+
+    for name in new_names:
+        verify_upload(storage, name)
+
+    with transaction.atomic():
+        created = [
+            Media.objects.create(post=post, file=name) for name in new_names]
+        start_compression_for_post_media(
+            post.pk, media_ids=[media.id for media in created])
+    return list(Media.objects.filter(post=post, file__in=names))
@@ -1,29 +1,57 @@
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
-from rest_framework.pagination import PageNumberPagination, CursorPagination
+from rest_framework.pagination import BasePagination, CursorPagination
 from rest_framework.decorators import action
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework import mixins
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.utils.urls import replace_query_param
+
+import base64
+import binascii
+import json
+import math
 
 from django.core.exceptions import PermissionDenied
 from django.db.models import (
     OuterRef, Subquery,
     IntegerField, Value,
+    F, Q, Window
 )
 from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_datetime
 from django.contrib.contenttypes.models import ContentType
-from django.db.models.functions import Coalesce
+from django.db.models.functions import Coalesce, Length, RowNumber
 
 from apps.ratings.models import Rating
+from apps.recommendations.similarity import SIMILAR_POSTS_COUNT
+from apps.ratings.counters import apply_pending_ratings
+from apps.ratings.votes import (
+    post_target,
+    comment_target,
+    upsert_vote,
+    delete_vote
+)
 
-from .models import Post, Comment
+from .models import Post, Comment, PATH_END, PATH_SEGMENT_WIDTH
+from .purge import soft_delete_post
+from .replies import apply_pending_replies
+from .uploads import issue_uploads, finalize_uploads
+from .cards import (
+    published_cards,
+    render_post_cards,
+    render_post_cards_by_ids
+)
 from .serializers import (
     PostDetailSerializer,
     PostListSerializer,
     CommentDetailSerializer,
     RatingSerializer,
-    CommentSummarySerializer
+    CommentSummarySerializer,
+    MediaSerializer,
+    UploadRequestSerializer,
+    FinalizeUploadSerializer
 )
 
 
@@ -52,7 +80,12 @@ def get_annotated_ratings(queryset, request, content_type: ContentType):
 
 
 def get_optimized_post_queryset(request):
-    queryset = Post.published.all().select_related('community')
+    # posts of a deleted community are hidden by its deletion job later
+    queryset = (
+        Post.published
+        .filter(community__is_deleted=False)
+        .select_related('community')
+    )
     post_content_type = ContentType.objects.get_for_model(Post)
 
     queryset = get_annotated_ratings(queryset, request, post_content_type)
@@ -66,6 +99,113 @@ def get_optimized_post_queryset(request):
     return qs
 
 
+def create_vote_response(request, target):
+    serializer = RatingSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+
+    result = upsert_vote(
+        target, request.user, serializer.validated_data['value'])
+    if result is None:
+        raise NotFound()
+
+    rating, created, sum_rating = result
+    return Response({
+        'rating': RatingSerializer(rating).data,
+        'sum_rating': sum_rating,
+        'user_vote': rating.value,
+    }, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+
+def delete_vote_response(request, target):
+    sum_rating = delete_vote(target, request.user)
+    if sum_rating is None:
+        raise NotFound()
+
+    return Response({
+        'sum_rating': sum_rating,
+        'user_vote': 0,
+    }, status=status.HTTP_202_ACCEPTED)
+
+
+def parse_limit(value, default, maximum):
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return default
+    return min(limit, maximum) if limit > 0 else default
+
+
+def get_user_votes(user, model, object_ids):
+    """Returns {object_id: value} of the user's votes with one query."""
+    if not user.is_authenticated or not object_ids:
+        return {}
+    return dict(
+        Rating.objects
+        .filter(
+            content_type=ContentType.objects.get_for_model(model),
+            object_id__in=object_ids,
+            user=user
+        )
+        .values_list('object_id', 'value')
+    )
+
+
+def get_comment_replies(roots, depth=3, limit=10):
+    """
+    Replies under a page of sibling comments, so the tree is `depth`
+    levels deep, at most `limit` oldest ones per parent, ordered by path.
+    """
+    if not roots or depth < 2:
+        return []
+
+    subtrees = Q()
+    for root in roots:
+        subtrees |= Q(path__gt=root.path, path__lt=root.path + PATH_END)
+    max_length = len(roots[0].path) + (depth - 1) * PATH_SEGMENT_WIDTH
+
+    ranked = (
+        Comment.objects
+        .filter(subtrees, post_id=roots[0].post_id)
+        .annotate(path_length=Length('path'))
+        .filter(path_length__lte=max_length)
+        .annotate(rank=Window(
+            RowNumber(),
+            partition_by=F('parent_id'),
+            order_by=F('id').asc()
+        ))
+        .filter(rank__lte=limit)
+        .values('id')
+    )
+
+    return list(
+        Comment.objects
+        .filter(id__in=ranked)
+        .select_related('author')
+        .order_by('path')
+    )
+
+
+def nest_comments(comments, items, root_count):
+    """
+    Builds the reply tree in one pass: the first `root_count` comments are
+    the page of roots, the replies follow ordered by path, so every parent
+    is seen before its replies.
+    """
+    nodes = {}
+    roots = []
+    for position, (comment, item) in enumerate(zip(comments, items)):
+        node = {**item, 'replies': []}
+        if position < root_count:
+            roots.append(node)
+        elif comment.parent_id in nodes:
+            nodes[comment.parent_id]['replies'].append(node)
+        else:
+            # the parent was cut off by the limit
+            continue
+        nodes[comment.id] = node
+    return roots
+
+
 class PostPagination(CursorPagination):
     page_size = 25
     ordering = ('-created', '-id')
@@ -85,6 +225,16 @@ class PostViewSet(viewsets.ModelViewSet):
             return PostListSerializer
         return PostDetailSerializer
 
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(published_cards())
+        return self.get_paginated_response(render_post_cards(request, page))
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        apply_pending_ratings([instance])
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
@@ -96,70 +246,234 @@ class PostViewSet(viewsets.ModelViewSet):
     def perform_destroy(self, instance):
         if self.get_object().author != self.request.user:
             raise PermissionDenied('You cannot delete this post.')
-        instance.delete()
+        soft_delete_post(instance)
+
+    @action(detail=True, methods=['post'], url_path='uploads')
+    def uploads(self, request, slug=None):
+        """Presigned targets for uploading media straight to the storage."""
+        post = self.get_object()
+        if post.author != request.user:
+            raise PermissionDenied('You cannot edit this post.')
+
+        serializer = UploadRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        uploads = issue_uploads(post, serializer.validated_data['files'])
+        return Response({'uploads': uploads}, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['post'], url_path='uploads/finalize')
+    def uploads_finalize(self, request, slug=None):
+        post = self.get_object()
+        if post.author != request.user:
+            raise PermissionDenied('You cannot edit this post.')
+
+        serializer = FinalizeUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        media = finalize_uploads(post, serializer.validated_data['tokens'])
+        return Response(
+            MediaSerializer(media, many=True, context={'request': request}).data,
+            status=status.HTTP_201_CREATED
+        )
 
-    # refactor later
     @action(detail=True, methods=['get', 'post', 'delete'], permission_classes=[IsAuthenticatedOrReadOnly], url_path='ratings')
     def ratings(self, request, slug=None):
-        post = self.get_object()
+        if request.method == 'POST':
+            return create_vote_response(request, post_target(slug))
 
-        if request.method == 'GET':
-            return Response({
-                'sum_rating': post.sum_rating,
-                'user_vote': post.user_vote,
-            })
+        elif request.method == 'DELETE':
+            return delete_vote_response(request, post_target(slug))
 
-        elif request.method == 'POST':
-            serializer = RatingSerializer(
-                data=request.data,
-                context={'request': request, 'view': self}
+        post = self.get_object()
+        apply_pending_ratings([post])
+        return Response({
+            'sum_rating': post.sum_rating,
+            'user_vote': post.user_vote,
+        })
+
+    @action(detail=True, methods=['get'], url_path='related')
+    def related(self, request, slug=None):
+        limit = parse_limit(
+            request.query_params.get('limit'),
+            default=10,
+            maximum=SIMILAR_POSTS_COUNT
+        )
+
+        row = (
+            Post.published
+            .filter(slug=slug)
+            .values_list('id', 'similarity__neighbour_ids')
+            .first()
+        )
+        if row is None:
+            raise NotFound()
+
+        related_ids = (row[1] or [])[:limit]
+        return Response({
+            'results': render_post_cards_by_ids(request, related_ids)
+        })
+
+
+# sort mode -> (field, descending), ties are broken by id
+COMMENT_SORTS = {
+    'new': ('time_created', True),
+    'old': ('time_created', False),
+    'top': ('sum_rating', True),
+    'controversial': ('controversy', True),
+}
+
+
+def encode_keyset_cursor(sort, value, last_id):
+    raw = json.dumps([sort, value, last_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def is_number(value):
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or (isinstance(value, float) and math.isfinite(value))
+
+
+def decode_keyset_cursor(cursor):
+    """Returns (sort, value, last_id) or raises ValueError."""
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(decoded, list) or len(decoded) != 3:
+        raise ValueError('Invalid cursor')
+
+    sort, value, last_id = decoded
+    if not isinstance(sort, str) or sort not in COMMENT_SORTS:
+        raise ValueError('Invalid cursor')
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise ValueError('Invalid cursor')
+
+    field, _ = COMMENT_SORTS[sort]
+    if field == 'time_created':
+        # raises ValueError for a well formed but impossible date
+        value = parse_datetime(value) if isinstance(value, str) else None
+        if value is None:
+            raise ValueError('Invalid cursor')
+    elif not is_number(value) or (field == 'sum_rating' and not isinstance(value, int)):
+        raise ValueError('Invalid cursor')
+    return sort, value, last_id
+
+
+class CommentPagination(BasePagination):
+    """
+    Keyset pagination over (sort field, id) without COUNT queries.
+    A page continues after the last row of the previous one,
+    so it is an index range scan at any depth. Views can provide
+    a stored total with `get_total_count()`.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 50
+    cursor_query_param = 'cursor'
+
+    def get_default_sort(self, view):
+        return view.default_sort
+
+    def get_sort(self, request, view):
+        sort = request.query_params.get('sort', self.get_default_sort(view))
+        if sort not in COMMENT_SORTS:
+            raise ValidationError(
+                {'sort': f'Must be one of: {", ".join(COMMENT_SORTS)}.'})
+        return sort
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.view = view
+        self.sort = self.get_sort(request, view)
+        field, descending = COMMENT_SORTS[self.sort]
+        direction = '-' if descending else ''
+        queryset = queryset.order_by(f'{direction}{field}', f'{direction}id')
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            try:
+                sort, value, last_id = decode_keyset_cursor(cursor)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+            if sort != self.sort:
+                raise NotFound('Invalid cursor')
+
+            op = 'lt' if descending else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{field}__{op}': value})
+                | Q(**{field: value, f'id__{op}': last_id}),
+                **{f'{field}__{op}e': value}
             )
-            serializer.is_valid(raise_exception=True)
 
-            rating_instance = serializer.save()
+        page_size = parse_limit(
+            request.query_params.get(self.page_size_query_param),
+            default=self.page_size,
+            maximum=self.max_page_size
+        )
+        rows = list(queryset[:page_size + 1])
+        page = rows[:page_size]
 
-            post.refresh_from_db()
+        self.next_cursor = None
+        if len(rows) > page_size:
+            last = page[-1]
+            value = getattr(last, field)
+            if field == 'time_created':
+                value = value.isoformat()
+            self.next_cursor = encode_keyset_cursor(self.sort, value, last.id)
+        return page
 
-            return Response({
-                'rating': serializer.data,
-                'sum_rating': post.sum_rating,
-                'user_vote': rating_instance.value,
-            }, status=status.HTTP_201_CREATED if serializer.created else status.HTTP_200_OK)
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.next_cursor)
 
-        elif request.method == 'DELETE':
-            Rating.objects.filter(
-                content_type=ContentType.objects.get_for_model(Post),
-                object_id=post.id,
-                user=request.user
-            ).delete()
+    def get_paginated_response(self, data):
+        response = {'next': self.get_next_link(), 'results': data}
+        if hasattr(self.view, 'get_total_count'):
+            response = {'count': self.view.get_total_count(), **response}
+        return Response(response)
 
-            post.refresh_from_db()
 
-            return Response({
-                'sum_rating': post.sum_rating,
-                'user_vote': 0,
-            }, status=status.HTTP_202_ACCEPTED)
+class CommentTreePagination(CommentPagination):
+    """
+    Pages of the top level comments of a tree, newest first,
+    or of the replies of its `parent`, oldest first.
+    """
+    page_size_query_param = 'limit'
 
+    def __init__(self, default_sort):
+        self.default_sort = default_sort
 
-class CommentPagination(PageNumberPagination):
-    page_size = 10
-    page_size_query_param = 'page_size'
-    max_page_size = 50
+    def get_default_sort(self, view):
+        return self.default_sort
+
+
+class PendingRepliesMixin:
+    """Adds the buffered replies counts to the comments of a page."""
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            apply_pending_replies(page)
+        return page
 
 
-class CommentViewSet(viewsets.ModelViewSet):
+class CommentViewSet(PendingRepliesMixin, viewsets.ModelViewSet):
     serializer_class = CommentDetailSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     pagination_class = CommentPagination
+    default_sort = 'new'
     lookup_field = 'pk'
 
     def get_queryset(self):
         slug = self.kwargs['slug']
-        post = get_object_or_404(Post, slug=slug)
+        self.post = get_object_or_404(
+            Post.visible.only('id', 'comment_count'), slug=slug)
 
         queryset = (
             Comment.objects
-            .filter(post=post)
+            .filter(post=self.post)
             .select_related('author')
             .with_ratings(self.request.user)
             .order_by('-time_created')
@@ -169,67 +483,100 @@ class CommentViewSet(viewsets.ModelViewSet):
             return queryset.filter(parent__isnull=True)
         return queryset
 
+    def get_total_count(self):
+        return self.post.comment_count
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        apply_pending_ratings([instance])
+        apply_pending_replies([instance])
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+
     def perform_create(self, serializer):
         slug = self.kwargs.get('slug')
-        post = get_object_or_404(Post, slug=slug)
+        post = get_object_or_404(Post.visible, slug=slug)
         serializer.save(post=post)
 
+    @action(detail=False, methods=['get'], url_path='tree')
+    def tree(self, request, slug=None):
+        post = get_object_or_404(Post.visible, slug=slug)
+        depth = parse_limit(
+            request.query_params.get('depth'), default=3, maximum=10)
+        limit = parse_limit(
+            request.query_params.get('limit'), default=10, maximum=50)
+
+        root = None
+        parent_id = request.query_params.get('parent')
+        if parent_id is not None:
+            if not parent_id.isdigit():
+                raise NotFound()
+            root = get_object_or_404(
+                Comment.objects.only('id', 'path'), post=post, pk=parent_id)
+
+        queryset = Comment.objects.filter(post=post).select_related('author')
+        if root is not None:
+            queryset = queryset.filter(parent=root)
+        else:
+            queryset = queryset.filter(parent__isnull=True)
+
+        paginator = CommentTreePagination(
+            default_sort='old' if root is not None else 'new')
+        roots = paginator.paginate_queryset(queryset, request, view=self)
+        comments = roots + get_comment_replies(roots, depth, limit)
+
+        apply_pending_ratings(comments)
+        apply_pending_replies(comments)
+        votes = get_user_votes(
+            request.user, Comment, [comment.id for comment in comments])
+        for comment in comments:
+            comment.user_vote = votes.get(comment.id, 0)
+
+        items = CommentSummarySerializer(comments, many=True).data
+        return Response({
+            'next': paginator.get_next_link(),
+            'results': nest_comments(comments, items, len(roots))
+        })
+
     def perform_update(self, serializer):
         if self.get_object().author != self.request.user:
             raise PermissionDenied('You cannot edit this comment.')
         serializer.save()
 
-    # refactor later
     @action(detail=True, methods=['get', 'post', 'delete'], permission_classes=[IsAuthenticatedOrReadOnly], url_path='ratings')
     def ratings(self, request, pk, slug=None):
-        comment = self.get_object()
-
-        if request.method == 'GET':
-            return Response({
-                'sum_rating': comment.sum_rating,
-                'user_vote': comment.user_vote,
-            })
-
-        elif request.method == 'POST':
-            serializer = RatingSerializer(
-                data=request.data,
-                context={'request': request, 'view': self}
-            )
-            serializer.is_valid(raise_exception=True)
-            rating = serializer.save()
-
-            comment = Comment.objects.filter(
-                pk=comment.pk).with_ratings(request.user).first()
+        if request.method in ('POST', 'DELETE') and not pk.isdigit():
+            raise NotFound()
 
-            return Response({
-                'rating': serializer.data,
-                'sum_rating': comment.sum_rating,
-                'user_vote': comment.user_vote,
-            }, status=status.HTTP_201_CREATED if serializer.created else status.HTTP_200_OK)
+        if request.method == 'POST':
+            return create_vote_response(request, comment_target(slug, pk))
 
         elif request.method == 'DELETE':
-            comment.ratings.filter(user=request.user).delete()
-            comment = Comment.objects.filter(
-                pk=comment.pk).with_ratings(request.user).first()
+            return delete_vote_response(request, comment_target(slug, pk))
 
-            return Response({
-                'sum_rating': comment.sum_rating,
-                'user_vote': comment.user_vote,
-            }, status=status.HTTP_202_ACCEPTED)
+        comment = self.get_object()
+        apply_pending_ratings([comment])
+        return Response({
+            'sum_rating': comment.sum_rating,
+            'user_vote': comment.user_vote,
+        })
 
 
-class CommentRepliesViewSet(mixins.ListModelMixin,
+class CommentRepliesViewSet(PendingRepliesMixin,
+                            mixins.ListModelMixin,
                             viewsets.GenericViewSet):
     serializer_class = CommentSummarySerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     pagination_class = CommentPagination
+    default_sort = 'old'
     lookup_field = 'pk'
 
     def get_queryset(self):
         parent_id = self.kwargs['pk']
         return (
             Comment.objects
-            .filter(parent_id=parent_id)
+            .filter(post__slug=self.kwargs['slug'], parent_id=parent_id)
+            .exclude(post__status='DL')
             .select_related('author')
             .with_ratings(self.request.user)
             .order_by('time_created')
@@ -0,0 +1,417 @@
+"""
+Write-behind buffer for rating sums.
+
+Votes only increment a Redis hash (object id -> pending delta),
+a periodic task moves the deltas into `sum_rating` in batches.
+Readers add the pending delta on top of the stored value.
+Models with a `vote_count` field also get the change of the number
+of votes, buffered under `votes:<object id>` in the same hash.
+Models with hourly vote rollups (a `vote_rollups` relation) also buffer
+the delta per hour under `<object id>:<hour start>` in a second hash.
+Models with similar posts (a `similarity` relation) add the ids whose
+votes changed to a set, so the similarity build knows what to redo.
+
+A flush holds a lock per hash, renames the hash into a "flushing" one
+and tags it with a batch id. The id is written to FlushedBatch in the
+same transaction as the deltas, and the flushing hash is only deleted
+while it still carries that id. A batch that is flushed again after a
+crash is found in FlushedBatch and dropped without being applied.
+
+When Redis is down a delta is written straight to the db instead. Drift
+that still gets in, e.g. a vote lost between the commit and the buffer,
+is fixed by the periodic reconcile that recounts the votes.
+"""
+import logging
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError, ResponseError
+
+from apps.recommendations.scoring import hot_key_expression
+
+from .models import FlushedBatch, Rating
+
+logger = logging.getLogger(__name__)
+
+
+FLUSH_BATCH_SIZE = 1000
+VOTES_FIELD_PREFIX = 'votes:'
+BATCH_FIELD = 'batch'
+FLUSH_LOCK_TIMEOUT = 300
+FLUSHED_BATCH_RETENTION = timedelta(days=1)
+RECONCILE_BATCH_SIZE = 1000
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+DROP_BATCH_SCRIPT = """
+if redis.call('hget', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def pending_key(model):
+    return f'ratings:pending:{model._meta.model_name}'
+
+
+def flushing_key(model):
+    return f'{pending_key(model)}:flushing'
+
+
+def rollup_pending_key(model):
+    return f'ratings:hourly:{model._meta.model_name}'
+
+
+def changed_key(model):
+    return f'ratings:changed:{model._meta.model_name}'
+
+
+def counts_votes(model):
+    return any(field.name == 'vote_count' for field in model._meta.fields)
+
+
+def rolls_up_votes(model):
+    return any(
+        relation.name == 'vote_rollups'
+        for relation in model._meta.related_objects
+    )
+
+
+def has_hot_key(model):
+    return any(field.name == 'hot_key' for field in model._meta.fields)
+
+
+def tracks_changes(model):
+    return any(
+        relation.name == 'similarity'
+        for relation in model._meta.related_objects
+    )
+
+
+def hour_start(timestamp):
+    return int(timestamp) // 3600 * 3600
+
+
+def record_rating_delta(model, object_id, delta, votes=0):
+    """
+    Buffers a vote delta and the change of the number of votes,
+    returns the total pending delta of the object.
+    """
+    r = get_redis_connection('default')
+    pipe = r.pipeline(transaction=False)
+    pipe.hincrby(pending_key(model), object_id, delta)
+    if votes and counts_votes(model):
+        pipe.hincrby(
+            pending_key(model), f'{VOTES_FIELD_PREFIX}{object_id}', votes)
+    if delta and rolls_up_votes(model):
+        pipe.hincrby(
+            rollup_pending_key(model),
+            f'{object_id}:{hour_start(time.time())}',
+            delta
+        )
+    if (delta or votes) and tracks_changes(model):
+        pipe.sadd(changed_key(model), object_id)
+    pipe.hget(flushing_key(model), object_id)
+    results = pipe.execute()
+    return results[0] + int(results[-1] or 0)
+
+
+def apply_rating_delta_now(model, object_id, delta, votes=0):
+    """Writes a vote delta straight to the db, with the hot key of posts."""
+    apply_rating_deltas(model, [(object_id, delta, votes)])
+    if has_hot_key(model):
+        model.objects.filter(pk=object_id).update(hot_key=hot_key_expression())
+
+
+def buffer_rating_delta(model, object_id, delta, votes=0):
+    """
+    record_rating_delta that writes the delta through when Redis is down.
+    Returns the pending delta of the object, or the delta itself once
+    it is in the db.
+    """
+    try:
+        return record_rating_delta(model, object_id, delta, votes=votes)
+    except RedisError as e:
+        logger.warning(
+            f'Failed to buffer a vote of {model._meta.model_name} {object_id}, '
+            f'writing it through: {e}')
+        apply_rating_delta_now(model, object_id, delta, votes=votes)
+        return delta
+
+
+def get_pending_deltas(model, object_ids):
+    """
+    Returns {object_id: delta} for deltas that are not in the db yet,
+    including the batch that is being flushed right now.
+    """
+    object_ids = list(object_ids)
+    if not object_ids:
+        return {}
+
+    try:
+        r = get_redis_connection('default')
+        pipe = r.pipeline(transaction=False)
+        pipe.hmget(pending_key(model), object_ids)
+        pipe.hmget(flushing_key(model), object_ids)
+        pending, flushing = pipe.execute()
+    except RedisError as e:
+        logger.warning(f'Failed to read pending rating deltas: {e}')
+        return {}
+
+    deltas = {}
+    for object_id, a, b in zip(object_ids, pending, flushing):
+        delta = int(a or 0) + int(b or 0)
+        if delta:
+            deltas[object_id] = delta
+    return deltas
+
+
+def apply_pending_ratings(objects):
+    """Adds pending deltas to `sum_rating` of already loaded objects."""
+    objects = list(objects)
+    if not objects:
+        return objects
+
+    model = type(objects[0])
+    deltas = get_pending_deltas(model, [obj.pk for obj in objects])
+    for obj in objects:
+        obj.sum_rating += deltas.get(obj.pk, 0)
+    return objects
+
+
+@contextmanager
+def flush_lock(key, timeout=FLUSH_LOCK_TIMEOUT):
+    """
+    Yields True if the flush lock of a hash was taken, False if another
+    flush holds it. Only the owner releases the lock.
+    """
+    r = get_redis_connection('default')
+    lock_key = f'{key}:lock'
+    token = uuid.uuid4().hex
+    acquired = r.set(lock_key, token, nx=True, ex=timeout)
+    try:
+        yield bool(acquired)
+    finally:
+        if acquired:
+            r.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+
+def take_batch(key, in_flight):
+    """
+    Moves the pending hash into the flushing one unless a failed batch is
+    still there. Returns (batch_id, {field: value}) or (None, {}).
+    """
+    r = get_redis_connection('default')
+    if not r.exists(in_flight):
+        try:
+            # never overwrites a batch that appeared meanwhile
+            r.renamenx(key, in_flight)
+        except ResponseError:
+            # nothing pending
+            return None, {}
+
+    r.hsetnx(in_flight, BATCH_FIELD, uuid.uuid4().hex)
+    fields = {
+        field.decode(): int(value)
+        for field, value in r.hgetall(in_flight).items()
+        if field.decode() != BATCH_FIELD
+    }
+    batch_id = r.hget(in_flight, BATCH_FIELD)
+    if batch_id is None:
+        # dropped by a flush that outlived its lock
+        return None, {}
+    return batch_id.decode(), fields
+
+
+def record_batch(batch_id):
+    """
+    Records a flushed batch, returns False if it is already in the db.
+    Has to run in the transaction that applies the batch.
+    """
+    table = connection.ops.quote_name(FlushedBatch._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (batch_id, created) VALUES (%s, %s) '
+            f'ON CONFLICT (batch_id) DO NOTHING RETURNING id',
+            [batch_id, timezone.now()]
+        )
+        return cursor.fetchone() is not None
+
+
+def drop_batch(in_flight, batch_id):
+    """Deletes the flushing hash if it still holds the batch."""
+    get_redis_connection('default').eval(
+        DROP_BATCH_SCRIPT, 1, in_flight, BATCH_FIELD, batch_id)
+
+
+def flush_batch(key, apply):
+    """
+    Flushes a buffer hash under its lock: apply({field: value}) runs in
+    one transaction with the batch record. Returns the fields of the
+    batch, or None if another flush holds the lock.
+    """
+    in_flight = f'{key}:flushing'
+    with flush_lock(key) as acquired:
+        if not acquired:
+            return None
+
+        batch_id, fields = take_batch(key, in_flight)
+        if batch_id is None:
+            return {}
+
+        with transaction.atomic():
+            if record_batch(batch_id):
+                apply(fields)
+            else:
+                logger.warning(f'Skipped already flushed batch {batch_id} of {key}')
+
+        drop_batch(in_flight, batch_id)
+        return fields
+
+
+def prune_flushed_batches(now=None):
+    """Deletes batch records older than FLUSHED_BATCH_RETENTION."""
+    cutoff = (now or timezone.now()) - FLUSHED_BATCH_RETENTION
+    deleted, _ = FlushedBatch.objects.filter(created__lt=cutoff).delete()
+    return deleted
+
+
+def apply_rating_deltas(model, items):
+    """
+    Applies [(object_id, delta, votes), ...] with one
+    UPDATE ... FROM (VALUES ...) statement per batch.
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    assignments = 'sum_rating = t.sum_rating + v.delta'
+    if counts_votes(model):
+        assignments += ', vote_count = t.vote_count + v.votes'
+    # a stable order keeps concurrent flushes from deadlocking
+    items = sorted(items)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(items), FLUSH_BATCH_SIZE):
+            batch = items[start:start + FLUSH_BATCH_SIZE]
+            values = ', '.join(['(%s, %s, %s)'] * len(batch))
+            params = [value for item in batch for value in item]
+            cursor.execute(
+                f'UPDATE {table} AS t '
+                f'SET {assignments} '
+                f'FROM (VALUES {values}) AS v(id, delta, votes) '
+                f'WHERE t.id = v.id',
+                params
+            )
+
+
+def parse_rating_deltas(fields):
+    """[(object_id, delta, votes), ...] of the fields of a rating hash."""
+    deltas = defaultdict(lambda: [0, 0])
+    for field, value in fields.items():
+        prefix, _, object_id = field.rpartition(':')
+        deltas[int(object_id)][1 if prefix else 0] += value
+
+    return [
+        (object_id, delta, votes)
+        for object_id, (delta, votes) in deltas.items()
+        if delta or votes
+    ]
+
+
+def flush_rating_deltas(model):
+    """
+    Moves pending deltas of a model into the db, returns the updated ids.
+    A batch that failed to flush stays in the flushing hash and
+    is retried before new deltas are taken.
+    """
+    def apply(fields):
+        items = parse_rating_deltas(fields)
+        if items:
+            apply_rating_deltas(model, items)
+
+    fields = flush_batch(pending_key(model), apply)
+    return [object_id for object_id, _, _ in parse_rating_deltas(fields or {})]
+
+
+def pending_object_ids(model, object_ids):
+    """Ids with any buffered delta, the flushing batch included."""
+    fields = list(object_ids)
+    if counts_votes(model):
+        fields += [f'{VOTES_FIELD_PREFIX}{object_id}' for object_id in object_ids]
+
+    r = get_redis_connection('default')
+    pipe = r.pipeline(transaction=False)
+    pipe.hmget(pending_key(model), fields)
+    pipe.hmget(flushing_key(model), fields)
+    pending, flushing = pipe.execute()
+
+    return {
+        int(str(field).rpartition(':')[2])
+        for field, a, b in zip(fields, pending, flushing)
+        if int(a or 0) or int(b or 0)
+    }
+
+
+def reconcile_ratings(model):
+    """
+    Sets sum_rating (and vote_count) of drifted objects to their votes,
+    one batch at a time, returns the fixed ids. A batch is fixed under
+    the flush lock and objects with buffered deltas are skipped; a batch
+    whose lock is taken is left to the next run.
+    """
+    votes = (
+        Rating.objects
+        .filter(
+            content_type=ContentType.objects.get_for_model(model),
+            object_id=OuterRef('pk')
+        )
+        .order_by()
+        .values('object_id')
+    )
+    actual = {'sum_rating': Coalesce(Subquery(
+        votes.annotate(total=Sum('value')).values('total')), 0)}
+    if counts_votes(model):
+        actual['vote_count'] = Coalesce(Subquery(
+            votes.annotate(count=Count('id')).values('count')), 0)
+
+    fixed = []
+    last_id = 0
+    while True:
+        object_ids = list(
+            model.objects
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .values_list('id', flat=True)[:RECONCILE_BATCH_SIZE]
+        )
+        if not object_ids:
+            break
+        last_id = object_ids[-1]
+
+        with flush_lock(pending_key(model)) as acquired:
+            if not acquired:
+                continue
+            settled = set(object_ids) - pending_object_ids(model, object_ids)
+            drifted = list(
+                model.objects
+                .filter(id__in=settled)
+                .annotate(**{f'actual_{name}': value for name, value in actual.items()})
+                .exclude(**{name: F(f'actual_{name}') for name in actual})
+                .values_list('id', flat=True)
+            )
+            if drifted:
+                model.objects.filter(id__in=drifted).update(**actual)
+                fixed += drifted
+
+    return fixed
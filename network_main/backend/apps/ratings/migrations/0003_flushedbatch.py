@@ -0,0 +1,26 @@
+# Generated by Django 5.2.14 on 2026-10-17 21:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ratings', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlushedBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch_id', models.CharField(max_length=32, unique=True, verbose_name='Batch id')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Time created')),
+            ],
+            options={
+                'verbose_name': 'Flushed batch',
+                'verbose_name_plural': 'Flushed batches',
+                'db_table': 'api_network_flushed_batch',
+            },
+        ),
+    ]
@@ -43,3 +43,37 @@ class Rating(models.Model):
 
     def __str__(self):
         return f'{self.content_object} - {self.value}'
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.set_loaded_value()
+        return instance
+
+    def set_loaded_value(self):
+        """Remembers the value stored in the db to compute vote deltas"""
+        self._loaded_value = self.__dict__.get('value')
+
+    def get_loaded_value(self):
+        return getattr(self, '_loaded_value', None) or 0
+
+
+class FlushedBatch(models.Model):
+    """
+    A batch of buffered vote deltas that is already in the db.
+    Written in the same transaction as the deltas, so a batch
+    that is flushed again is not applied twice.
+    """
+
+    batch_id = models.CharField(
+        max_length=32, unique=True, verbose_name='Batch id')
+    created = models.DateTimeField(
+        auto_now_add=True, db_index=True, verbose_name='Time created')
+
+    class Meta:
+        db_table = 'api_network_flushed_batch'
+        verbose_name = 'Flushed batch'
+        verbose_name_plural = 'Flushed batches'
+
+    def __str__(self):
+        return self.batch_id
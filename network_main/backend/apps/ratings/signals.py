@@ -1,40 +1,48 @@
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from django.db.models import Sum, Value
-from django.db.models.functions import Coalesce
+from django.contrib.contenttypes.models import ContentType
 
 from apps.posts.models import Post, Comment
 from apps.ratings.models import Rating
 
+from .counters import buffer_rating_delta
 
-def update_object_rating(object_id, model):
-    try:
-        object = model.objects.get(pk=object_id)
 
-        new_sum = object.ratings.aggregate(
-            total=Coalesce(Sum('value'), Value(0))
-        )['total']
+RATED_MODELS = (Post, Comment)
 
-        model.objects.filter(pk=object_id).update(sum_rating=new_sum)
-    except model.DoesNotExist:
-        pass
 
-
-@receiver(post_save, sender=Rating)
-def on_post_rating_save(sender, instance, **kwargs):
-    update_object_rating(instance.object_id, Post)
+def get_rated_model(instance):
+    model = ContentType.objects.get_for_id(
+        instance.content_type_id).model_class()
+    return model if model in RATED_MODELS else None
 
 
-@receiver(post_delete, sender=Rating)
-def on_post_rating_delete(sender, instance, **kwargs):
-    update_object_rating(instance.object_id, Post)
+def buffer_on_commit(model, object_id, delta, votes):
+    """Buffers the delta once the vote is committed, a rollback drops it."""
+    transaction.on_commit(
+        lambda: buffer_rating_delta(model, object_id, delta, votes=votes))
 
 
 @receiver(post_save, sender=Rating)
-def on_comment_rating_save(sender, instance, **kwargs):
-    update_object_rating(instance.object_id, Comment)
+def on_rating_save(sender, instance, created, **kwargs):
+    model = get_rated_model(instance)
+    if model is None:
+        return
+
+    previous = 0 if created else instance.get_loaded_value()
+    buffer_on_commit(
+        model, instance.object_id, instance.value - previous,
+        votes=1 if created else 0
+    )
+    instance.set_loaded_value()
 
 
 @receiver(post_delete, sender=Rating)
-def on_comment_rating_delete(sender, instance, **kwargs):
-    update_object_rating(instance.object_id, Comment)
+def on_rating_delete(sender, instance, **kwargs):
+    model = get_rated_model(instance)
+    if model is None:
+        return
+
+    buffer_on_commit(
+        model, instance.object_id, -instance.get_loaded_value(), votes=-1)
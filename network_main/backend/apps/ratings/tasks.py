@@ -0,0 +1,52 @@
+from celery import shared_task
+
+from apps.posts.models import Post, Comment
+from apps.recommendations.scoring import mark_posts_dirty, hot_key_expression
+from apps.recommendations.rollups import flush_vote_rollups
+
+from .counters import (
+    flush_rating_deltas,
+    prune_flushed_batches,
+    reconcile_ratings
+)
+
+
+@shared_task
+def flush_pending_ratings():
+    """
+    A periodic task that moves buffered vote deltas into sum_rating.
+    """
+    post_ids = flush_rating_deltas(Post)
+    comment_ids = flush_rating_deltas(Comment)
+    buckets = flush_vote_rollups()
+    prune_flushed_batches()
+
+    if post_ids:
+        Post.objects.filter(id__in=post_ids).update(
+            hot_key=hot_key_expression())
+        mark_posts_dirty(post_ids)
+
+    return (
+        f'Flushed ratings of {len(post_ids)} posts '
+        f'and {len(comment_ids)} comments, {buckets} vote buckets'
+    )
+
+
+@shared_task
+def reconcile_rating_sums():
+    """
+    A periodic task that fixes drift of sum_rating and vote_count
+    from the actual votes of posts and comments.
+    """
+    post_ids = reconcile_ratings(Post)
+    comment_ids = reconcile_ratings(Comment)
+
+    if post_ids:
+        Post.objects.filter(id__in=post_ids).update(
+            hot_key=hot_key_expression())
+        mark_posts_dirty(post_ids)
+
+    return (
+        f'Fixed ratings of {len(post_ids)} posts '
+        f'and {len(comment_ids)} comments'
+    )
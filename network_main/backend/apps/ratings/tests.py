@@ -1,3 +1,459 @@
+import pytest
+import threading
+import time
+
+from django.db import connection, connections, transaction
 from django.test import TestCase
+from django.urls import reverse
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+
+from rest_framework.test import APIClient
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from apps.users.models import CustomUser
+from apps.communities.models import Community
+from apps.posts.models import Post, Comment
+from apps.ratings.models import Rating, FlushedBatch
+from apps.ratings import counters
+from apps.ratings.counters import (
+    pending_key,
+    flushing_key,
+    get_pending_deltas,
+    flush_rating_deltas
+)
+from apps.ratings.tasks import flush_pending_ratings, reconcile_rating_sums
+from apps.ratings.votes import upsert_vote, post_target
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.fixture
+def test_user():
+    return CustomUser.objects.create_user(
+        username='testuser',
+        email='test@example.com',
+        password='testpassword',
+        is_active=True
+    )
+
+
+@pytest.fixture
+def other_user():
+    return CustomUser.objects.create_user(
+        username='otheruser',
+        email='other@example.com',
+        password='testpassword',
+        is_active=True
+    )
+
+
+@pytest.fixture
+def post(test_user):
+    community = Community.objects.create(
+        creator=test_user,
+        name='testcommunity',
+        slug='testcommunity',
+    )
+    return Post.objects.create(
+        author=test_user,
+        title='testpost',
+        community=community
+    )
+
+
+@pytest.fixture
+def comment(test_user, post):
+    return Comment.objects.create(
+        post=post,
+        author=test_user,
+        content='testcomment'
+    )
+
+
+def committed():
+    """Runs the on_commit callbacks of the block, tests never commit"""
+    return TestCase.captureOnCommitCallbacks(execute=True)
+
+
+def rate(obj, user, value):
+    with committed():
+        return Rating.objects.create(
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.id,
+            user=user,
+            value=value
+        )
+
+
+@pytest.mark.django_db
+class TestWriteBehindRatings:
+
+    def test_vote_is_buffered_until_flush(self, post, test_user, other_user):
+        rate(post, test_user, 1)
+        rate(post, other_user, 1)
+
+        post.refresh_from_db()
+        assert post.sum_rating == 0
+        assert get_pending_deltas(Post, [post.id]) == {post.id: 2}
+
+        flush_pending_ratings()
+
+        post.refresh_from_db()
+        assert post.sum_rating == 2
+        assert get_pending_deltas(Post, [post.id]) == {}
+
+    def test_changed_and_deleted_votes_record_deltas(self, post, test_user):
+        rating = rate(post, test_user, 1)
+
+        rating.value = -1
+        with committed():
+            rating.save()
+        assert get_pending_deltas(Post, [post.id]) == {post.id: -1}
+
+        with committed():
+            Rating.objects.get(pk=rating.pk).delete()
+        assert get_pending_deltas(Post, [post.id]) == {}
+
+    def test_rolled_back_vote_is_not_buffered(self, post, test_user):
+        with committed(), pytest.raises(RuntimeError):
+            with transaction.atomic():
+                Rating.objects.create(
+                    content_type=ContentType.objects.get_for_model(post),
+                    object_id=post.id,
+                    user=test_user,
+                    value=1
+                )
+                raise RuntimeError('rolled back')
+
+        assert get_pending_deltas(Post, [post.id]) == {}
+
+    def test_vote_is_saved_without_redis(self, post, test_user, monkeypatch):
+        def fail(*args, **kwargs):
+            raise RedisError('redis is down')
+
+        monkeypatch.setattr(counters, 'record_rating_delta', fail)
+        rate(post, test_user, 1)
+        assert Rating.objects.filter(user=test_user).exists()
+
+        # written through instead of buffered
+        post.refresh_from_db()
+        assert post.sum_rating == 1
+        assert post.hot_key > 0
+
+    def test_stale_save_keeps_counters(self, post, comment, test_user):
+        stale_post = Post.objects.get(pk=post.pk)
+        stale_comment = Comment.objects.get(pk=comment.pk)
+        rate(post, test_user, 1)
+        rate(comment, test_user, 1)
+        flush_pending_ratings()
+
+        stale_post.title = 'edited post'
+        stale_post.save()
+        stale_comment.content = 'edited'
+        stale_comment.save()
+
+        post.refresh_from_db()
+        comment.refresh_from_db()
+        assert (post.title, post.sum_rating) == ('edited post', 1)
+        assert (comment.content, comment.sum_rating, comment.vote_count) == (
+            'edited', 1, 1)
+
+    def test_reconcile_fixes_drift(self, post, comment, test_user, other_user):
+        rate(post, test_user, 1)
+        rate(comment, test_user, -1)
+        flush_pending_ratings()
+        Post.objects.filter(pk=post.pk).update(sum_rating=7)
+        Comment.objects.filter(pk=comment.pk).update(sum_rating=3, vote_count=5)
+
+        assert reconcile_rating_sums() == 'Fixed ratings of 1 posts and 1 comments'
+        post.refresh_from_db()
+        comment.refresh_from_db()
+        assert post.sum_rating == 1
+        assert (comment.sum_rating, comment.vote_count) == (-1, 1)
+        assert reconcile_rating_sums() == 'Fixed ratings of 0 posts and 0 comments'
+
+    def test_reconcile_skips_buffered_votes(self, post, test_user, other_user):
+        rate(post, test_user, 1)
+        flush_pending_ratings()
+        rate(post, other_user, 1)
+
+        assert reconcile_rating_sums() == 'Fixed ratings of 0 posts and 0 comments'
+        flush_pending_ratings()
+        post.refresh_from_db()
+        assert post.sum_rating == 2
+
+    def test_comment_votes_do_not_touch_posts(self, post, comment, test_user):
+        rate(comment, test_user, -1)
+        flush_pending_ratings()
+
+        post.refresh_from_db()
+        comment.refresh_from_db()
+        assert post.sum_rating == 0
+        assert comment.sum_rating == -1
+
+    def test_comment_vote_count_is_buffered(self, authenticated_client,
+                                            comment, test_user, other_user):
+        url = reverse(
+            'post-comments-ratings',
+            kwargs={'slug': comment.post.slug, 'pk': comment.pk}
+        )
+        rate(comment, other_user, -1)
+        authenticated_client.post(url, {'value': 1})
+        authenticated_client.post(url, {'value': -1})
+        flush_pending_ratings()
+
+        comment.refresh_from_db()
+        assert comment.vote_count == 2
+        assert comment.sum_rating == -2
+
+        authenticated_client.delete(url)
+        with committed():
+            Rating.objects.get(user=other_user).delete()
+        flush_pending_ratings()
+
+        comment.refresh_from_db()
+        assert comment.vote_count == 0
+        assert comment.sum_rating == 0
+
+    def test_failed_flush_is_retried(self, post, test_user, other_user, monkeypatch):
+        rate(post, test_user, 1)
+
+        def fail(model, items):
+            raise RuntimeError('db is down')
+
+        monkeypatch.setattr(counters, 'apply_rating_deltas', fail)
+        with pytest.raises(RuntimeError):
+            flush_rating_deltas(Post)
+        monkeypatch.undo()
+
+        r = get_redis_connection('default')
+        assert r.exists(flushing_key(Post))
+
+        # a vote during the outage goes to the next batch
+        rate(post, other_user, 1)
+        assert get_pending_deltas(Post, [post.id]) == {post.id: 2}
+
+        flush_rating_deltas(Post)
+        post.refresh_from_db()
+        assert post.sum_rating == 1
+        assert r.exists(pending_key(Post))
+
+        flush_rating_deltas(Post)
+        post.refresh_from_db()
+        assert post.sum_rating == 2
+
+    def test_flush_waits_for_running_flush(self, post, test_user):
+        rate(post, test_user, 1)
+
+        with counters.flush_lock(pending_key(Post)) as acquired:
+            assert acquired
+            assert flush_rating_deltas(Post) == []
+
+        post.refresh_from_db()
+        assert post.sum_rating == 0
+        assert flush_rating_deltas(Post) == [post.id]
+        post.refresh_from_db()
+        assert post.sum_rating == 1
+
+    def test_committed_batch_is_not_applied_twice(self, post, test_user, monkeypatch):
+        rate(post, test_user, 1)
+
+        def crash(in_flight, batch_id):
+            raise RuntimeError('worker died')
+
+        monkeypatch.setattr(counters, 'drop_batch', crash)
+        with pytest.raises(RuntimeError):
+            flush_rating_deltas(Post)
+        monkeypatch.undo()
+
+        r = get_redis_connection('default')
+        assert r.exists(flushing_key(Post))
+        assert FlushedBatch.objects.count() == 1
+
+        flush_rating_deltas(Post)
+        post.refresh_from_db()
+        assert post.sum_rating == 1
+        assert not r.exists(flushing_key(Post))
+
+    def test_detail_includes_pending_votes(self, post, test_user):
+        rate(post, test_user, 1)
+
+        response = APIClient().get(
+            reverse('post-detail', kwargs={'slug': post.slug}))
+        assert response.data['sum_rating'] == 1
+
+
+@pytest.fixture
+def authenticated_client(test_user):
+    client = APIClient()
+    client.force_authenticate(user=test_user)
+    return client
+
+
+@pytest.mark.django_db
+class TestVoteEndpoints:
+
+    def post_url(self, post):
+        return reverse('post-ratings', kwargs={'slug': post.slug})
+
+    def comment_url(self, comment):
+        return reverse(
+            'post-comments-ratings',
+            kwargs={'slug': comment.post.slug, 'pk': comment.pk}
+        )
+
+    def test_vote_is_one_statement(self, authenticated_client, post,
+                                   django_assert_num_queries):
+        ContentType.objects.get_for_model(Post)
+
+        with django_assert_num_queries(1):
+            response = authenticated_client.post(
+                self.post_url(post), {'value': 1})
+
+        assert response.status_code == 201
+        assert response.data['sum_rating'] == 1
+        assert response.data['user_vote'] == 1
+        assert response.data['rating']['value'] == 1
+
+        with django_assert_num_queries(1):
+            response = authenticated_client.post(
+                self.post_url(post), {'value': -1})
+
+        assert response.status_code == 200
+        assert response.data['sum_rating'] == -1
+
+        with django_assert_num_queries(1):
+            response = authenticated_client.delete(self.post_url(post))
+
+        assert response.status_code == 202
+        assert response.data['sum_rating'] == 0
+        assert not Rating.objects.exists()
+
+    def test_vote_adds_to_stored_sum(self, authenticated_client, post, other_user):
+        rate(post, other_user, 1)
+        flush_pending_ratings()
+
+        response = authenticated_client.post(self.post_url(post), {'value': 1})
+        assert response.data['sum_rating'] == 2
+
+        flush_pending_ratings()
+        post.refresh_from_db()
+        assert post.sum_rating == 2
+
+    def test_vote_without_redis(self, authenticated_client, post, monkeypatch):
+        def fail(*args, **kwargs):
+            raise RedisError('redis is down')
+
+        monkeypatch.setattr(counters, 'record_rating_delta', fail)
+
+        response = authenticated_client.post(self.post_url(post), {'value': 1})
+        assert response.status_code == 201
+        assert response.data['sum_rating'] == 1
+        post.refresh_from_db()
+        assert post.sum_rating == 1
+
+        response = authenticated_client.delete(self.post_url(post))
+        assert response.data['sum_rating'] == 0
+        post.refresh_from_db()
+        assert post.sum_rating == 0
+
+    def test_comment_vote(self, authenticated_client, post, comment,
+                          django_assert_num_queries):
+        ContentType.objects.get_for_model(Comment)
+
+        with django_assert_num_queries(1):
+            response = authenticated_client.post(
+                self.comment_url(comment), {'value': -1})
+
+        assert response.status_code == 201
+        assert response.data['sum_rating'] == -1
+        assert get_pending_deltas(Post, [post.id]) == {}
+
+    def test_vote_on_comment_of_other_post(self, authenticated_client, post,
+                                           comment, test_user):
+        other_post = Post.objects.create(
+            author=test_user,
+            title='otherpost',
+            community=post.community
+        )
+        url = reverse(
+            'post-comments-ratings',
+            kwargs={'slug': other_post.slug, 'pk': comment.pk}
+        )
+        response = authenticated_client.post(url, {'value': 1})
+        assert response.status_code == 404
+        assert not Rating.objects.exists()
+
+    def test_invalid_vote_value(self, authenticated_client, post):
+        response = authenticated_client.post(self.post_url(post), {'value': 5})
+        assert response.status_code == 400
+        assert not Rating.objects.exists()
+
+
+def wait_for_lock_waiters(count, timeout=5):
+    deadline = time.monotonic() + timeout
+    with connection.cursor() as cursor:
+        while time.monotonic() < deadline:
+            cursor.execute(
+                "SELECT COUNT(*) FROM pg_stat_activity "
+                "WHERE datname = current_database() AND wait_event_type = 'Lock'"
+            )
+            if cursor.fetchone()[0] >= count:
+                return
+            time.sleep(0.05)
+    raise AssertionError('No vote is waiting for the first one')
+
+
+@pytest.mark.django_db(transaction=True)
+class TestConcurrentVotes:
+
+    def test_concurrent_first_votes_count_once(self, post, test_user):
+        inserted = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def first_vote():
+            try:
+                with transaction.atomic():
+                    upsert_vote(post_target(post.slug), test_user, 1)
+                    inserted.set()
+                    release.wait(5)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        def second_vote():
+            try:
+                upsert_vote(post_target(post.slug), test_user, 1)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        first = threading.Thread(target=first_vote)
+        first.start()
+        assert inserted.wait(5)
+
+        # the second vote blocks on the uncommitted insert of the first one
+        second = threading.Thread(target=second_vote)
+        second.start()
+        try:
+            wait_for_lock_waiters(1)
+        finally:
+            release.set()
+            first.join()
+            second.join()
 
-# Create your tests here.
+        assert not errors
+        assert Rating.objects.filter(user=test_user).count() == 1
+        flush_pending_ratings()
+        post.refresh_from_db()
+        assert post.sum_rating == 1
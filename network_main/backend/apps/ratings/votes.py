@@ -0,0 +1,146 @@
+"""
+Vote writes in a single SQL statement.
+
+The rating row is upserted (or deleted) together with the lookup of the
+rated object, the previous vote and the stored sum_rating. The resulting
+delta goes to the write-behind buffer, so the hot post/comment row
+is not locked by every vote; without Redis it is written to the row. Only two concurrent first votes of the
+same user need a second run of the statement.
+"""
+from django.db import connection, OperationalError
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from apps.posts.models import Post, Comment
+
+from .models import Rating
+from .counters import buffer_rating_delta
+
+
+# a retry only follows a concurrent first vote of the same user
+VOTE_ATTEMPTS = 3
+
+
+def post_target(slug):
+    sql = (
+        f'SELECT id, sum_rating FROM {Post._meta.db_table} '
+        f"WHERE slug = %s AND status = 'PB'"
+    )
+    return Post, sql, [slug]
+
+
+def comment_target(slug, pk):
+    sql = (
+        f'SELECT c.id, c.sum_rating FROM {Comment._meta.db_table} c '
+        f'JOIN {Post._meta.db_table} p ON p.id = c.post_id '
+        f"WHERE c.id = %s AND p.slug = %s AND p.status <> 'DL'"
+    )
+    return Comment, sql, [pk, slug]
+
+
+def upsert_vote(target, user, value):
+    """
+    Creates or changes the vote of a user.
+    Returns (rating, created, sum_rating) or None if the target does not exist.
+    """
+    model, target_sql, target_params = target
+    content_type_id = ContentType.objects.get_for_model(model).id
+    table = Rating._meta.db_table
+
+    # FOR UPDATE makes a concurrent change of the same vote wait
+    # and re-read the latest value, so the delta stays exact.
+    # A first vote only inserts: if a concurrent first vote wins the
+    # insert, nothing is returned and the statement runs again,
+    # this time updating the committed row.
+    sql = f'''
+        WITH target AS ({target_sql}),
+        old AS (
+            SELECT r.id, r.value FROM {table} r JOIN target t ON r.object_id = t.id
+            WHERE r.content_type_id = %s AND r.user_id = %s
+            FOR UPDATE OF r
+        ),
+        updated AS (
+            UPDATE {table} r SET value = %s FROM old WHERE r.id = old.id
+            RETURNING r.id, r.object_id, r.value, r.time_created,
+                      false AS created, old.value AS old_value
+        ),
+        inserted AS (
+            INSERT INTO {table} (content_type_id, object_id, user_id, value, time_created)
+            SELECT %s, t.id, %s, %s, %s FROM target t
+            WHERE NOT EXISTS (SELECT 1 FROM old)
+            ON CONFLICT (content_type_id, object_id, user_id) DO NOTHING
+            RETURNING id, object_id, value, time_created,
+                      true AS created, 0 AS old_value
+        ),
+        changed AS (
+            SELECT * FROM updated UNION ALL SELECT * FROM inserted
+        )
+        SELECT c.id, c.object_id, c.value, c.time_created, c.created,
+               c.old_value, t.sum_rating
+        FROM target t LEFT JOIN changed c ON true
+    '''
+    params = [
+        *target_params,
+        content_type_id, user.id,
+        value,
+        content_type_id, user.id, value, timezone.now(),
+    ]
+
+    with connection.cursor() as cursor:
+        for _ in range(VOTE_ATTEMPTS):
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+            if row is None or row[0] is not None:
+                break
+        else:
+            raise OperationalError('The vote kept conflicting with concurrent votes')
+
+    if row is None:
+        return None
+
+    rating_id, object_id, value, time_created, created, old_value, stored = row
+    rating = Rating(
+        id=rating_id,
+        content_type_id=content_type_id,
+        object_id=object_id,
+        user=user,
+        value=value,
+        time_created=time_created
+    )
+    pending = buffer_rating_delta(
+        model, object_id, value - old_value, votes=1 if created else 0)
+    return rating, created, stored + pending
+
+
+def delete_vote(target, user):
+    """
+    Removes the vote of a user.
+    Returns the new sum_rating or None if the target does not exist.
+    """
+    model, target_sql, target_params = target
+    content_type_id = ContentType.objects.get_for_model(model).id
+    table = Rating._meta.db_table
+
+    sql = f'''
+        WITH target AS ({target_sql}),
+        deleted AS (
+            DELETE FROM {table} r USING target t
+            WHERE r.object_id = t.id
+              AND r.content_type_id = %s AND r.user_id = %s
+            RETURNING r.value
+        )
+        SELECT t.id, t.sum_rating, COALESCE((SELECT value FROM deleted), 0)
+        FROM target t
+    '''
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [*target_params, content_type_id, user.id])
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    object_id, stored, old_value = row
+    pending = buffer_rating_delta(
+        model, object_id, -old_value, votes=-1 if old_value else 0)
+    return stored + pending
@@ -0,0 +1,226 @@
+"""
+Offline candidate generation for personalized recommendations.
+
+A periodic job loads a pool of recent high scoring posts once and scores it
+for batches of active users with NumPy: the post score plus the user's
+affinity to the post's community, built from votes and memberships.
+The top ids are stored as a ranked list per user, so the view never runs
+the heavy query. The build time is the list generation.
+"""
+from datetime import timedelta
+
+import numpy as np
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from apps.memberships.models import Membership
+from apps.posts.models import Post
+from apps.ratings.models import Rating
+from apps.users.models import CustomUser
+from apps.communities.feeds import datetime_to_score
+
+from .ranked import store_ranked_lists
+
+
+CANDIDATES_PER_USER = 500
+CANDIDATE_POOL_SIZE = 20000
+CANDIDATES_TIMEOUT = 60 * 60 * 6
+CANDIDATES_BUILD_LOCK_TIMEOUT = 60
+USER_BATCH_SIZE = 100
+
+POOL_WINDOW_DAYS = 90
+ACTIVE_USER_DAYS = 7
+VOTE_HISTORY_DAYS = 90
+
+W_UPVOTE = 1.0
+W_DOWNVOTE = -0.5
+W_MEMBERSHIP = 2.0
+W_COMMUNITY = 0.6
+
+
+def candidates_key(user_id):
+    return f'user:{user_id}:candidates'
+
+
+def candidates_build_lock_key(user_id):
+    return f'user:{user_id}:candidates:building'
+
+
+def schedule_candidates_build(user_id):
+    from .tasks import build_user_candidates
+
+    r = get_redis_connection('default')
+    acquired = r.set(
+        candidates_build_lock_key(user_id), 1,
+        nx=True, ex=CANDIDATES_BUILD_LOCK_TIMEOUT
+    )
+    if acquired:
+        transaction.on_commit(lambda: build_user_candidates.delay(user_id))
+
+
+def get_active_user_ids(now=None):
+    since = (now or timezone.now()) - timedelta(days=ACTIVE_USER_DAYS)
+    recent_voters = Rating.objects.filter(
+        time_created__gte=since).values('user_id')
+
+    return (
+        CustomUser.objects
+        .filter(is_active=True)
+        .filter(Q(last_login__gte=since) | Q(id__in=recent_voters))
+        .order_by('id')
+        .values_list('id', flat=True)
+    )
+
+
+def load_candidate_pool(now=None):
+    """
+    Loads the posts every user is scored against as arrays.
+    `post_order` sorts post_ids for searchsorted lookups.
+    """
+    since = (now or timezone.now()) - timedelta(days=POOL_WINDOW_DAYS)
+    rows = list(
+        Post.published
+        .filter(created__gte=since)
+        .order_by('-score')
+        .values_list('id', 'community_id', 'score')[:CANDIDATE_POOL_SIZE]
+    )
+
+    if rows:
+        post_ids, community_ids, scores = map(np.array, zip(*rows))
+    else:
+        post_ids = np.array([], dtype=np.int64)
+        community_ids = np.array([], dtype=np.int64)
+        scores = np.array([], dtype=np.float64)
+
+    communities, community_codes = np.unique(
+        community_ids, return_inverse=True)
+
+    return {
+        'post_ids': post_ids.astype(np.int64),
+        'post_order': np.argsort(post_ids),
+        'scores': scores.astype(np.float32),
+        'communities': communities.astype(np.int64),
+        'community_codes': community_codes,
+    }
+
+
+def lookup(sorted_values, values, order=None):
+    """
+    Positions of `values` in a sorted array (or an array sorted by `order`)
+    and a mask of the values that were found.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    keys = sorted_values if order is None else sorted_values[order]
+    if not len(keys) or not len(values):
+        return np.zeros(len(values), dtype=np.int64), np.zeros(len(values), dtype=bool)
+
+    positions = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+    found = keys[positions] == values
+    if order is not None:
+        positions = order[positions]
+    return positions, found
+
+
+def load_user_signals(user_ids, now=None):
+    """
+    Returns (votes, memberships) as lists of
+    (user_id, post_id, value, community_id) and (user_id, community_id).
+    """
+    since = (now or timezone.now()) - timedelta(days=VOTE_HISTORY_DAYS)
+    post_community = Post.objects.filter(
+        pk=OuterRef('object_id')).values('community_id')[:1]
+
+    votes = list(
+        Rating.objects
+        .filter(
+            user_id__in=user_ids,
+            content_type=ContentType.objects.get_for_model(Post),
+            time_created__gte=since
+        )
+        .annotate(community_id=Subquery(post_community))
+        .values_list('user_id', 'object_id', 'value', 'community_id')
+    )
+    memberships = list(
+        Membership.objects
+        .filter(user_id__in=user_ids, community__is_deleted=False)
+        .values_list('user_id', 'community_id')
+    )
+    return votes, memberships
+
+
+def score_candidates(pool, user_ids, votes, memberships, limit=CANDIDATES_PER_USER):
+    """Returns {user_id: [post_id, ...]} best first."""
+    user_ids = list(user_ids)
+    user_index = {user_id: i for i, user_id in enumerate(user_ids)}
+    affinity = np.zeros(
+        (len(user_ids), len(pool['communities'])), dtype=np.float32)
+    excluded = np.zeros(
+        (len(user_ids), len(pool['post_ids'])), dtype=bool)
+
+    if votes:
+        v_users, v_posts, v_values, v_communities = zip(*votes)
+        rows = np.array([user_index[u] for u in v_users], dtype=np.int64)
+        weights = np.where(np.array(v_values) > 0, W_UPVOTE, W_DOWNVOTE)
+
+        columns, found = lookup(pool['communities'], [
+            c or 0 for c in v_communities])
+        np.add.at(affinity, (rows[found], columns[found]), weights[found])
+
+        # already voted posts are not recommended again
+        positions, found = lookup(
+            pool['post_ids'], v_posts, pool['post_order'])
+        excluded[rows[found], positions[found]] = True
+
+    if memberships:
+        m_users, m_communities = zip(*memberships)
+        rows = np.array([user_index[u] for u in m_users], dtype=np.int64)
+        columns, found = lookup(pool['communities'], m_communities)
+        np.add.at(affinity, (rows[found], columns[found]), W_MEMBERSHIP)
+
+    # scale every user's affinity to [-1, 1]
+    norm = np.abs(affinity).max(axis=1, keepdims=True)
+    np.divide(affinity, norm, out=affinity, where=norm > 0)
+
+    totals = pool['scores'][None, :] + \
+        W_COMMUNITY * affinity[:, pool['community_codes']]
+    totals[excluded] = -np.inf
+
+    size = totals.shape[1]
+    if size > limit:
+        top = np.argpartition(-totals, limit - 1, axis=1)[:, :limit]
+    else:
+        top = np.tile(np.arange(size), (len(user_ids), 1))
+
+    result = {}
+    for row, user_id in enumerate(user_ids):
+        columns = top[row]
+        columns = columns[np.argsort(-totals[row, columns], kind='stable')]
+        columns = columns[np.isfinite(totals[row, columns])]
+        result[user_id] = pool['post_ids'][columns].tolist()
+    return result
+
+
+def build_candidates(user_ids, pool=None, now=None):
+    """Computes and stores candidate lists for the given users."""
+    now = now or timezone.now()
+    pool = pool if pool is not None else load_candidate_pool(now)
+    built_at = datetime_to_score(now)
+
+    total = 0
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), USER_BATCH_SIZE):
+        batch = user_ids[start:start + USER_BATCH_SIZE]
+        votes, memberships = load_user_signals(batch, now)
+        candidates = score_candidates(pool, batch, votes, memberships)
+
+        store_ranked_lists({
+            candidates_key(user_id): ids
+            for user_id, ids in candidates.items()
+        }, generation=built_at, timeout=CANDIDATES_TIMEOUT)
+        total += len(batch)
+
+    return total
@@ -0,0 +1,245 @@
+import heapq
+import logging
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError
+
+from apps.communities.feeds import (
+    ADD_IF_EXISTS_SCRIPT,
+    FEED_MAX_LENGTH,
+    feed_key,
+    datetime_to_score,
+    filter_after_cursor,
+    queue_feed_range,
+    read_feed_range,
+    schedule_feed_rebuild
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Communities up to this size push new posts into members' inboxes,
+# bigger ones are pulled from their community feed at read time.
+FANOUT_MEMBERS_THRESHOLD = 1000
+# Feeds of the most active big communities read per page, the posts of
+# the other ones come from a single Postgres query.
+MAX_PULLED_COMMUNITIES = 50
+FANOUT_BATCH_SIZE = 1000
+
+HOME_FEED_MAX_LENGTH = 500
+HOME_FEED_TIMEOUT = 60 * 60 * 24
+SUBSCRIPTIONS_TIMEOUT = 60 * 10
+
+
+def home_feed_key(user_id):
+    return f'user:{user_id}:home'
+
+
+def subscriptions_cache_key(user_id):
+    return f'user_home_subscriptions:{user_id}'
+
+
+def is_pushed_community(members_count):
+    return members_count <= FANOUT_MEMBERS_THRESHOLD
+
+
+def invalidate_home_feed(user_id):
+    cache.delete(subscriptions_cache_key(user_id))
+    try:
+        get_redis_connection('default').delete(home_feed_key(user_id))
+    except RedisError as e:
+        logger.warning(f'Failed to drop home feed of user {user_id}: {e}')
+
+
+def load_subscriptions(user_id):
+    """
+    Returns (pushed_ids, pulled_ids) for the communities of a user,
+    pulled ones ordered by activity, most active first.
+    """
+    from apps.memberships.models import Membership
+
+    rows = (
+        Membership.objects
+        .filter(user_id=user_id, community__is_deleted=False)
+        .values_list(
+            'community_id',
+            'community__members_count',
+            'community__activity_score'
+        )
+    )
+
+    pushed, pulled = [], []
+    for community_id, members_count, activity_score in rows:
+        if is_pushed_community(members_count):
+            pushed.append(community_id)
+        else:
+            pulled.append((activity_score, community_id))
+
+    pulled.sort(reverse=True)
+    return pushed, [c_id for _, c_id in pulled]
+
+
+def get_subscriptions(user_id):
+    """Cached load_subscriptions."""
+    key = subscriptions_cache_key(user_id)
+    data = cache.get(key)
+
+    if data is None:
+        pushed, pulled = load_subscriptions(user_id)
+        data = {'pushed': pushed, 'pulled': pulled}
+        cache.set(key, data, timeout=SUBSCRIPTIONS_TIMEOUT)
+
+    return data['pushed'], data['pulled']
+
+
+def rebuild_home_feed(user_id, community_ids):
+    from apps.posts.models import Post
+
+    key = home_feed_key(user_id)
+    rows = list(
+        Post.published
+        .filter(community_id__in=community_ids)
+        .order_by('-created', '-id')
+        .values_list('id', 'created')[:HOME_FEED_MAX_LENGTH]
+    ) if community_ids else []
+
+    r = get_redis_connection('default')
+    pipe = r.pipeline()
+    pipe.delete(key)
+    # an empty inbox still has to be "warm", the sentinel is never served
+    pipe.zadd(key, {0: 0})
+    if rows:
+        pipe.zadd(key, {
+            post_id: datetime_to_score(created) for post_id, created in rows
+        })
+    pipe.expire(key, HOME_FEED_TIMEOUT)
+    pipe.execute()
+
+
+def fanout_post(post_id, created, member_ids):
+    r = get_redis_connection('default')
+    script = r.register_script(ADD_IF_EXISTS_SCRIPT)
+    score = datetime_to_score(created)
+
+    pipe = r.pipeline(transaction=False)
+    for user_id in member_ids:
+        script(
+            keys=[home_feed_key(user_id)],
+            args=[score, post_id, HOME_FEED_MAX_LENGTH],
+            client=pipe
+        )
+    pipe.execute()
+
+
+def read_redis_sources(user_id, pushed, pulled, cursor, count):
+    """
+    Reads the inbox and the pulled community feeds after the cursor.
+    Returns (sources, floors, fallback_ids): the entries of each source,
+    the (score, post_id) down to which each source that has more is
+    complete, and the communities that have to be read from Postgres.
+    """
+    inbox_key = home_feed_key(user_id)
+
+    r = get_redis_connection('default')
+    if pushed and not r.exists(inbox_key):
+        rebuild_home_feed(user_id, pushed)
+
+    pulled, fallback_ids = (
+        pulled[:MAX_PULLED_COMMUNITIES], pulled[MAX_PULLED_COMMUNITIES:])
+    keys = ([inbox_key] if pushed else []) + [feed_key(c) for c in pulled]
+    # exists, zcard and the range reads of each key
+    reads = 4 if cursor is not None else 3
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.exists(key)
+        pipe.zcard(key)
+        queue_feed_range(pipe, key, cursor, count)
+    results = pipe.execute()
+
+    sources = []
+    floors = []
+    for index, key in enumerate(keys):
+        exists, size, *replies = results[index * reads:(index + 1) * reads]
+        is_inbox = pushed and index == 0
+        max_length = HOME_FEED_MAX_LENGTH if is_inbox else FEED_MAX_LENGTH
+        community_ids = pushed if is_inbox else [pulled[index - bool(pushed)]]
+
+        if not exists:
+            if not is_inbox:
+                schedule_feed_rebuild(community_ids[0])
+            fallback_ids.extend(community_ids)
+            continue
+
+        entries, cut = read_feed_range(replies, cursor, count)
+        if (cut is None and size >= max_length) or (cut is not None and not entries):
+            # source is capped and exhausted, or a single timestamp fills
+            # the range, the posts are read from Postgres
+            fallback_ids.extend(community_ids)
+        else:
+            sources.append(entries)
+            if cut is not None:
+                post_id, score = entries[-1]
+                floors.append((score, post_id))
+
+    return sources, floors, fallback_ids
+
+
+def get_home_feed_page(user_id, cursor=None, count=25):
+    """
+    Merges the user's inbox (pushed posts of small communities) with
+    the feeds of big communities, newest first. Without Redis every
+    community is read from Postgres.
+    Returns up to `count` (post_id, score) pairs after the (score, post_id)
+    cursor and whether more follow.
+    """
+    from apps.posts.models import Post
+
+    try:
+        pushed, pulled = get_subscriptions(user_id)
+        if not pushed and not pulled:
+            return [], False
+        sources, floors, fallback_ids = read_redis_sources(
+            user_id, pushed, pulled, cursor, count)
+    except (RedisError, ConnectionInterrupted) as e:
+        logger.warning(f'Failed to read home feed of user {user_id}: {e}')
+        pushed, pulled = load_subscriptions(user_id)
+        sources, floors, fallback_ids = [], [], pushed + pulled
+
+    if fallback_ids:
+        queryset = filter_after_cursor(
+            Post.published.filter(community_id__in=fallback_ids), cursor)
+        rows = list(
+            queryset
+            .order_by('-created', '-id')
+            .values_list('id', 'created')[:count + 1]
+        )
+        if len(rows) > count:
+            rows = rows[:count]
+            post_id, created = rows[-1]
+            floors.append((datetime_to_score(created), post_id))
+        sources.append([
+            (post_id, datetime_to_score(created)) for post_id, created in rows
+        ])
+
+    # every source is sorted newest first, so a k-way merge is enough;
+    # below the highest floor a source may be missing posts
+    merged = heapq.merge(*sources, key=lambda entry: (-entry[1], -entry[0]))
+    floor = max(floors, default=None)
+
+    seen = set()
+    page = []
+    more = floor is not None
+    for post_id, score in merged:
+        if floor is not None and (score, post_id) < floor:
+            break
+        if post_id in seen:
+            continue
+        if len(page) == count:
+            more = True
+            break
+        seen.add(post_id)
+        page.append((post_id, score))
+
+    return page, more
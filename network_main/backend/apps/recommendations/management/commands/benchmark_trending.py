@@ -0,0 +1,45 @@
+import time
+from datetime import timedelta
+from statistics import median
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.posts.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Compares trending lists ordered by (status, -score) and (status, -hot_key)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=20)
+        parser.add_argument('--limit', type=int, default=2000)
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument(
+            '--explain',
+            action='store_true',
+            help='Print query plans'
+        )
+
+    def handle(self, *args, **options):
+        time_threshold = timezone.now() - timedelta(days=options['days'])
+        base = Post.published.filter(created__gte=time_threshold)
+
+        for ordering in ('-score', '-hot_key'):
+            queryset = (
+                base.order_by(ordering)
+                .values_list('id', flat=True)[:options['limit']]
+            )
+
+            timings = []
+            for _ in range(options['runs']):
+                start = time.perf_counter()
+                list(queryset)
+                timings.append((time.perf_counter() - start) * 1000)
+
+            self.stdout.write(
+                f'{ordering:>10}: median {median(timings):.2f} ms, '
+                f'max {max(timings):.2f} ms over {options["runs"]} runs'
+            )
+            if options['explain']:
+                self.stdout.write(queryset.explain(analyze=True))
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.14 on 2026-10-17 19:47
+
+import django.contrib.postgres.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('posts', '0003_post_hot_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostSimilarity',
+            fields=[
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='similarity', serialize=False, to='posts.post', verbose_name='Post')),
+                ('neighbour_ids', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None, verbose_name='Similar post ids')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Update time')),
+            ],
+            options={
+                'verbose_name': 'Post similarity',
+                'verbose_name_plural': 'Post similarities',
+                'db_table': 'api_network_post_similarity',
+            },
+        ),
+    ]
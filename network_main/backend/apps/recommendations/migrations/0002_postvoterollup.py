@@ -0,0 +1,50 @@
+# Generated by Django 5.2.14 on 2026-10-17 20:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Seeds the last 30 days from the vote times, later vote
+# changes are not in the ratings table
+BACKFILL_ROLLUPS = '''
+    INSERT INTO api_network_post_vote_rollup (post_id, community_id, span, bucket, net)
+    SELECT p.id, p.community_id, 'hour', date_trunc('hour', r.time_created), SUM(r.value)
+    FROM api_network_rating r
+    JOIN django_content_type ct
+      ON ct.id = r.content_type_id AND ct.app_label = 'posts' AND ct.model = 'post'
+    JOIN api_network_post p ON p.id = r.object_id
+    WHERE r.time_created >= NOW() - INTERVAL '30 days'
+    GROUP BY p.id, p.community_id, date_trunc('hour', r.time_created)
+    HAVING SUM(r.value) <> 0
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0008_postcard'),
+        ('ratings', '0002_initial'),
+        ('recommendations', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostVoteRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('community_id', models.BigIntegerField()),
+                ('span', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], default='hour', max_length=4)),
+                ('bucket', models.DateTimeField(verbose_name='Bucket start')),
+                ('net', models.IntegerField(default=0, verbose_name='Net votes')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vote_rollups', to='posts.post', verbose_name='Post')),
+            ],
+            options={
+                'verbose_name': 'Post vote rollup',
+                'verbose_name_plural': 'Post vote rollups',
+                'db_table': 'api_network_post_vote_rollup',
+                'indexes': [models.Index(fields=['bucket'], name='api_network_bucket_389d3e_idx'), models.Index(fields=['community_id', 'bucket'], name='api_network_communi_8f6272_idx'), models.Index(fields=['span', 'bucket'], name='api_network_span_8de838_idx')],
+                'constraints': [models.UniqueConstraint(fields=('post', 'span', 'bucket'), name='unique_post_vote_rollup_bucket')],
+            },
+        ),
+        migrations.RunSQL(BACKFILL_ROLLUPS, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.14 on 2026-10-17 21:56
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommendations', '0002_postvoterollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='postsimilarity',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['neighbour_ids'], name='post_similarity_neighbours_idx'),
+        ),
+    ]
@@ -1,3 +1,77 @@
 from django.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 
-# Create your models here.
+from apps.posts.models import Post
+
+
+class PostSimilarity(models.Model):
+    """Precomputed most similar posts by co-upvotes, best first"""
+
+    post = models.OneToOneField(
+        to=Post,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='similarity',
+        verbose_name='Post'
+    )
+    neighbour_ids = ArrayField(
+        models.IntegerField(),
+        default=list,
+        verbose_name='Similar post ids'
+    )
+    updated = models.DateTimeField(auto_now=True, verbose_name='Update time')
+
+    class Meta:
+        db_table = 'api_network_post_similarity'
+        indexes = [
+            # finds the posts listing a post whose votes changed
+            GinIndex(fields=['neighbour_ids'], name='post_similarity_neighbours_idx'),
+        ]
+        verbose_name = 'Post similarity'
+        verbose_name_plural = 'Post similarities'
+
+    def __str__(self):
+        return f'Similar to {self.post_id}'
+
+
+class PostVoteRollup(models.Model):
+    """
+    Net votes of a post within an hour, or within a day for old buckets.
+    Filled from the vote buffer, so windowed rankings never scan ratings.
+    """
+
+    class Span(models.TextChoices):
+        HOUR = 'hour', 'Hour'
+        DAY = 'day', 'Day'
+
+    post = models.ForeignKey(
+        to=Post,
+        on_delete=models.CASCADE,
+        related_name='vote_rollups',
+        verbose_name='Post'
+    )
+    # copied from the post to rank a community without joins
+    community_id = models.BigIntegerField()
+    span = models.CharField(max_length=4, choices=Span.choices, default=Span.HOUR)
+    bucket = models.DateTimeField(verbose_name='Bucket start')
+    net = models.IntegerField(default=0, verbose_name='Net votes')
+
+    class Meta:
+        db_table = 'api_network_post_vote_rollup'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['post', 'span', 'bucket'],
+                name='unique_post_vote_rollup_bucket'
+            )
+        ]
+        indexes = [
+            models.Index(fields=['bucket']),
+            models.Index(fields=['community_id', 'bucket']),
+            models.Index(fields=['span', 'bucket']),
+        ]
+        verbose_name = 'Post vote rollup'
+        verbose_name_plural = 'Post vote rollups'
+
+    def __str__(self):
+        return f'{self.post_id} {self.span} {self.bucket}: {self.net}'
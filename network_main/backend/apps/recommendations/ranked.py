@@ -0,0 +1,90 @@
+"""
+Ranked id lists in Redis.
+
+A list is a sorted set scored by rank, so a page is a single ZRANGE by
+position. Every build gets a new generation stored next to the list.
+Cursors carry (generation, position, last id): within a generation the
+position is exact, after a rebuild the page continues after the last seen
+id if it is still listed, otherwise at the same position.
+"""
+import base64
+import binascii
+
+from django_redis import get_redis_connection
+
+
+def generation_key(key):
+    return f'{key}:gen'
+
+
+def encode_ranked_cursor(generation, position, last_id):
+    raw = f'g={generation}&p={position}&i={last_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_ranked_cursor(cursor):
+    """Returns (generation, position, last_id) or raises ValueError."""
+    try:
+        decoded = base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (binascii.Error, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+    parts = dict(part.partition('=')[::2] for part in decoded.split('&'))
+    values = [parts.get(name, '') for name in ('g', 'p', 'i')]
+    if not all(value.isdigit() for value in values):
+        raise ValueError('Invalid cursor')
+    return tuple(int(value) for value in values)
+
+
+def store_ranked_lists(lists, generation, timeout):
+    """
+    Replaces {key: [id, ...]} lists, best first.
+    An empty list is stored as a generation without members.
+    """
+    r = get_redis_connection('default')
+    pipe = r.pipeline()
+    for key, ids in lists.items():
+        if ids:
+            tmp_key = f'{key}:tmp'
+            pipe.delete(tmp_key)
+            pipe.zadd(tmp_key, {item: rank for rank, item in enumerate(ids)})
+            pipe.expire(tmp_key, timeout)
+            pipe.rename(tmp_key, key)
+        else:
+            pipe.delete(key)
+        pipe.set(generation_key(key), generation, ex=timeout)
+    pipe.execute()
+
+
+def get_ranked_page(key, cursor=None, count=25):
+    """
+    Returns (ids, next_cursor, generation) for a decoded cursor,
+    or None if the list is not built.
+    """
+    start = cursor[1] if cursor else 0
+
+    r = get_redis_connection('default')
+    pipe = r.pipeline(transaction=False)
+    pipe.get(generation_key(key))
+    pipe.zrange(key, start, start + count - 1)
+    pipe.zcard(key)
+    generation, ids, size = pipe.execute()
+
+    if generation is None:
+        return None
+    generation = int(generation)
+
+    if cursor and cursor[0] != generation:
+        # the list was rebuilt since the cursor was issued
+        rank = r.zrank(key, cursor[2])
+        if rank is not None and rank + 1 != start:
+            start = rank + 1
+            ids = r.zrange(key, start, start + count - 1)
+
+    ids = [int(item) for item in ids]
+    end = start + len(ids)
+    next_cursor = (
+        encode_ranked_cursor(generation, end, ids[-1])
+        if ids and end < size else None
+    )
+    return ids, next_cursor, generation
@@ -0,0 +1,196 @@
+"""
+Hourly vote rollups and the windowed "top" lists built from them.
+
+Votes add their delta to a Redis hash per (post, hour) next to the rating
+buffer. The flush moves the hash into PostVoteRollup with one upsert per
+batch, and hourly buckets older than a couple of days are folded into
+daily ones. A top list of a window sums the buckets in range and is kept
+as a ranked list in Redis for a few minutes.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from apps.communities.feeds import datetime_to_score
+from apps.posts.cards import published_cards
+from apps.posts.models import Post
+from apps.ratings.counters import (
+    FLUSH_BATCH_SIZE,
+    rollup_pending_key,
+    hour_start,
+    flush_batch
+)
+
+from .models import PostVoteRollup
+from .ranked import get_ranked_page, store_ranked_lists
+
+
+WINDOWS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+    'week': timedelta(days=7),
+    'month': timedelta(days=30),
+    'all': None,
+}
+
+TOP_LIST_SIZE = 2000
+TOP_LIST_TIMEOUT = 240
+COMPACT_AFTER_DAYS = 2
+COMPACT_BATCH_SIZE = 10000
+
+
+def top_list_key(window, community_id=None):
+    if community_id is None:
+        return f'posts:top:{window}'
+    return f'community:{community_id}:top:{window}'
+
+
+def parse_window(request):
+    """The `window` query param or None, raises ValidationError if unknown."""
+    window = request.query_params.get('window')
+    if window is not None and window not in WINDOWS:
+        raise ValidationError(
+            {'window': f'Expected one of: {", ".join(WINDOWS)}.'})
+    return window
+
+
+def upsert_rollups(items, span=PostVoteRollup.Span.HOUR):
+    """
+    Adds [(post_id, bucket, net), ...] to the buckets with
+    INSERT ... ON CONFLICT, rows of missing posts are skipped.
+    """
+    quote = connection.ops.quote_name
+    table = quote(PostVoteRollup._meta.db_table)
+    posts = quote(Post._meta.db_table)
+    # a stable order keeps concurrent flushes from deadlocking
+    items = sorted(items)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(items), FLUSH_BATCH_SIZE):
+            batch = items[start:start + FLUSH_BATCH_SIZE]
+            values = ', '.join(['(%s::bigint, %s::timestamptz, %s::integer)'] * len(batch))
+            cursor.execute(
+                f'INSERT INTO {table} (post_id, community_id, span, bucket, net) '
+                f'SELECT v.post_id, p.community_id, %s, v.bucket, v.net '
+                f'FROM (VALUES {values}) AS v(post_id, bucket, net) '
+                f'JOIN {posts} p ON p.id = v.post_id '
+                f'ON CONFLICT (post_id, span, bucket) '
+                f'DO UPDATE SET net = {table}.net + EXCLUDED.net',
+                [span, *[value for item in batch for value in item]]
+            )
+
+
+def parse_rollups(fields):
+    """[(post_id, bucket, net), ...] of the fields of the hourly hash."""
+    items = []
+    for field, value in fields.items():
+        post_id, _, hour = field.partition(':')
+        if value:
+            bucket = datetime.fromtimestamp(int(hour), tz=dt_timezone.utc)
+            items.append((int(post_id), bucket, value))
+    return items
+
+
+def flush_vote_rollups():
+    """
+    Moves buffered hourly deltas into PostVoteRollup, returns the number
+    of touched buckets. A failed batch is retried like the rating buffer.
+    """
+    def apply(fields):
+        items = parse_rollups(fields)
+        if items:
+            upsert_rollups(items)
+
+    fields = flush_batch(rollup_pending_key(Post), apply)
+    return len(parse_rollups(fields or {}))
+
+
+def compact_vote_rollups(now=None, batch_size=COMPACT_BATCH_SIZE):
+    """
+    Folds hourly buckets of finished days older than COMPACT_AFTER_DAYS
+    into daily buckets, returns the number of folded hourly rows.
+    """
+    now = now or timezone.now()
+    cutoff = (now - timedelta(days=COMPACT_AFTER_DAYS)).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+    table = connection.ops.quote_name(PostVoteRollup._meta.db_table)
+
+    total = 0
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                WITH moved AS (
+                    DELETE FROM {table} WHERE id IN (
+                        SELECT id FROM {table}
+                        WHERE span = %s AND bucket < %s
+                        ORDER BY id LIMIT %s
+                    )
+                    RETURNING post_id, community_id, bucket, net
+                ),
+                folded AS (
+                    INSERT INTO {table} (post_id, community_id, span, bucket, net)
+                    SELECT post_id, MAX(community_id), %s,
+                           date_trunc('day', bucket), SUM(net)
+                    FROM moved
+                    GROUP BY post_id, date_trunc('day', bucket)
+                    ON CONFLICT (post_id, span, bucket)
+                    DO UPDATE SET net = {table}.net + EXCLUDED.net
+                )
+                SELECT COUNT(*) FROM moved
+                ''',
+                [PostVoteRollup.Span.HOUR, cutoff, batch_size,
+                 PostVoteRollup.Span.DAY]
+            )
+            moved = cursor.fetchone()[0]
+        total += moved
+        if moved < batch_size:
+            return total
+
+
+def top_post_ids(window, community_id=None, limit=TOP_LIST_SIZE, now=None):
+    """Published post ids by net votes within the window, best first."""
+    if WINDOWS[window] is None:
+        queryset = published_cards()
+        if community_id is not None:
+            queryset = queryset.filter(community_id=community_id)
+        return list(
+            queryset.order_by('-sum_rating', '-id')
+            .values_list('id', flat=True)[:limit]
+        )
+
+    now = now or timezone.now()
+    since = datetime.fromtimestamp(
+        hour_start((now - WINDOWS[window]).timestamp()), tz=dt_timezone.utc)
+
+    queryset = PostVoteRollup.objects.filter(bucket__gte=since)
+    if community_id is not None:
+        queryset = queryset.filter(community_id=community_id)
+    return list(
+        queryset
+        .filter(post__status='PB')
+        .values('post_id')
+        .annotate(total=Sum('net'))
+        .filter(total__gt=0)
+        .order_by('-total', '-post_id')
+        .values_list('post_id', flat=True)[:limit]
+    )
+
+
+def get_top_page(window, cursor, count, community_id=None):
+    """Same as get_ranked_page, builds the list of the window on a miss."""
+    key = top_list_key(window, community_id)
+    page = get_ranked_page(key, cursor, count)
+
+    if page is None:
+        store_ranked_lists(
+            {key: top_post_ids(window, community_id)},
+            generation=datetime_to_score(timezone.now()),
+            timeout=TOP_LIST_TIMEOUT
+        )
+        page = get_ranked_page(key, cursor, count)
+
+    return page
@@ -0,0 +1,104 @@
+"""
+Post score maintenance.
+
+Posts that got votes, comments or were published are collected in a
+Redis set and rescored by the next `update_posts_score` run.
+Freshness decays fastest right after publishing, so posts of the last
+RECENT_SCORE_HOURS are rescored every run of `refresh_recent_posts_score`.
+The rest of the scoring window is handled by a slow sweep that walks it
+newest first, one chunk per run.
+
+`hot_key` is a decay-free alternative: log10 of the votes plus the
+creation time, so newer posts win without rewriting older ones.
+It only changes together with sum_rating or comment_count.
+"""
+import logging
+import math
+
+from django.db.models import F, Func, Value, ExpressionWrapper, FloatField
+from django.db.models.functions import Abs, Extract, Greatest, Log, Random, Sign
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+
+DIRTY_POSTS_KEY = 'posts:score:dirty'
+SWEEP_CURSOR_KEY = 'posts:score:sweep_cursor'
+
+SCORE_WINDOW_DAYS = 90
+RECENT_SCORE_HOURS = 48
+SCORE_BATCH_SIZE = 1000
+SWEEP_BATCH_SIZE = 2000
+
+W_RATING = 0.4
+W_COMMENTS = 0.1
+W_FRESHNESS = 0.3
+W_RANDOM = 0.6
+
+# 2024-01-01 UTC, keeps hot keys small
+HOT_EPOCH = 1704067200
+# every 12.5 hours of age equal one order of magnitude of votes
+HOT_DECAY_SECONDS = 45000
+HOT_COMMENT_WEIGHT = 0.25
+
+
+def mark_posts_dirty(post_ids):
+    post_ids = list(post_ids)
+    if not post_ids:
+        return
+    try:
+        get_redis_connection('default').sadd(DIRTY_POSTS_KEY, *post_ids)
+    except RedisError as e:
+        # the sweep will pick these posts up later
+        logger.warning(f'Failed to mark posts {post_ids} for rescoring: {e}')
+
+
+def pop_dirty_posts(count=SCORE_BATCH_SIZE):
+    r = get_redis_connection('default')
+    return [int(post_id) for post_id in r.spop(DIRTY_POSTS_KEY, count) or []]
+
+
+def score_expression(now):
+    hours_since_created = Extract(now - F('created'), 'epoch') / 3600.0
+    freshness = 1.0 / (1.0 + hours_since_created)
+
+    return ExpressionWrapper(
+        (W_RATING * F('sum_rating')) +
+        (W_COMMENTS * F('comment_count')) +
+        (W_FRESHNESS * freshness) +
+        (W_RANDOM * Random() * 0.4),
+        output_field=FloatField()
+    )
+
+
+class Epoch(Func):
+    """Unix time of a timestamptz, independent of the connection time zone"""
+    template = 'EXTRACT(EPOCH FROM %(expressions)s)'
+    output_field = FloatField()
+
+
+def compute_hot_key(sum_rating, comment_count, created):
+    votes = sum_rating + HOT_COMMENT_WEIGHT * comment_count
+    sign = (votes > 0) - (votes < 0)
+    order = math.log10(max(abs(votes), 1))
+    seconds = created.timestamp() - HOT_EPOCH
+    return sign * order + seconds / HOT_DECAY_SECONDS
+
+
+def hot_key_expression(sum_rating=F('sum_rating'), comment_count=F('comment_count')):
+    """
+    SQL counterpart of `compute_hot_key` for queryset updates.
+    Pass new values explicitly when they are set in the same UPDATE.
+    """
+    votes = ExpressionWrapper(
+        sum_rating + HOT_COMMENT_WEIGHT * comment_count,
+        output_field=FloatField()
+    )
+    order = Log(10, Greatest(Abs(votes), Value(1.0)))
+    seconds = Epoch(F('created')) - HOT_EPOCH
+
+    return ExpressionWrapper(
+        Sign(votes) * order + seconds / HOT_DECAY_SECONDS,
+        output_field=FloatField()
+    )
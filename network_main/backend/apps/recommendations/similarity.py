@@ -0,0 +1,206 @@
+"""
+Item-item "related posts" model.
+
+Posts are similar when the same users upvoted them: cosine similarity
+over the sparse user x post upvote matrix. Votes add the ids of changed
+posts to a Redis set (see ratings.counters). An incremental build takes
+those posts and the posts whose upvotes left the window since the last
+build, adds every post co-voted with them or listing them as similar,
+and loads only the upvotes of the voters of these posts. A full build
+loads the whole window and runs a few times a day.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from apps.posts.models import Post
+from apps.ratings.counters import changed_key
+from apps.ratings.models import Rating
+
+from .candidates import lookup
+from .models import PostSimilarity
+
+
+SIMILAR_POSTS_COUNT = 50
+VOTE_WINDOW_DAYS = 180
+ROW_CHUNK_SIZE = 1000
+WRITE_BATCH_SIZE = 1000
+
+LAST_BUILD_KEY = 'posts:similarity:built_at'
+
+
+def upvotes(since):
+    return Rating.objects.filter(
+        content_type=ContentType.objects.get_for_model(Post),
+        value=1,
+        time_created__gte=since
+    ).order_by()
+
+
+def load_upvote_matrix(since, post_ids=None):
+    """
+    Returns (matrix, post_ids, norms): a binary users x posts csr matrix,
+    the post id and the norm of every column. With `post_ids` only the
+    voters of those posts are loaded: their columns are complete, norms
+    of the other columns are counted separately.
+    """
+    votes = upvotes(since)
+    if post_ids is not None:
+        votes = votes.filter(user_id__in=(
+            upvotes(since).filter(object_id__in=post_ids).values('user_id')))
+
+    rows = np.array(list(
+        votes.values_list('user_id', 'object_id')
+    ), dtype=np.int64).reshape(-1, 2)
+
+    _, user_codes = np.unique(rows[:, 0], return_inverse=True)
+    columns, post_codes = np.unique(rows[:, 1], return_inverse=True)
+
+    matrix = csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (user_codes, post_codes)),
+        shape=(user_codes.max(initial=-1) + 1, len(columns))
+    )
+
+    if post_ids is None:
+        counts = np.asarray(matrix.sum(axis=0)).ravel()
+    else:
+        counted = np.array(list(
+            upvotes(since)
+            .filter(object_id__in=votes.values('object_id'))
+            .values('object_id')
+            .annotate(votes=Count('id'))
+            .values_list('object_id', 'votes')
+        ), dtype=np.int64).reshape(-1, 2)
+        positions, found = lookup(columns, counted[:, 0])
+        counts = np.zeros(len(columns), dtype=np.float32)
+        counts[positions[found]] = counted[found, 1]
+
+    return matrix, columns, np.sqrt(counts)
+
+
+def get_affected_post_ids(changed, since, expired_since):
+    """
+    Posts whose similar posts may differ after `changed` posts got new
+    votes and the upvotes older than `since` left the window.
+    """
+    changed = set(changed)
+    changed.update(
+        upvotes(expired_since)
+        .filter(time_created__lt=since)
+        .values_list('object_id', flat=True)
+    )
+    if not changed:
+        return changed
+
+    recent = upvotes(since)
+    affected = set(changed)
+    # similarities to the changed posts went up...
+    affected.update(
+        recent
+        .filter(user_id__in=(
+            recent.filter(object_id__in=changed).values('user_id')))
+        .values_list('object_id', flat=True)
+    )
+    # ...or down, possibly to nothing
+    affected.update(
+        PostSimilarity.objects
+        .filter(neighbour_ids__overlap=list(changed))
+        .values_list('post_id', flat=True)
+    )
+    return affected
+
+
+def top_neighbours(matrix, post_ids, norms, rows, count=SIMILAR_POSTS_COUNT):
+    """Yields (post_id, [similar post ids]) for the given matrix columns."""
+    by_post = matrix.T.tocsr()
+
+    for start in range(0, len(rows), ROW_CHUNK_SIZE):
+        chunk = rows[start:start + ROW_CHUNK_SIZE]
+        co_votes = (by_post[chunk] @ matrix).tocsr()
+
+        for i, row in enumerate(chunk):
+            begin, end = co_votes.indptr[i], co_votes.indptr[i + 1]
+            columns = co_votes.indices[begin:end]
+            similarity = co_votes.data[begin:end] / \
+                (norms[row] * norms[columns])
+
+            keep = columns != row
+            columns, similarity = columns[keep], similarity[keep]
+
+            if len(columns) > count:
+                top = np.argpartition(-similarity, count - 1)[:count]
+                columns, similarity = columns[top], similarity[top]
+
+            # ties go to the older post to keep lists stable between builds
+            neighbours = post_ids[columns]
+            order = np.lexsort((neighbours, -similarity))
+            yield int(post_ids[row]), neighbours[order].tolist()
+
+
+def save_similarities(items):
+    existing = set(
+        Post.objects
+        .filter(id__in=[post_id for post_id, _ in items])
+        .values_list('id', flat=True)
+    )
+    PostSimilarity.objects.bulk_create(
+        [
+            PostSimilarity(post_id=post_id, neighbour_ids=neighbour_ids)
+            for post_id, neighbour_ids in items
+            if post_id in existing
+        ],
+        update_conflicts=True,
+        unique_fields=['post'],
+        update_fields=['neighbour_ids', 'updated']
+    )
+
+
+def build_similarities(full=False):
+    """
+    Recomputes similar posts, incrementally unless `full` is set
+    or there was no build yet. Returns the number of updated posts.
+    """
+    now = timezone.now()
+    since = now - timedelta(days=VOTE_WINDOW_DAYS)
+    r = get_redis_connection('default')
+    last_build = r.get(LAST_BUILD_KEY)
+    # votes that arrive during the build stay for the next one
+    changed = [int(post_id) for post_id in r.smembers(changed_key(Post))]
+
+    if full or last_build is None:
+        matrix, post_ids, norms = load_upvote_matrix(since)
+        rows = np.arange(len(post_ids))
+        missing = []
+    else:
+        built_at = datetime.fromtimestamp(float(last_build), tz=dt_timezone.utc)
+        affected = sorted(get_affected_post_ids(
+            changed, since, built_at - timedelta(days=VOTE_WINDOW_DAYS)))
+        matrix, post_ids, norms = load_upvote_matrix(since, affected)
+        positions, found = lookup(post_ids, affected)
+        rows = positions[found]
+        # posts without upvotes left have no neighbours
+        missing = np.asarray(affected, dtype=np.int64)[~found].tolist()
+
+    items = [(post_id, []) for post_id in missing]
+    updated = 0
+    for item in top_neighbours(matrix, post_ids, norms, rows):
+        items.append(item)
+        if len(items) >= WRITE_BATCH_SIZE:
+            save_similarities(items)
+            updated += len(items)
+            items = []
+
+    if items:
+        save_similarities(items)
+        updated += len(items)
+
+    if changed:
+        r.srem(changed_key(Post), *changed)
+    r.set(LAST_BUILD_KEY, now.timestamp())
+    return updated
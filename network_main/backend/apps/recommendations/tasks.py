@@ -2,14 +2,36 @@ from celery import shared_task
 
 from django.utils import timezone
 from django.db import transaction
-from django.db.models import Count, F, ExpressionWrapper, FloatField
-from django.db.models.functions import Extract, Random
+from django.db.models import Count
+from django_redis import get_redis_connection
 
 
 from datetime import timedelta
 
 from apps.posts.models import Post
 from apps.communities.models import Community
+from apps.memberships.models import Membership
+from apps.communities.feeds import datetime_to_score, filter_after_cursor
+
+from .feeds import fanout_post, FANOUT_BATCH_SIZE
+from .candidates import (
+    build_candidates,
+    get_active_user_ids,
+    load_candidate_pool,
+    candidates_build_lock_key,
+    USER_BATCH_SIZE
+)
+from .similarity import build_similarities
+from .rollups import compact_vote_rollups
+from .scoring import (
+    RECENT_SCORE_HOURS,
+    SCORE_WINDOW_DAYS,
+    SCORE_BATCH_SIZE,
+    SWEEP_BATCH_SIZE,
+    SWEEP_CURSOR_KEY,
+    pop_dirty_posts,
+    score_expression
+)
 
 
 @shared_task
@@ -61,42 +83,190 @@ def update_community_score():
 @shared_task
 def update_posts_score():
     """
-    A periodic task for recalculating score of recent posts.
+    A periodic task for recalculating score of posts
+    that got votes or comments since the last run.
     """
 
     now = timezone.now()
+    time_threshold = now - timedelta(days=SCORE_WINDOW_DAYS)
+
+    updated = 0
+    while True:
+        post_ids = pop_dirty_posts(SCORE_BATCH_SIZE)
+        if not post_ids:
+            break
 
-    time_threshold = now - timedelta(days=90)
-
-    w_rating = 0.4
-    w_comments = 0.1
-    w_freshness = 0.3
-    w_random = 0.6
-
-    posts_to_update = Post.published.filter(created__gte=time_threshold)
-
-    updated_queryset = posts_to_update.annotate(
-        hours_since_created=ExpressionWrapper(
-            Extract((now - F('created')), 'epoch') / 3600.0,
-            output_field=FloatField()
-        ),
-        freshness=ExpressionWrapper(
-            1.0 / (1.0 + F('hours_since_created')),
-            output_field=FloatField()
-        ),
-        random_factor=ExpressionWrapper(
-            Random() * 0.4,
-            output_field=FloatField()
-        ),
-        new_score=ExpressionWrapper(
-            (w_rating * F('sum_rating')) +
-            (w_comments * F('comment_count')) +
-            (w_freshness * F('freshness')) +
-            (w_random * F('random_factor')),
-            output_field=FloatField()
+        updated += (
+            Post.published
+            .filter(id__in=post_ids, created__gte=time_threshold)
+            .update(score=score_expression(now))
         )
+
+    return f'Updated scores for {updated} posts'
+
+
+def rescore_posts_page(queryset, cursor, now, count):
+    """
+    Rescores the next `count` posts of the queryset after the cursor
+    in (-created, -id) order. Returns the cursor of the last one,
+    None when there are no more posts, and the number of rescored posts.
+    """
+    rows = list(
+        filter_after_cursor(queryset, cursor)
+        .order_by('-created', '-id')
+        .values_list('created', 'id')[:count]
+    )
+    if not rows:
+        return None, 0
+
+    (
+        Post.objects
+        .filter(id__in=[post_id for _, post_id in rows])
+        .update(score=score_expression(now))
+    )
+    created, post_id = rows[-1]
+    return (datetime_to_score(created), post_id), len(rows)
+
+
+@shared_task
+def refresh_recent_posts_score():
+    """
+    A periodic task that rescores the posts of the last
+    RECENT_SCORE_HOURS, where freshness changes the most.
+    """
+
+    now = timezone.now()
+    recent = Post.published.filter(
+        created__gte=now - timedelta(hours=RECENT_SCORE_HOURS))
+
+    updated = 0
+    cursor = None
+    while True:
+        cursor, count = rescore_posts_page(recent, cursor, now, SCORE_BATCH_SIZE)
+        if cursor is None:
+            break
+        updated += count
+
+    return f'Refreshed scores for {updated} recent posts'
+
+
+@shared_task
+def sweep_posts_score():
+    """
+    A periodic task that slowly refreshes the freshness part of the score
+    for older posts in the scoring window, newest first, one chunk per run.
+    """
+
+    now = timezone.now()
+    older = Post.published.filter(
+        created__gte=now - timedelta(days=SCORE_WINDOW_DAYS),
+        created__lt=now - timedelta(hours=RECENT_SCORE_HOURS)
     )
 
-    updated_queryset.update(score=F('new_score'))
+    r = get_redis_connection('default')
+    score, _, post_id = (r.get(SWEEP_CURSOR_KEY) or b'').decode().partition(',')
+    # an id-only cursor of the old ascending sweep starts over
+    cursor = (int(score), int(post_id)) if post_id else None
+
+    cursor, count = rescore_posts_page(older, cursor, now, SWEEP_BATCH_SIZE)
+    if cursor is None:
+        # the window is done, start over on the next run
+        r.delete(SWEEP_CURSOR_KEY)
+        return 'Sweep finished'
+
+    r.set(SWEEP_CURSOR_KEY, f'{cursor[0]},{cursor[1]}')
+    return f'Swept scores for {count} posts'
+
+
+@shared_task
+def fanout_post_to_members(post_id):
+    """
+    Pushes a new post into the home feed inboxes of community members.
+    Only inboxes that are already materialized are updated.
+    """
 
-    return f'Updated scores for {updated_queryset.count()} score'
+    post = (
+        Post.published
+        .filter(pk=post_id)
+        .values('id', 'community_id', 'created')
+        .first()
+    )
+    if post is None:
+        return f'Post {post_id} is not published'
+
+    member_ids = (
+        Membership.objects
+        .filter(community_id=post['community_id'])
+        .order_by('id')
+        .values_list('user_id', flat=True)
+    )
+
+    batch = []
+    total = 0
+    for user_id in member_ids.iterator(chunk_size=FANOUT_BATCH_SIZE):
+        batch.append(user_id)
+        if len(batch) == FANOUT_BATCH_SIZE:
+            fanout_post(post['id'], post['created'], batch)
+            total += len(batch)
+            batch = []
+
+    if batch:
+        fanout_post(post['id'], post['created'], batch)
+        total += len(batch)
+
+    return f'Post {post_id} pushed to {total} members'
+
+
+@shared_task
+def update_user_candidates():
+    """
+    A periodic task that precomputes recommendation candidates
+    for recently active users.
+    """
+
+    now = timezone.now()
+    pool = load_candidate_pool(now)
+
+    total = 0
+    batch = []
+    for user_id in get_active_user_ids(now).iterator(chunk_size=USER_BATCH_SIZE):
+        batch.append(user_id)
+        if len(batch) == USER_BATCH_SIZE:
+            total += build_candidates(batch, pool=pool, now=now)
+            batch = []
+
+    if batch:
+        total += build_candidates(batch, pool=pool, now=now)
+
+    return f'Built candidates for {total} users'
+
+
+@shared_task
+def build_user_candidates(user_id):
+    """
+    Builds candidates for a single user after a cache miss.
+    """
+
+    build_candidates([user_id])
+    get_redis_connection('default').delete(candidates_build_lock_key(user_id))
+    return f'Built candidates for user {user_id}'
+
+
+@shared_task
+def update_post_similarity(full=False):
+    """
+    A periodic task that refreshes related posts
+    of the posts whose co-votes changed, or of all posts if `full`.
+    """
+
+    updated = build_similarities(full=full)
+    return f'Updated similar posts for {updated} posts'
+
+
+@shared_task
+def compact_post_vote_rollups():
+    """
+    A periodic task that folds old hourly vote buckets into daily ones.
+    """
+    folded = compact_vote_rollups()
+    return f'Folded {folded} hourly vote buckets'
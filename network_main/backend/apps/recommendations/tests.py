@@ -1,12 +1,16 @@
 import pytest
+from io import StringIO
 from datetime import timedelta
+from unittest.mock import patch
 from django.utils import timezone
+from django.test import TestCase
 
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
 from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
 
 
 from apps.users.models import CustomUser
@@ -15,15 +19,47 @@ from apps.communities.models import Community
 from apps.memberships.models import Membership
 from apps.posts.models import Post, Comment, Media
 from apps.ratings.models import Rating
+from apps.ratings.tasks import flush_pending_ratings
 from apps.posts.views import (
     get_annotated_ratings,
     get_optimized_post_queryset
 )
-from apps.recommendations.views import (
-    get_user_recommendations,
-    get_trending_posts
+from apps.recommendations.views import get_trending_posts
+from apps.recommendations.tasks import (
+    update_posts_score,
+    update_user_candidates,
+    sweep_posts_score,
+    refresh_recent_posts_score,
+    fanout_post_to_members
 )
-from apps.recommendations.tasks import update_posts_score
+from apps.recommendations import tasks as recommendation_tasks
+from apps.recommendations.models import PostSimilarity, PostVoteRollup
+from apps.recommendations.rollups import compact_vote_rollups
+from apps.recommendations.similarity import (
+    build_similarities,
+    LAST_BUILD_KEY,
+    VOTE_WINDOW_DAYS
+)
+from apps.recommendations.candidates import (
+    candidates_build_lock_key,
+    candidates_key
+)
+from apps.recommendations.ranked import (
+    store_ranked_lists,
+    get_ranked_page,
+    decode_ranked_cursor,
+    generation_key
+)
+from apps.recommendations.scoring import (
+    DIRTY_POSTS_KEY,
+    SWEEP_CURSOR_KEY,
+    compute_hot_key,
+    hot_key_expression
+)
+from apps.recommendations.feeds import home_feed_key
+from apps.communities.feeds import rebuild_feed, datetime_to_score
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
 
 
 @pytest.fixture(autouse=True)
@@ -162,47 +198,6 @@ def media_file(post):
 
 @pytest.mark.django_db
 class TestPostRecommendations:
-    def test_get_user_recommendations_authenticated(self, authenticated_client, test_user, post, community):
-        post_content_type = ContentType.objects.get_for_model(Post)
-        Rating.objects.create(
-            content_type=post_content_type,
-            object_id=post.id,
-            user=test_user,
-            value=1,
-        )
-
-        request = authenticated_client.get(
-            reverse('post-recommendations')).wsgi_request
-        request.user = test_user
-        queryset = get_user_recommendations(request)
-
-        assert queryset.count() >= 0
-        for post in queryset:
-            assert hasattr(post, 'sum_rating')
-            assert hasattr(post, 'comment_count')
-            assert hasattr(post, 'freshness')
-            assert hasattr(post, 'community_relevance')
-            assert hasattr(post, 'score')
-            assert post.user_vote is not None
-
-    def test_get_user_recommendations_excludes_liked_posts(self, authenticated_client, test_user, post, community):
-        cache.clear()
-
-        post_content_type = ContentType.objects.get_for_model(Post)
-        Rating.objects.create(
-            content_type=post_content_type,
-            object_id=post.id,
-            user=test_user,
-            value=1,
-        )
-
-        request = authenticated_client.get(
-            reverse('post-recommendations')).wsgi_request
-        request.user = test_user
-        queryset = get_user_recommendations(request)
-
-        assert post.id not in queryset.values_list('id', flat=True)
-
     def test_get_trending_posts(self, api_client, post):
         cache.clear()
 
@@ -230,16 +225,19 @@ class TestPostRecommendations:
 
         assert post.id not in queryset.values_list('id', flat=True)
 
-    def test_get_annotated_ratings_authenticated(self, authenticated_client, test_user, post):
+    def test_get_annotated_ratings_authenticated(self, authenticated_client, test_user, post,
+                                                 django_capture_on_commit_callbacks):
         cache.clear()
 
         post_content_type = ContentType.objects.get_for_model(Post)
-        Rating.objects.create(
-            content_type=post_content_type,
-            object_id=post.id,
-            user=test_user,
-            value=1,
-        )
+        with django_capture_on_commit_callbacks(execute=True):
+            Rating.objects.create(
+                content_type=post_content_type,
+                object_id=post.id,
+                user=test_user,
+                value=1,
+            )
+        flush_pending_ratings()
 
         request = authenticated_client.get(
             reverse('post-recommendations')).wsgi_request
@@ -299,9 +297,9 @@ class TestPostRecommendations:
 
         post.created = timezone.now() - timedelta(hours=1)
         post.status = 'PB'
-        post.sum_rating = 10
-        post.comment_count = 5
         post.save()
+        # counters are not written by save
+        Post.objects.filter(pk=post.pk).update(sum_rating=10, comment_count=5)
 
         update_posts_score()
 
@@ -387,3 +385,657 @@ class TestCommunityRecommendationsView:
         assert response.data['type'] == 'just_popular_communities'
         recs = response.data['recommendations']
         assert recs[0]['slug'] == community_gaming.slug
+
+
+@pytest.mark.django_db
+class TestHomeFeed:
+
+    @pytest.fixture
+    def subscribed_posts(self, test_user, second_user, community_python, community_gaming, community_django):
+        Membership.objects.create(user=test_user, community=community_python)
+        Membership.objects.create(user=test_user, community=community_gaming)
+        # gaming is big enough to be pulled at read time
+        Community.objects.filter(pk=community_gaming.pk).update(
+            members_count=5000)
+
+        now = timezone.now()
+        posts = []
+        for i, community in enumerate([community_python, community_gaming] * 20):
+            post = Post.objects.create(
+                author=second_user,
+                title=f'homepost_{i}',
+                community=community,
+                status='PB'
+            )
+            Post.objects.filter(pk=post.pk).update(
+                created=now - timedelta(minutes=i))
+            posts.append(post)
+
+        Post.objects.create(
+            author=second_user,
+            title='not subscribed',
+            community=community_django,
+            status='PB'
+        )
+        return posts
+
+    def collect_ids(self, client):
+        ids = []
+        params = {}
+        while True:
+            response = client.get(reverse('home-feed'), params)
+            assert response.status_code == status.HTTP_200_OK
+            ids.extend(r['id'] for r in response.data['results'])
+            if not response.data['next_cursor']:
+                return ids
+            params = {'cursor': response.data['next_cursor']}
+
+    def test_home_feed_unauthenticated(self, api_client):
+        response = api_client.get(reverse('home-feed'))
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+    def test_home_feed_without_memberships(self, authenticated_client):
+        response = authenticated_client.get(reverse('home-feed'))
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['results'] == []
+
+    def test_home_feed_merges_subscriptions(self, authenticated_client, subscribed_posts, community_gaming):
+        expected = [post.id for post in subscribed_posts]
+
+        # pulled community feed is cold, served from Postgres
+        assert self.collect_ids(authenticated_client) == expected
+
+        rebuild_feed(community_gaming.id)
+        assert self.collect_ids(authenticated_client) == expected
+
+    def test_home_feed_pages_posts_with_same_created(self, authenticated_client, subscribed_posts,
+                                                     community_gaming, monkeypatch):
+        monkeypatch.setattr('apps.recommendations.views.HomeFeedView.page_size', 4)
+        now = timezone.now()
+        for i, post in enumerate(subscribed_posts):
+            Post.objects.filter(pk=post.pk).update(
+                created=now - timedelta(minutes=i // 6))
+        expected = list(
+            Post.objects
+            .filter(pk__in=[post.id for post in subscribed_posts])
+            .order_by('-created', '-id')
+            .values_list('id', flat=True)
+        )
+
+        assert self.collect_ids(authenticated_client) == expected
+
+        rebuild_feed(community_gaming.id)
+        assert self.collect_ids(authenticated_client) == expected
+
+    def test_fanout_pushes_into_warm_inbox(self, authenticated_client, test_user, second_user,
+                                           subscribed_posts, community_python):
+        authenticated_client.get(reverse('home-feed'))
+
+        new_post = Post.objects.create(
+            author=second_user,
+            title='fresh post',
+            community=community_python,
+            status='PB'
+        )
+        fanout_post_to_members(new_post.id)
+
+        r = get_redis_connection('default')
+        assert r.zscore(home_feed_key(test_user.id), new_post.id) is not None
+
+        response = authenticated_client.get(reverse('home-feed'))
+        assert response.data['results'][0]['id'] == new_post.id
+
+    def test_publishing_a_draft_fans_out(self, second_user, community_python,
+                                         django_capture_on_commit_callbacks):
+        draft = Post.objects.create(
+            author=second_user,
+            title='draft post',
+            community=community_python,
+            status='DF'
+        )
+        with patch('apps.posts.signals.fanout_post_to_members') as fanout:
+            with django_capture_on_commit_callbacks(execute=True):
+                draft = Post.objects.get(pk=draft.pk)
+                draft.status = 'PB'
+                draft.save()
+                # saving the published post again does not push it twice
+                draft.save()
+        fanout.delay.assert_called_once_with(draft.pk)
+
+    def test_membership_change_drops_inbox(self, authenticated_client, test_user, subscribed_posts,
+                                           community_django):
+        authenticated_client.get(reverse('home-feed'))
+        r = get_redis_connection('default')
+        assert r.exists(home_feed_key(test_user.id))
+
+        Membership.objects.create(user=test_user, community=community_django)
+        assert not r.exists(home_feed_key(test_user.id))
+
+        ids = self.collect_ids(authenticated_client)
+        assert Post.objects.get(title='not subscribed').id in ids
+
+    def test_communities_over_pull_limit_are_read(self, authenticated_client, subscribed_posts,
+                                                  community_python, community_gaming, monkeypatch):
+        monkeypatch.setattr('apps.recommendations.feeds.MAX_PULLED_COMMUNITIES', 1)
+        Community.objects.filter(pk=community_python.pk).update(members_count=5000)
+        rebuild_feed(community_python.id)
+        rebuild_feed(community_gaming.id)
+
+        expected = [post.id for post in subscribed_posts]
+        assert self.collect_ids(authenticated_client) == expected
+
+    def test_home_feed_without_redis(self, authenticated_client, subscribed_posts, monkeypatch):
+        def fail(*args, **kwargs):
+            raise RedisError('down')
+
+        monkeypatch.setattr(
+            'apps.recommendations.feeds.get_redis_connection', fail)
+
+        expected = [post.id for post in subscribed_posts]
+        assert self.collect_ids(authenticated_client) == expected
+
+
+@pytest.mark.django_db
+class TestPostScoring:
+
+    @pytest.fixture
+    def posts(self, test_user, community):
+        posts = [
+            Post.objects.create(
+                author=test_user,
+                title=f'scored_{i}',
+                community=community,
+                status='PB',
+            )
+            for i in range(3)
+        ]
+        # start from a clean dirty set
+        cache.clear()
+        return posts
+
+    def test_only_dirty_posts_are_rescored(self, test_user, posts):
+        Comment.objects.create(post=posts[0], author=test_user, content='hi')
+
+        update_posts_score()
+
+        scores = dict(Post.objects.values_list('id', 'score'))
+        assert scores[posts[0].id] > 0
+        assert scores[posts[1].id] == 0
+        assert scores[posts[2].id] == 0
+
+        r = get_redis_connection('default')
+        assert not r.exists(DIRTY_POSTS_KEY)
+
+    def test_flushed_votes_mark_post_dirty(self, test_user, posts,
+                                           django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            Rating.objects.create(
+                content_type=ContentType.objects.get_for_model(Post),
+                object_id=posts[1].id,
+                user=test_user,
+                value=1,
+            )
+        r = get_redis_connection('default')
+        # the score must not be computed from a stale sum_rating
+        assert not r.sismember(DIRTY_POSTS_KEY, posts[1].id)
+
+        flush_pending_ratings()
+        assert r.sismember(DIRTY_POSTS_KEY, posts[1].id)
+
+    def age(self, posts, days):
+        # posts[0] is the newest
+        now = timezone.now()
+        for i, post in enumerate(posts):
+            Post.objects.filter(id=post.id).update(
+                created=now - timedelta(days=days, hours=i))
+        return [Post.objects.get(id=post.id) for post in posts]
+
+    def test_recent_posts_are_refreshed(self, posts):
+        old = self.age(posts[2:], days=3)[0]
+
+        assert refresh_recent_posts_score() == 'Refreshed scores for 2 recent posts'
+        scores = dict(Post.objects.values_list('id', 'score'))
+        assert scores[posts[0].id] > 0
+        assert scores[posts[1].id] > 0
+        assert scores[old.id] == 0
+
+    def test_sweep_walks_window_in_chunks(self, posts, monkeypatch):
+        monkeypatch.setattr(recommendation_tasks, 'SWEEP_BATCH_SIZE', 2)
+        posts = self.age(posts, days=3)
+        r = get_redis_connection('default')
+        # a cursor of the old ascending sweep starts over
+        r.set(SWEEP_CURSOR_KEY, posts[2].id)
+
+        assert sweep_posts_score() == 'Swept scores for 2 posts'
+        assert r.get(SWEEP_CURSOR_KEY).decode() == (
+            f'{datetime_to_score(posts[1].created)},{posts[1].id}')
+        assert Post.objects.get(id=posts[2].id).score == 0
+
+        sweep_posts_score()
+        assert all(
+            score > 0 for score in Post.objects.values_list('score', flat=True))
+
+        assert sweep_posts_score() == 'Sweep finished'
+        assert not r.exists(SWEEP_CURSOR_KEY)
+
+    def test_sweep_skips_recent_posts(self, posts):
+        assert sweep_posts_score() == 'Sweep finished'
+        assert set(Post.objects.values_list('score', flat=True)) == {0}
+
+
+@pytest.mark.django_db
+class TestHotKey:
+
+    def test_sql_and_python_hot_keys_match(self, test_user, post,
+                                           django_capture_on_commit_callbacks):
+        Comment.objects.create(post=post, author=test_user, content='hi')
+        with django_capture_on_commit_callbacks(execute=True):
+            Rating.objects.create(
+                content_type=ContentType.objects.get_for_model(Post),
+                object_id=post.id,
+                user=test_user,
+                value=-1,
+            )
+        flush_pending_ratings()
+
+        post.refresh_from_db()
+        assert post.sum_rating == -1
+        assert post.comment_count == 1
+        assert post.hot_key == pytest.approx(
+            compute_hot_key(-1, 1, post.created))
+
+        Post.objects.filter(id=post.id).update(hot_key=hot_key_expression())
+        post.refresh_from_db()
+        assert post.hot_key == pytest.approx(
+            compute_hot_key(-1, 1, post.created))
+
+    def test_trending_prefers_newer_posts_with_equal_votes(self, test_user, community):
+        old = Post.objects.create(
+            author=test_user, title='old', community=community, status='PB')
+        Post.objects.filter(id=old.id).update(
+            created=timezone.now() - timedelta(days=1))
+        Post.objects.filter(id=old.id).update(hot_key=hot_key_expression())
+
+        popular = Post.objects.create(
+            author=test_user, title='popular', community=community,
+            status='PB', sum_rating=100)
+        new = Post.objects.create(
+            author=test_user, title='new', community=community, status='PB')
+
+        ids = list(get_trending_posts(days=3).values_list('id', flat=True))
+        assert ids == [popular.id, new.id, old.id]
+
+    def test_benchmark_command(self, post):
+        out = StringIO()
+        call_command('benchmark_trending', runs=1, stdout=out)
+
+        output = out.getvalue()
+        assert '-score' in output
+        assert '-hot_key' in output
+
+
+@pytest.mark.django_db
+class TestUserCandidates:
+
+    def candidates(self, user):
+        r = get_redis_connection('default')
+        return [int(i) for i in r.zrange(candidates_key(user.id), 0, -1)]
+
+    @pytest.fixture
+    def pool_posts(self, second_user, community_python, community_gaming):
+        posts = {}
+        for community in (community_python, community_gaming):
+            for i in range(3):
+                post = Post.objects.create(
+                    author=second_user,
+                    title=f'{community.slug}_{i}',
+                    community=community,
+                    status='PB',
+                )
+                posts[post.title] = post
+        Post.objects.update(score=1.0)
+        return posts
+
+    def test_candidates_follow_community_affinity(self, test_user, pool_posts,
+                                                  community_python):
+        Membership.objects.create(user=test_user, community=community_python)
+        voted = pool_posts['gamers_0']
+        Rating.objects.create(
+            content_type=ContentType.objects.get_for_model(Post),
+            object_id=voted.id,
+            user=test_user,
+            value=-1,
+        )
+
+        update_user_candidates()
+
+        ids = self.candidates(test_user)
+        python_ids = {p.id for p in pool_posts.values()
+                      if p.community_id == community_python.id}
+        assert set(ids[:3]) == python_ids
+        assert voted.id not in ids
+        assert len(ids) == 5
+
+    def test_view_reads_candidates_with_realtime_boost(self, authenticated_client, test_user,
+                                                        second_user, pool_posts, community_python):
+        Membership.objects.create(user=test_user, community=community_python)
+        Rating.objects.create(
+            content_type=ContentType.objects.get_for_model(Post),
+            object_id=pool_posts['gamers_0'].id,
+            user=test_user,
+            value=1,
+        )
+        update_user_candidates()
+        candidates = self.candidates(test_user)
+
+        fresh = Post.objects.create(
+            author=second_user,
+            title='fresh',
+            community=community_python,
+            status='PB',
+        )
+
+        response = authenticated_client.get(reverse('post-recommendations'))
+        ids = [item['id'] for item in response.data['results']]
+        assert ids == [fresh.id] + candidates
+
+    def test_candidates_without_redis(self, authenticated_client, test_user, pool_posts, monkeypatch):
+        def fail(*args, **kwargs):
+            raise RedisError('down')
+
+        monkeypatch.setattr('apps.recommendations.ranked.get_redis_connection', fail)
+        monkeypatch.setattr('apps.recommendations.views.PostRecommendationView.page_size', 2)
+
+        ids = []
+        params = {}
+        while True:
+            response = authenticated_client.get(reverse('post-recommendations'), params)
+            assert response.status_code == status.HTTP_200_OK
+            ids.extend(item['id'] for item in response.data['results'])
+            if not response.data['next_cursor']:
+                break
+            params = {'cursor': response.data['next_cursor']}
+
+        assert ids == list(get_trending_posts(days=30).values_list('id', flat=True))
+
+    def test_cache_miss_falls_back_to_trending(self, authenticated_client, test_user, pool_posts):
+        response = authenticated_client.get(reverse('post-recommendations'))
+
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data['results']) == len(pool_posts)
+
+        r = get_redis_connection('default')
+        assert r.exists(candidates_build_lock_key(test_user.id))
+        assert not r.exists(generation_key(candidates_key(test_user.id)))
+
+
+@pytest.mark.django_db
+class TestRelatedPosts:
+
+    @pytest.fixture
+    def voters(self):
+        return [
+            CustomUser.objects.create_user(
+                username=f'voter{i}',
+                email=f'voter{i}@example.com',
+                password='testpassword',
+                is_active=True
+            )
+            for i in range(4)
+        ]
+
+    @pytest.fixture
+    def related_posts(self, test_user, community):
+        return [
+            Post.objects.create(
+                author=test_user,
+                title=f'related_{name}',
+                community=community,
+                status='PB'
+            )
+            for name in 'abc'
+        ]
+
+    def upvote(self, user, post, value=1):
+        # changed posts are recorded on commit
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            return Rating.objects.create(
+                content_type=ContentType.objects.get_for_model(Post),
+                object_id=post.id,
+                user=user,
+                value=value,
+            )
+
+    def neighbours(self, post):
+        return PostSimilarity.objects.get(post=post).neighbour_ids
+
+    def test_full_and_incremental_build(self, voters, related_posts):
+        a, b, c = related_posts
+        for user in voters[:2]:
+            self.upvote(user, a)
+            self.upvote(user, b)
+        self.upvote(voters[2], a)
+        self.upvote(voters[2], c)
+
+        assert build_similarities() == 3
+        assert self.neighbours(a) == [b.id, c.id]
+        assert self.neighbours(b) == [a.id]
+        assert self.neighbours(c) == [a.id]
+
+        self.upvote(voters[3], b)
+        self.upvote(voters[3], c)
+
+        # the voted posts and the posts co-voted with them
+        assert build_similarities() == 3
+        assert self.neighbours(b) == [a.id, c.id]
+        assert self.neighbours(c) == [a.id, b.id]
+
+        # nothing changed since
+        assert build_similarities() == 0
+
+    def test_unvote_and_flip_are_rebuilt(self, voters, related_posts):
+        a, b, c = related_posts
+        self.upvote(voters[0], a)
+        self.upvote(voters[0], b)
+        flipped = self.upvote(voters[1], a)
+        self.upvote(voters[1], c)
+        build_similarities()
+        assert self.neighbours(a) == [b.id, c.id]
+
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            flipped.value = -1
+            flipped.save()
+        build_similarities()
+        assert self.neighbours(a) == [b.id]
+        assert self.neighbours(c) == []
+
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            Rating.objects.filter(user=voters[0], object_id=b.id).get().delete()
+        build_similarities()
+        assert self.neighbours(a) == []
+        assert self.neighbours(b) == []
+
+    def test_expired_upvotes_are_rebuilt(self, voters, related_posts):
+        a, b, _ = related_posts
+        self.upvote(voters[0], a)
+        old = self.upvote(voters[0], b)
+        build_similarities()
+        assert self.neighbours(a) == [b.id]
+
+        r = get_redis_connection('default')
+        r.set(LAST_BUILD_KEY, (timezone.now() - timedelta(hours=2)).timestamp())
+        Rating.objects.filter(pk=old.pk).update(
+            time_created=timezone.now() - timedelta(days=VOTE_WINDOW_DAYS, hours=1))
+        build_similarities()
+        assert self.neighbours(a) == []
+
+    def test_related_endpoint(self, api_client, voters, related_posts):
+        a, b, c = related_posts
+        for user in voters[:2]:
+            self.upvote(user, a)
+            self.upvote(user, b)
+        self.upvote(voters[2], a)
+        self.upvote(voters[2], c)
+        build_similarities()
+
+        url = reverse('post-related', kwargs={'slug': a.slug})
+        response = api_client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert [p['id'] for p in response.data['results']] == [b.id, c.id]
+
+        response = api_client.get(url, {'limit': 1})
+        assert [p['id'] for p in response.data['results']] == [b.id]
+
+    def test_related_endpoint_without_model(self, api_client, post):
+        url = reverse('post-related', kwargs={'slug': post.slug})
+        response = api_client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['results'] == []
+
+        url = reverse('post-related', kwargs={'slug': 'missing'})
+        assert api_client.get(url).status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestRankedLists:
+
+    def test_pages_follow_rank(self):
+        store_ranked_lists({'ranked:test': list(range(100, 160))},
+                           generation=1, timeout=60)
+
+        ids, cursor, generation = get_ranked_page('ranked:test', count=25)
+        assert ids == list(range(100, 125))
+        assert generation == 1
+
+        ids, cursor, _ = get_ranked_page(
+            'ranked:test', decode_ranked_cursor(cursor), count=25)
+        assert ids == list(range(125, 150))
+
+        ids, cursor, _ = get_ranked_page(
+            'ranked:test', decode_ranked_cursor(cursor), count=25)
+        assert ids == list(range(150, 160))
+        assert cursor is None
+
+    def test_cursor_survives_rebuild(self):
+        store_ranked_lists({'ranked:test': list(range(100, 150))},
+                           generation=1, timeout=60)
+        _, cursor, _ = get_ranked_page('ranked:test', count=10)
+
+        # two new items ranked on top, the last seen id moved down
+        store_ranked_lists({'ranked:test': [1, 2] + list(range(100, 150))},
+                           generation=2, timeout=60)
+        ids, _, generation = get_ranked_page(
+            'ranked:test', decode_ranked_cursor(cursor), count=10)
+        assert ids == list(range(110, 120))
+        assert generation == 2
+
+        # the last seen id is gone, continue at the same position
+        store_ranked_lists({'ranked:test': list(range(200, 250))},
+                           generation=3, timeout=60)
+        ids, _, _ = get_ranked_page(
+            'ranked:test', decode_ranked_cursor(cursor), count=10)
+        assert ids == list(range(210, 220))
+
+    def test_missing_list(self):
+        assert get_ranked_page('ranked:missing') is None
+
+        store_ranked_lists({'ranked:empty': []}, generation=1, timeout=60)
+        assert get_ranked_page('ranked:empty') == ([], None, 1)
+
+    def test_trending_view_pages(self, api_client, test_user, community):
+        for i in range(30):
+            Post.objects.create(
+                author=test_user,
+                title=f'ranked_{i}',
+                community=community,
+                status='PB'
+            )
+
+        url = reverse('post-recommendations')
+        first = api_client.get(url)
+        second = api_client.get(url, {'cursor': first.data['next_cursor']})
+
+        ids = [p['id'] for p in first.data['results'] + second.data['results']]
+        assert len(ids) == 30
+        assert len(set(ids)) == 30
+        assert second.data['next_cursor'] is None
+
+        response = api_client.get(url, {'cursor': 'garbage'})
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestVoteRollups:
+
+    def rollup(self, post, net, age, span='hour'):
+        bucket = (timezone.now() - age).replace(minute=0, second=0, microsecond=0)
+        if span == 'day':
+            bucket = bucket.replace(hour=0)
+        return PostVoteRollup.objects.create(
+            post=post, community_id=post.community_id,
+            span=span, bucket=bucket, net=net
+        )
+
+    def test_votes_are_rolled_up_per_hour(self, api_client, test_user, second_user, post):
+        url = reverse('post-ratings', kwargs={'slug': post.slug})
+        for user in (test_user, second_user):
+            api_client.force_authenticate(user=user)
+            api_client.post(url, {'value': 1})
+        flush_pending_ratings()
+
+        rollup = PostVoteRollup.objects.get(post=post)
+        assert (rollup.span, rollup.net, rollup.community_id) == (
+            'hour', 2, post.community_id)
+        assert rollup.bucket == timezone.now().replace(
+            minute=0, second=0, microsecond=0)
+
+        # a changed vote adds its difference, a removed one takes it back
+        api_client.post(url, {'value': -1})
+        api_client.force_authenticate(user=test_user)
+        api_client.delete(url)
+        flush_pending_ratings()
+        assert PostVoteRollup.objects.get(post=post).net == -1
+
+    def test_windows(self, api_client, test_user, community, second_user):
+        other = Community.objects.create(
+            creator=second_user, name='othercommunity', slug='othercommunity')
+        recent, old, elsewhere = [
+            Post.objects.create(author=test_user, title=f'windowed {i}',
+                                community=c, status='PB')
+            for i, c in enumerate((community, community, other))
+        ]
+        self.rollup(recent, 3, timedelta(minutes=30))
+        self.rollup(elsewhere, 5, timedelta(hours=2))
+        self.rollup(old, 10, timedelta(days=10), span='day')
+        Post.objects.filter(id=recent.id).update(sum_rating=20)
+
+        url = reverse('post-recommendations')
+        expected = {
+            'hour': [recent.id],
+            'day': [elsewhere.id, recent.id],
+            'month': [old.id, elsewhere.id, recent.id],
+            'all': [recent.id, elsewhere.id, old.id],
+        }
+        for window, ids in expected.items():
+            response = api_client.get(url, {'window': window})
+            assert [p['id'] for p in response.data['results']][:len(ids)] == ids
+
+        url = reverse('community-posts-list',
+                      kwargs={'community_slug': community.slug})
+        response = api_client.get(url, {'window': 'month'})
+        assert [p['id'] for p in response.data['results']] == [old.id, recent.id]
+        assert 'author_slug' in response.data['results'][0]
+
+        response = api_client.get(url, {'window': 'year'})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_compaction_folds_old_hours_into_days(self, post):
+        self.rollup(post, 2, timedelta(days=5, hours=1))
+        self.rollup(post, 3, timedelta(days=5, hours=2))
+        recent = self.rollup(post, 7, timedelta(hours=1))
+        assert compact_vote_rollups(batch_size=1) == 2
+
+        daily = PostVoteRollup.objects.get(post=post, span='day')
+        assert daily.net == 5
+        assert daily.bucket.hour == 0
+        assert PostVoteRollup.objects.filter(span='hour').get() == recent
@@ -1,10 +1,12 @@
 from django.urls import path
 
-from .views import CommunityRecommendationView, PostRecommendationView
+from .views import CommunityRecommendationView, PostRecommendationView, HomeFeedView
 
 urlpatterns = [
     path('posts/', PostRecommendationView.as_view(),
          name='post-recommendations'),
+    path('home/', HomeFeedView.as_view(),
+         name='home-feed'),
     path('communities/', CommunityRecommendationView.as_view(),
          name='community-recommendations'),
 ]
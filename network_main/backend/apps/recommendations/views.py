@@ -1,57 +1,46 @@
+import logging
 from datetime import timedelta
-from functools import partial
 
 from rest_framework import generics
 from rest_framework.response import Response
 from rest_framework.pagination import CursorPagination
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.exceptions import NotFound
 
-from django.db.models import (
-    Exists, OuterRef, Case,
-    When, Value, F
-)
-from django.db.models.fields import FloatField
-from django.contrib.contenttypes.models import ContentType
+from django.db.models import Exists, OuterRef
 from django.core.cache import cache
 from django.utils import timezone
+from redis.exceptions import RedisError
 
 from apps.communities.models import Community
 from apps.posts.models import Post
 from apps.posts.views import get_optimized_post_queryset
+from apps.posts.cards import render_post_cards_by_ids
 from apps.posts.serializers import PostListSerializer
-from apps.ratings.models import Rating
 from apps.communities.serializers import CommunityListSerializer
+from apps.communities.feeds import (
+    encode_feed_cursor,
+    decode_feed_cursor,
+    datetime_to_score
+)
 
+from .feeds import get_home_feed_page
+from .candidates import candidates_key, schedule_candidates_build
+from .ranked import (
+    get_ranked_page,
+    store_ranked_lists,
+    encode_ranked_cursor,
+    decode_ranked_cursor
+)
+from .rollups import parse_window, get_top_page
 
-def get_user_recommendations(request):
-    user = request.user
-    post_content_type = ContentType.objects.get_for_model(Post)
-
-    liked_posts = Rating.objects.filter(
-        user=user, value=1, content_type=post_content_type
-    ).values_list('object_id', flat=True)[:30]
 
-    liked_communities = Post.objects.filter(
-        id__in=liked_posts
-    ).values_list('community_id', flat=True).distinct()
+logger = logging.getLogger(__name__)
 
-    time_threshold = timezone.now() - timedelta(days=90)
-    queryset = Post.published.filter(
-        created__gte=time_threshold
-    ).exclude(id__in=liked_posts)
 
-    w_community = 0.6
-
-    queryset = queryset.annotate(
-        community_relevance=Case(
-            When(community_id__in=liked_communities, then=Value(w_community)),
-            default=0.1,
-            output_field=FloatField()
-        ),
-        personalized_score=F('score') + F('community_relevance')
-    ).order_by('-personalized_score')
-
-    return queryset
+REALTIME_BOOST_SIZE = 10
+TRENDING_KEY = 'posts:trending'
+TRENDING_TIMEOUT = 240
 
 
 def get_trending_posts(days=3):
@@ -59,82 +48,150 @@ def get_trending_posts(days=3):
 
     queryset = Post.published.filter(
         created__gte=time_threshold
-    ).order_by('-score')
+    ).order_by('-hot_key')
 
     return queryset
 
 
-def paginate_ids_by_cursor(post_ids, cursor_id, page_size=25):
-    """
-    Finds cursor_id in the list and returns the next batch
-    """
-    if not cursor_id:
-        return post_ids[:page_size], post_ids[page_size] if len(post_ids) > page_size else None
-    try:
-        cursor_index = post_ids.index(int(cursor_id))
+def get_trending_page(cursor, count):
+    page = get_ranked_page(TRENDING_KEY, cursor, count)
+
+    if page is None:
+        queryset = get_trending_posts(days=30)
+        post_ids = list(queryset.values_list('id', flat=True)[:2000])
+        store_ranked_lists(
+            {TRENDING_KEY: post_ids},
+            generation=datetime_to_score(timezone.now()),
+            timeout=TRENDING_TIMEOUT
+        )
+        page = get_ranked_page(TRENDING_KEY, cursor, count)
 
-        start_index = cursor_index + 1
-        end_index = start_index + page_size
+    return page
 
-        page_ids = post_ids[start_index:end_index]
 
-        next_cursor = page_ids[-1] if len(page_ids) > 0 and len(
-            post_ids) > end_index else None
+def get_trending_fallback_page(cursor, count):
+    """
+    Trending posts paged by position straight from Postgres, for when
+    Redis is unavailable. The cursors are those of the ranked lists.
+    """
+    start = cursor[1] if cursor else 0
+    post_ids = list(
+        get_trending_posts(days=30)
+        .values_list('id', flat=True)[start:start + count + 1]
+    )
+
+    next_cursor = None
+    if len(post_ids) > count:
+        post_ids = post_ids[:count]
+        next_cursor = encode_ranked_cursor(0, start + count, post_ids[-1])
+    return post_ids, next_cursor, 0
 
-        return page_ids, next_cursor
 
-    except ValueError:
-        return [], None
+def get_personalized_page(user_id, cursor, count):
+    """
+    Precomputed candidates of the user, the first page starts with fresh
+    posts from their communities. Falls back to trending until candidates
+    are built, and to trending from Postgres without Redis.
+    """
+    try:
+        page = get_ranked_page(candidates_key(user_id), cursor, count)
+        if page is None:
+            schedule_candidates_build(user_id)
+            return get_trending_page(cursor, count)
+    except RedisError as e:
+        logger.warning(f'Failed to read candidates of user {user_id}: {e}')
+        return get_trending_fallback_page(cursor, count)
+
+    post_ids, next_cursor, built_at = page
+    if cursor is None:
+        known = set(post_ids)
+        boost = [
+            post_id
+            for post_id, score in get_home_feed_page(user_id, count=REALTIME_BOOST_SIZE)[0]
+            if score > built_at and post_id not in known
+        ]
+        post_ids = boost + post_ids
+
+    return post_ids, next_cursor, built_at
 
 
 class PostRecommendationView(generics.ListAPIView):
     permission_classes = [AllowAny]
     serializer_class = PostListSerializer
+    page_size = 25
 
     def get_queryset(self):
         return get_optimized_post_queryset(request=self.request)
 
     def list(self, request, *args, **kwargs):
-        cursor_id = request.query_params.get('cursor')
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                cursor = decode_ranked_cursor(cursor)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+        else:
+            cursor = None
 
+        window = parse_window(request)
         if request.user.is_authenticated:
-            cache_key = f'user_recommendations:{request.user.id}'
-            query_function = partial(get_user_recommendations, request)
-            cache_timeout = 300
-
+            page_ids, next_cursor, _ = get_personalized_page(
+                request.user.id, cursor, self.page_size)
+        elif window:
+            page_ids, next_cursor, _ = get_top_page(
+                window, cursor, self.page_size)
         else:
-            cache_key = f'trending_posts_ids'
-            query_function = partial(get_trending_posts, days=30)
-            cache_timeout = 240
+            page_ids, next_cursor, _ = get_trending_page(
+                cursor, self.page_size)
+
+        if not page_ids:
+            return Response({'next_cursor': None, 'results': []})
+
+        return Response({
+            'next_cursor': next_cursor,
+            'results': render_post_cards_by_ids(request, page_ids)
+        })
+
+
+class HomeFeedView(generics.ListAPIView):
+    """
+    Newest posts from the communities the user is subscribed to.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = PostListSerializer
+    page_size = 25
 
-        post_ids = cache.get(cache_key)
+    def get_queryset(self):
+        return get_optimized_post_queryset(request=self.request)
 
-        if post_ids is None:
-            queryset = query_function()
-            post_ids = list(queryset.values_list('id', flat=True)[:2000])
-            cache.set(cache_key, post_ids, timeout=cache_timeout)
+    def list(self, request, *args, **kwargs):
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                cursor = decode_feed_cursor(cursor)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+        else:
+            cursor = None
 
-        page_ids, next_cursor = paginate_ids_by_cursor(
-            post_ids,
-            cursor_id,
-            page_size=25
+        entries, more = get_home_feed_page(
+            request.user.id,
+            cursor,
+            count=self.page_size
         )
 
+        next_cursor = None
+        if more:
+            post_id, score = entries[-1]
+            next_cursor = encode_feed_cursor(score, post_id)
+
+        page_ids = [post_id for post_id, _ in entries]
         if not page_ids:
             return Response({'next_cursor': None, 'results': []})
 
-        base_queryset = self.get_queryset()
-        preserved_order = Case(*[When(pk=pk_val, then=pos)
-                               for pos, pk_val in enumerate(page_ids)])
-        queryset = base_queryset.filter(
-            pk__in=page_ids
-        ).order_by(preserved_order)
-
-        serializer = self.get_serializer(queryset, many=True)
-
         return Response({
             'next_cursor': next_cursor,
-            'results': serializer.data
+            'results': render_post_cards_by_ids(request, page_ids)
         })
 
 
@@ -0,0 +1,78 @@
+"""
+Queued deletion of stored files.
+
+Files that are no longer referenced are added to a Redis set instead of
+being deleted one request at a time. A periodic task pops them in
+batches of DELETE_BATCH_SIZE and removes each batch with a single S3
+DeleteObjects call; keys that failed are queued again. Other storages
+delete the files one by one. A name popped by a worker that crashed is
+left to the orphaned file collector.
+"""
+import logging
+
+from django.core.files.storage import default_storage
+from django_redis import get_redis_connection
+from storages.backends.s3 import S3Storage
+
+from .utils import delete_s3_file
+
+logger = logging.getLogger(__name__)
+
+
+DELETE_BATCH_SIZE = 1000
+DELETION_QUEUE_KEY = 'storage:deletions'
+
+
+def queue_file_deletion(names):
+    """Queues storage names for deletion, empty names are skipped."""
+    names = [name for name in names if name]
+    if names:
+        get_redis_connection('default').sadd(DELETION_QUEUE_KEY, *names)
+
+
+def delete_objects(storage, names):
+    """
+    Deletes up to DELETE_BATCH_SIZE objects with one request,
+    returns the names that could not be deleted.
+    """
+    keys = {storage._normalize_name(name): name for name in names}
+    response = storage.connection.meta.client.delete_objects(
+        Bucket=storage.bucket_name,
+        Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+    )
+    errors = response.get('Errors', [])
+    for error in errors:
+        logger.error(
+            f"Failed to delete {error['Key']} from S3: {error.get('Message')}")
+    return [keys[error['Key']] for error in errors if error['Key'] in keys]
+
+
+def flush_file_deletions(storage=None, max_batches=None):
+    """Deletes the queued files, returns the number of deleted ones."""
+    storage = storage or default_storage
+    r = get_redis_connection('default')
+
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        names = [name.decode() for name in r.spop(DELETION_QUEUE_KEY, DELETE_BATCH_SIZE)]
+        if not names:
+            break
+        batches += 1
+
+        if isinstance(storage, S3Storage):
+            try:
+                failed = delete_objects(storage, names)
+            except Exception:
+                r.sadd(DELETION_QUEUE_KEY, *names)
+                raise
+            total += len(names) - len(failed)
+            if failed:
+                # retried by the next run
+                r.sadd(DELETION_QUEUE_KEY, *failed)
+                break
+        else:
+            for name in names:
+                delete_s3_file(storage, name)
+            total += len(names)
+    return total
@@ -24,7 +24,7 @@ from rest_framework.exceptions import ErrorDetail
 
 from apps.communities.models import Community
 from apps.memberships.models import Membership
-from apps.posts.models import Post
+from apps.posts.models import Post, DeletionJob
 from .models import CustomUser
 
 
@@ -583,6 +583,17 @@ class TestCustomUserView:
         test_user.refresh_from_db()
         assert test_user.first_name == 'testupdate'
 
+    def test_delete_account(self, api_client, test_user):
+        api_client.force_authenticate(user=test_user)
+        response = api_client.delete(self.url)
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+
+        # the account is removed by a background job
+        test_user.refresh_from_db()
+        assert not test_user.is_active
+        assert DeletionJob.objects.filter(
+            kind='user', target_id=test_user.pk, finished__isnull=True).exists()
+
     def test_update_other_user(self, api_client, test_user):
         other_user = CustomUser.objects.create_user(
             email='other@example.com',
@@ -1,7 +1,7 @@
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.generics import RetrieveUpdateAPIView, CreateAPIView, RetrieveAPIView, ListAPIView
+from rest_framework.generics import RetrieveUpdateDestroyAPIView, CreateAPIView, RetrieveAPIView, ListAPIView
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.pagination import CursorPagination
 
@@ -24,7 +24,13 @@ import jwt
 
 from apps.posts.serializers import PostListSerializer
 from apps.communities.models import Community
-from apps.posts.views import get_optimized_post_queryset
+from apps.posts.deletion import delete_user
+from apps.posts.cards import (
+    published_cards,
+    get_post_cards,
+    drop_deleted_communities,
+    overlay_user_votes
+)
 from apps.services.oauth_tokens import get_google_tokens, get_github_tokens
 from apps.services.utils import (
     get_or_create_social_user,
@@ -64,13 +70,21 @@ class CustomUserView(RetrieveAPIView):
     lookup_field = 'slug'
 
 
-class CustomUserInfoView(RetrieveUpdateAPIView):
+class CustomUserInfoView(RetrieveUpdateDestroyAPIView):
     serializer_class = CustomUserInfoSerializer
     permission_classes = [IsAuthenticated]
 
     def get_object(self):
         return self.request.user
 
+    def destroy(self, request, *args, **kwargs):
+        delete_user(request.user)
+
+        response = Response(status=status.HTTP_204_NO_CONTENT)
+        response.delete_cookie('access_token')
+        response.delete_cookie('refresh_token')
+        return response
+
 
 class UserRegistrationView(CreateAPIView):
     serializer_class = RegisterUserSerializer
@@ -386,8 +400,8 @@ class CustomUserPostsView(ListAPIView):
 
     def get_queryset(self):
         request = self.request
-        queryset = get_optimized_post_queryset(request)
-        queryset = queryset.filter(author__slug=self.kwargs['slug'])
+        queryset = published_cards().filter(
+            author_slug=self.kwargs['slug'])
 
         filter_type = request.query_params.get('filter', 'popular')
 
@@ -403,20 +417,25 @@ class CustomUserPostsView(ListAPIView):
         return queryset
 
     def list(self, request, *args, **kwargs):
-        cursor = request.query_params.get('cursor')
-
-        if cursor is None:
+        # cached pages hold cards without the viewer's votes
+        cache_key = None
+        if request.query_params.get('cursor') is None:
             filter_type = request.query_params.get('filter', 'popular')
             cache_key = f"user_posts_first_page:{self.kwargs['slug']}:{filter_type}"
-            cached_data = cache.get(cache_key)
-            if cached_data is not None:
-                return Response(cached_data)
 
-            response = super().list(request, *args, **kwargs)
-            cache.set(cache_key, response.data, timeout=60 * 15)
-            return response
+        data = cache.get(cache_key) if cache_key else None
+        if data is None:
+            page = self.paginate_queryset(self.get_queryset())
+            data = self.get_paginated_response(get_post_cards(page, request)).data
+            if cache_key:
+                cache.set(cache_key, data, timeout=60 * 15)
+        else:
+            data = {**data, 'results': drop_deleted_communities(data['results'])}
 
-        return super().list(request, *args, **kwargs)
+        return Response({
+            **data,
+            'results': overlay_user_votes(request, data['results'])
+        })
 
 
 class CommunityListCursorPagination(CursorPagination):
@@ -439,6 +458,26 @@ class CustomUserCommunitiesView(ListAPIView):
 
         return queryset
 
+    def without_deleted(self, data):
+        """
+        Drops communities deleted since the page was cached, members'
+        caches are only cleared once the deletion job reaches them.
+        """
+        ids = [item['id'] for item in data['results']]
+        deleted = set(
+            Community.all_objects
+            .filter(id__in=ids, is_deleted=True)
+            .values_list('id', flat=True)
+        )
+        if not deleted:
+            return data
+        return {
+            **data,
+            'results': [
+                item for item in data['results'] if item['id'] not in deleted
+            ],
+        }
+
     def list(self, request, *args, **kwargs):
         slug = self.kwargs['slug']
         cursor = request.query_params.get('cursor')
@@ -447,7 +486,7 @@ class CustomUserCommunitiesView(ListAPIView):
             cache_key = f'user_communities_first_page:{slug}'
             cached_data = cache.get(cache_key)
             if cached_data is not None:
-                return Response(cached_data)
+                return Response(self.without_deleted(cached_data))
 
             response = super().list(request, *args, **kwargs)
             cache.set(cache_key, response.data, timeout=600)
@@ -463,7 +502,9 @@ class CustomUserStatusCheck(APIView):
     def post(self, request):
         user = request.user
         if user.is_authenticated:
-            community_ids = user.user_memberships.values_list(
+            community_ids = user.user_memberships.filter(
+                community__is_deleted=False
+            ).values_list(
                 'community_id',
                 flat=True
             )
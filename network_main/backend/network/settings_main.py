@@ -344,10 +344,75 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'apps.recommendations.tasks.update_posts_score',
         'schedule': crontab(minute='*/5'),
     },
+    'refresh-recent-posts-score-every-minute': {
+        'task': 'apps.recommendations.tasks.refresh_recent_posts_score',
+        'schedule': crontab(minute='*'),
+    },
+    'sweep-posts-score-every-minute': {
+        'task': 'apps.recommendations.tasks.sweep_posts_score',
+        'schedule': crontab(minute='*'),
+    },
+    'reconcile-comment-counts-every-hour': {
+        'task': 'apps.posts.tasks.reconcile_comment_counts',
+        'schedule': crontab(minute=30),
+    },
+    'reconcile-replies-counts-every-hour': {
+        'task': 'apps.posts.tasks.reconcile_replies_counts',
+        'schedule': crontab(minute=40),
+    },
+    'reconcile-rating-sums-every-hour': {
+        'task': 'apps.ratings.tasks.reconcile_rating_sums',
+        'schedule': crontab(minute=50),
+    },
+    'purge-deleted-posts-every-10-minutes': {
+        'task': 'apps.posts.tasks.purge_deleted_posts',
+        'schedule': crontab(minute='*/10'),
+    },
+    'update-user-candidates-every-15-minutes': {
+        'task': 'apps.recommendations.tasks.update_user_candidates',
+        'schedule': crontab(minute='*/15'),
+    },
+    'update-post-similarity-every-30-minutes': {
+        'task': 'apps.recommendations.tasks.update_post_similarity',
+        'schedule': crontab(minute='*/30'),
+    },
+    'rebuild-post-similarity-every-day': {
+        'task': 'apps.recommendations.tasks.update_post_similarity',
+        'schedule': crontab(hour=3, minute=15),
+        'kwargs': {'full': True},
+    },
     'update-community-activity-score-every-10-minutes': {
         'task': 'apps.recommendations.tasks.update_community_score',
         'schedule': crontab(minute='*/10'),
     },
+    'resume-deletion-jobs-every-10-minutes': {
+        'task': 'apps.posts.tasks.resume_deletion_jobs',
+        'schedule': crontab(minute='*/10'),
+    },
+    'compact-post-vote-rollups-every-hour': {
+        'task': 'apps.recommendations.tasks.compact_post_vote_rollups',
+        'schedule': crontab(minute=45),
+    },
+    'flush-storage-deletions-every-minute': {
+        'task': 'apps.posts.tasks.flush_storage_deletions',
+        'schedule': crontab(minute='*'),
+    },
+    'collect-orphaned-storage-files-every-day': {
+        'task': 'apps.posts.tasks.collect_orphaned_storage_files',
+        'schedule': crontab(hour=4, minute=30),
+    },
+    'update-category-trending-every-5-minutes': {
+        'task': 'apps.categories.tasks.update_category_trending',
+        'schedule': crontab(minute='*/5'),
+    },
+    'flush-pending-ratings-every-10-seconds': {
+        'task': 'apps.ratings.tasks.flush_pending_ratings',
+        'schedule': timedelta(seconds=10),
+    },
+    'flush-pending-replies-every-10-seconds': {
+        'task': 'apps.posts.tasks.flush_pending_replies',
+        'schedule': timedelta(seconds=10),
+    },
 }
 
 # Frontend url for email verification
@@ -24,7 +24,7 @@ export default function CommentsSection({
     const [rootComments, setRootComments] = useState<CommentType[]>([]);
     const [hasMoreRoot, setHasMoreRoot] = useState(true);
     const [loadingRoot, setLoadingRoot] = useState(false);
-    const [rootPage, setRootPage] = useState(1);
+    const [rootCursor, setRootCursor] = useState<string | null>(null);
     const [replyTo, setReplyTo] = useState<string | null>(null);
     const commentsMapRef = useRef<Map<number, CommentType>>(new Map());
     const observerTarget = useRef<HTMLDivElement>(null);
@@ -36,6 +36,7 @@ export default function CommentsSection({
             try {
                 const { results, next } = await fetchComments(postSlug);
                 setRootComments(results);
+                setRootCursor(next);
                 setHasMoreRoot(!!next);
 
                 const newMap = new Map<number, CommentType>();
@@ -57,8 +58,8 @@ export default function CommentsSection({
                 if (entry.isIntersecting && hasMoreRoot && !loadingRoot) {
                     setLoadingRoot(true);
                     try {
-                        const { results, next } = await fetchComments(postSlug, rootPage + 1);
-                        setRootPage(prev => prev + 1);
+                        const { results, next } = await fetchComments(postSlug, rootCursor);
+                        setRootCursor(next);
                         setRootComments(prev => [...prev, ...results]);
                         setHasMoreRoot(!!next);
 
@@ -84,7 +85,7 @@ export default function CommentsSection({
                 observer.unobserve(observerTarget.current);
             }
         };
-    }, [hasMoreRoot, loadingRoot, postSlug, rootPage]);
+    }, [hasMoreRoot, loadingRoot, postSlug, rootCursor]);
 
     useEffect(() => {
         if (replyTo === "root" || replyTo != null) {
@@ -114,13 +114,13 @@ describe('api.ts', () => {
     });
 
     describe('comments related', () => {
-        it('fetchComments returns results and next', async () => {
-            const resp = { data: { results: [{ id: 1 }], next: 'https://x?page=2' } };
+        it('fetchComments returns results and next cursor', async () => {
+            const resp = { data: { results: [{ id: 1 }], next: 'https://x/?cursor=abc&page_size=5' } };
             mockedAuthApi.get.mockResolvedValueOnce(resp);
-            const r = await apiModule.fetchComments('slug', 1, 5);
-            expect(mockedAuthApi.get).toHaveBeenCalledWith('/posts/slug/comments/', { params: { page: 1, page_size: 5 } });
+            const r = await apiModule.fetchComments('slug', 'xyz', 5);
+            expect(mockedAuthApi.get).toHaveBeenCalledWith('/posts/slug/comments/', { params: { page_size: 5, cursor: 'xyz' } });
             expect(r.results).toEqual(resp.data.results);
-            expect(r.next).toEqual(resp.data.next);
+            expect(r.next).toEqual('abc');
         });
 
         it('fetchReplies returns list', async () => {
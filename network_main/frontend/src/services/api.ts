@@ -95,16 +95,19 @@ export async function deleteVotePost(slug: string): Promise<VoteResult> {
 
 export async function fetchComments(
     slug: string,
-    page: number = 1,
+    cursor: string | null = null,
     pageSize: number = 10
 ): Promise<{ results: CommentType[]; next: string | null }> {
     try {
-        const response = await api.get(`/posts/${slug}/comments/`, {
-            params: { page, page_size: pageSize }
-        });
+        const params: { page_size: number; cursor?: string } = { page_size: pageSize };
+        if (cursor) params.cursor = cursor;
+        const response = await api.get(`/posts/${slug}/comments/`, { params });
+        const next = response.data.next
+            ? new URL(response.data.next).searchParams.get('cursor')
+            : null;
         return {
             results: response.data.results,
-            next: response.data.next,
+            next,
         };
     } catch (error: any) {
         throw new Error(error.response?.data?.message || 'Failed to fetch comments.');